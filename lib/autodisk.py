@@ -298,7 +298,7 @@ class autodisk():
                 metadata_end_magic = build_meta.read32bit(f, "big",  build_info["autodisk_filedata_offset"] - 4)
 
                 if metadata_end_magic == AUTODISK_FILEM_END_MAGIC:
-                    metadata_calculated_crc = build_meta.crc32(build_meta.get_data(f, build_info["autodisk_offset"] + 0x08, metadata_size - 0x08))
+                    metadata_calculated_crc = build_meta.crc32_file_range(f, build_info["autodisk_offset"] + 0x08, metadata_size - 0x08)
 
                     if metadata_calculated_crc != metadata_found_crc:
                         if not silent:
@@ -1,14 +1,20 @@
 import os
 import sys
+import array
 import tempfile
 import ctypes
 import math
 import struct
+import mmap
+import errno
+import zlib
 import re
+import contextlib
 from enum import Enum
 from lib.lzss import *
 from lib.lzj import *
 from lib.tea import *
+from lib.compress_cache import compress_cache
 
 """
     All integers are big endian.
@@ -142,119 +148,70 @@ class build_meta():
 
         print(info + ", ".join(infos))
 
-    def checksum(data):
-        checksum = 0
+    # Below this many bytes plain sum() beats the cost of going through numpy.
+    NUMPY_SUM_MIN_SIZE = 0x10000
 
-        data = bytearray(data)
+    def lane_sums(data, lane_count = 4):
+        # Sum of every lane_count'th byte starting at 0, 1, ... lane_count - 1. Either numpy or sum()
+        # over a strided memoryview does the adding, neither one copies the data.
+        numpy = None
+        if len(data) >= build_meta.NUMPY_SUM_MIN_SIZE:
+            try:
+                import numpy
+            except ImportError:
+                pass
 
-        if (len(data) % 4) != 0:
-            for a in range(4 - (len(data) % 4)):
-                data.append(0)
+        if numpy != None:
+            data = numpy.frombuffer(data, dtype=numpy.uint8)
 
-        for i in range(0, len(data), 4):
-            checksum += ctypes.c_uint32(
-                (data[i] << 0x18) +
-                (data[i + 1] << 0x10) +
-                (data[i + 2] << 0x08) +
-                (data[i + 3])
-            ).value
+            return [int(data[lane::lane_count].sum(dtype=numpy.uint64)) for lane in range(lane_count)]
+        else:
+            with memoryview(data).cast("B") as view:
+                return [sum(view[lane::lane_count]) for lane in range(lane_count)]
 
-        return checksum & 0xffffffff
+    def checksum(data):
+        return build_meta.chunked_checksum(data, 4)
 
     def chunked_checksum(data, chunk_size = 4):
-        checksum = ctypes.c_uint32(0)
-
-        data = bytearray(data)
+        # Adds up data as big-endian chunk_size byte words with the last one padded out with zeros.
+        # Byte n of every word is worth the same, so each byte lane is summed and shifted into place.
+        if chunk_size < 1 or chunk_size > 4:
+            raise Exception("Checksum chunk size needs to be 1 to 4 bytes, got " + str(chunk_size))
 
-        if chunk_size > 1:
-            if (len(data) % chunk_size) != 0:
-                for a in range(chunk_size - (len(data) % chunk_size)):
-                    data.append(0)
+        checksum = 0
+        for lane, lane_sum in enumerate(build_meta.lane_sums(data, chunk_size)):
+            checksum += lane_sum << ((chunk_size - lane - 1) * 8)
 
-        for i in range(0, len(data), chunk_size):
-            if chunk_size == 1:
-                checksum.value += data[i]
-            elif chunk_size == 2:
-                checksum.value += (data[i] << 0x08) + (data[i + 1])
-            elif chunk_size == 3:
-                checksum.value += (data[i] << 0x10) + (data[i + 1] << 0x08) + (data[i + 2])
-            elif chunk_size == 4:
-                checksum.value += (data[i] << 0x18) + (data[i + 1] << 0x10) + (data[i + 2] << 0x08) + (data[i + 3])
+        return checksum & 0xffffffff
 
-        return checksum.value & 0xffffffff
+    # How much crc32_file_range reads at a time.
+    CRC32_READ_SIZE = 0x100000
 
     def crc32(data, crc = 0xffffffff):
-        table = [
-            0x00000000, 0x77073096, 0xee0e612c, 0x990951ba,
-            0x076dc419, 0x706af48f, 0xe963a535, 0x9e6495a3,
-            0x0edb8832, 0x79dcb8a4, 0xe0d5e91e, 0x97d2d988,
-            0x09b64c2b, 0x7eb17cbd, 0xe7b82d07, 0x90bf1d91,
-            0x1db71064, 0x6ab020f2, 0xf3b97148, 0x84be41de,
-            0x1adad47d, 0x6ddde4eb, 0xf4d4b551, 0x83d385c7,
-            0x136c9856, 0x646ba8c0, 0xfd62f97a, 0x8a65c9ec,
-            0x14015c4f, 0x63066cd9, 0xfa0f3d63, 0x8d080df5,
-            0x3b6e20c8, 0x4c69105e, 0xd56041e4, 0xa2677172,
-            0x3c03e4d1, 0x4b04d447, 0xd20d85fd, 0xa50ab56b,
-            0x35b5a8fa, 0x42b2986c, 0xdbbbc9d6, 0xacbcf940,
-            0x32d86ce3, 0x45df5c75, 0xdcd60dcf, 0xabd13d59,
-            0x26d930ac, 0x51de003a, 0xc8d75180, 0xbfd06116,
-            0x21b4f4b5, 0x56b3c423, 0xcfba9599, 0xb8bda50f,
-            0x2802b89e, 0x5f058808, 0xc60cd9b2, 0xb10be924,
-            0x2f6f7c87, 0x58684c11, 0xc1611dab, 0xb6662d3d,
-            0x76dc4190, 0x01db7106, 0x98d220bc, 0xefd5102a,
-            0x71b18589, 0x06b6b51f, 0x9fbfe4a5, 0xe8b8d433,
-            0x7807c9a2, 0x0f00f934, 0x9609a88e, 0xe10e9818,
-            0x7f6a0dbb, 0x086d3d2d, 0x91646c97, 0xe6635c01,
-            0x6b6b51f4, 0x1c6c6162, 0x856530d8, 0xf262004e,
-            0x6c0695ed, 0x1b01a57b, 0x8208f4c1, 0xf50fc457,
-            0x65b0d9c6, 0x12b7e950, 0x8bbeb8ea, 0xfcb9887c,
-            0x62dd1ddf, 0x15da2d49, 0x8cd37cf3, 0xfbd44c65,
-            0x4db26158, 0x3ab551ce, 0xa3bc0074, 0xd4bb30e2,
-            0x4adfa541, 0x3dd895d7, 0xa4d1c46d, 0xd3d6f4fb,
-            0x4369e96a, 0x346ed9fc, 0xad678846, 0xda60b8d0,
-            0x44042d73, 0x33031de5, 0xaa0a4c5f, 0xdd0d7cc9,
-            0x5005713c, 0x270241aa, 0xbe0b1010, 0xc90c2086,
-            0x5768b525, 0x206f85b3, 0xb966d409, 0xce61e49f,
-            0x5edef90e, 0x29d9c998, 0xb0d09822, 0xc7d7a8b4,
-            0x59b33d17, 0x2eb40d81, 0xb7bd5c3b, 0xc0ba6cad,
-            0xedb88320, 0x9abfb3b6, 0x03b6e20c, 0x74b1d29a,
-            0xead54739, 0x9dd277af, 0x04db2615, 0x73dc1683,
-            0xe3630b12, 0x94643b84, 0x0d6d6a3e, 0x7a6a5aa8,
-            0xe40ecf0b, 0x9309ff9d, 0x0a00ae27, 0x7d079eb1,
-            0xf00f9344, 0x8708a3d2, 0x1e01f268, 0x6906c2fe,
-            0xf762575d, 0x806567cb, 0x196c3671, 0x6e6b06e7,
-            0xfed41b76, 0x89d32be0, 0x10da7a5a, 0x67dd4acc,
-            0xf9b9df6f, 0x8ebeeff9, 0x17b7be43, 0x60b08ed5,
-            0xd6d6a3e8, 0xa1d1937e, 0x38d8c2c4, 0x4fdff252,
-            0xd1bb67f1, 0xa6bc5767, 0x3fb506dd, 0x48b2364b,
-            0xd80d2bda, 0xaf0a1b4c, 0x36034af6, 0x41047a60,
-            0xdf60efc3, 0xa867df55, 0x316e8eef, 0x4669be79,
-            0xcb61b38c, 0xbc66831a, 0x256fd2a0, 0x5268e236,
-            0xcc0c7795, 0xbb0b4703, 0x220216b9, 0x5505262f,
-            0xc5ba3bbe, 0xb2bd0b28, 0x2bb45a92, 0x5cb36a04,
-            0xc2d7ffa7, 0xb5d0cf31, 0x2cd99e8b, 0x5bdeae1d,
-            0x9b64c2b0, 0xec63f226, 0x756aa39c, 0x026d930a,
-            0x9c0906a9, 0xeb0e363f, 0x72076785, 0x05005713,
-            0x95bf4a82, 0xe2b87a14, 0x7bb12bae, 0x0cb61b38,
-            0x92d28e9b, 0xe5d5be0d, 0x7cdcefb7, 0x0bdbdf21,
-            0x86d3d2d4, 0xf1d4e242, 0x68ddb3f8, 0x1fda836e,
-            0x81be16cd, 0xf6b9265b, 0x6fb077e1, 0x18b74777,
-            0x88085ae6, 0xff0f6a70, 0x66063bca, 0x11010b5c,
-            0x8f659eff, 0xf862ae69, 0x616bffd3, 0x166ccf45,
-            0xa00ae278, 0xd70dd2ee, 0x4e048354, 0x3903b3c2,
-            0xa7672661, 0xd06016f7, 0x4969474d, 0x3e6e77db,
-            0xaed16a4a, 0xd9d65adc, 0x40df0b66, 0x37d83bf0,
-            0xa9bcae53, 0xdebb9ec5, 0x47b2cf7f, 0x30b5ffe9,
-            0xbdbdf21c, 0xcabac28a, 0x53b39330, 0x24b4a3a6,
-            0xbad03605, 0xcdd70693, 0x54de5729, 0x23d967bf,
-            0xb3667a2e, 0xc4614ab8, 0x5d681b02, 0x2a6f2b94,
-            0xb40bbe37, 0xc30c8ea1, 0x5a05df1b, 0x2d02ef8d
-        ]
+        # WebTV's CRC32 starts at 0xffffffff and leaves off the final XOR. zlib.crc32 XORs going in
+        # and coming out, so XORing around it gives the WebTV value and lets crc carry on a running one.
+        return zlib.crc32(data, (crc & 0xffffffff) ^ 0xffffffff) ^ 0xffffffff
 
-        for byte in data:  
-            crc = table[(byte ^ crc) & 0xff] ^ (crc >> 8)
+    def crc32_file_range(f, start_offset = 0, read_size = 0, crc = 0xffffffff):
+        # Same as crc32(get_data(f, start_offset, read_size)) but reads in pieces rather than all at once.
+        f.seek(0, os.SEEK_END)
+        data_size = f.tell()
 
-        return crc & 0xffffffff
+        if read_size <= 0:
+            read_size = data_size - start_offset
+
+        crc_stream = crc32_stream(crc)
+
+        f.seek(start_offset)
+        while read_size > 0:
+            data = f.read(min(read_size, build_meta.CRC32_READ_SIZE))
+            if len(data) == 0:
+                break
+
+            crc_stream.update(data)
+            read_size -= len(data)
+
+        return crc_stream.value()
 
     def align(_bytes, align_to = 0x200):
         alignment_size = align_to - (_bytes % align_to)
@@ -263,70 +220,89 @@ class build_meta():
         else:
             return 0
 
-    def swap_data(data, swap_bits = 32, start_offset = 0x00, end_offset = 0x00):
-        new_data = bytearray(0x00)
-        for idx in range(start_offset, end_offset if end_offset > 0 else len(data), 0x02 if swap_bits == 16 else 0x04):
-            swap_data = bytearray(0x00)
-            if swap_bits == 32:
-                swap_data = bytearray(data[idx:(idx + 0x04)])
-                swap_data.reverse()
-            elif swap_bits == 16:
-                swap_data = bytearray(data[idx:(idx + 0x02)])
-                swap_data.reverse()
-            elif swap_bits == 1632 or swap_bits == 3216:
-                _swap_data = bytearray(data[idx:(idx + 0x04)])
-                _swap_data.reverse()
-
-                swap_data = bytearray(0x04)
-                swap_data[0] = _swap_data[1]
-                swap_data[1] = _swap_data[0]
-                swap_data[2] = _swap_data[3]
-                swap_data[3] = _swap_data[2]
-            else:
-                swap_data = bytearray(data[idx:(idx + 0x04)])
+    # How much swap_file_data reads at a time, needs to be a multiple of 4.
+    SWAP_READ_SIZE = 0x100000
+
+    def swap_word_size(swap_bits = 32):
+        return 0x02 if swap_bits == 16 else 0x04
+
+    def swap_bytes(data, swap_bits = 32):
+        # Swaps every whole word in data with array.byteswap(). A partial word at the end
+        # is turned around on its own for 16 and 32, 16/32 can't swap one.
+        word_size = build_meta.swap_word_size(swap_bits)
+        whole_size = len(data) - (len(data) % word_size)
+
+        if swap_bits == 32 or swap_bits == 16 or swap_bits == 1632 or swap_bits == 3216:
+            words = array.array("H" if word_size == 0x02 else "I")
+            words.frombytes(data[0:whole_size])
+            words.byteswap()
+
+            if swap_bits == 1632 or swap_bits == 3216:
+                # 32 then 16 leaves the bytes in each half where they were and swaps the halves.
+                _words = array.array("H")
+                _words.frombytes(words.tobytes())
+                _words.byteswap()
+                words = _words
+
+            swapped_data = bytearray(words.tobytes())
+        else:
+            swapped_data = bytearray(data[0:whole_size])
+
+        if whole_size < len(data):
+            if swap_bits == 1632 or swap_bits == 3216:
+                raise Exception("Can't 16/32 swap the last " + str(len(data) - whole_size) + " byte(s), the data needs to be a multiple of 4 bytes")
+
+            tail_data = bytearray(data[whole_size:])
+
+            if swap_bits == 32 or swap_bits == 16:
+                tail_data.reverse()
 
-            new_data += swap_data
+            swapped_data += tail_data
 
-        return new_data
+        return swapped_data
 
+    def swap_range(start_offset, end_offset, data_size, swap_bits = 32):
+        # Where swapping stops. It goes word by word from start_offset so the last word can run past end_offset.
+        word_size = build_meta.swap_word_size(swap_bits)
+
+        if end_offset <= start_offset:
+            return start_offset
+
+        end_offset = start_offset + (math.ceil((end_offset - start_offset) / word_size) * word_size)
+
+        if end_offset > data_size and (swap_bits == 1632 or swap_bits == 3216):
+            raise Exception("Can't 16/32 swap past the end of the data at " + hex(data_size))
+
+        return min(end_offset, data_size)
+
+    def swap_data(data, swap_bits = 32, start_offset = 0x00, end_offset = 0x00):
+        end_offset = build_meta.swap_range(start_offset, end_offset if end_offset > 0 else len(data), len(data), swap_bits)
+
+        return build_meta.swap_bytes(data[start_offset:end_offset], swap_bits)
 
     def swap_file_data(in_path, out_path = None, swap_bits = 32, start_offset = 0x00, end_offset = 0x00):
         if out_path == None:
             out_path = tempfile.mktemp()
 
         with open(in_path, "rb") as f:
-            file_start = start_offset
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
 
-            file_end = 0x00
-            if end_offset == 0x00:
-                f.seek(0, os.SEEK_END)
-                file_end = f.tell()
-            else:
-                file_end = end_offset
+            file_start = start_offset
+            file_end = build_meta.swap_range(file_start, end_offset if end_offset > 0 else file_size, file_size, swap_bits)
 
             f.seek(file_start)
+            build_meta.forget_detect(out_path)
             with open(out_path, "wb") as f2:
-                for index in range(file_start, file_end, 0x04):
-                    data = bytearray(0x00)
-                    if swap_bits == 32:
-                        data = bytearray(f.read(0x04))
-                        data.reverse()
-                    elif swap_bits == 32:
-                        data = bytearray(f.read(0x02))
-                        data.reverse()
-                    elif swap_bits == 1632 or swap_bits == 3216:
-                        _data = bytearray(f.read(0x04))
-                        _data.reverse()
-
-                        data = bytearray(0x04)
-                        data[0] = _data[1]
-                        data[1] = _data[0]
-                        data[2] = _data[3]
-                        data[3] = _data[2]
-                    else:
-                        data = bytearray(f.read(0x04))
+                read_size = max(file_end - file_start, 0)
+                while read_size > 0:
+                    data = f.read(min(read_size, build_meta.SWAP_READ_SIZE))
+                    if len(data) == 0:
+                        break
+
+                    f2.write(build_meta.swap_bytes(data, swap_bits))
+                    read_size -= len(data)
 
-                    f2.write(data)
                 f2.close()
             f.close()
 
@@ -352,6 +328,7 @@ class build_meta():
         return data
 
     def write_object_file(build_info, data, silent = False):
+        build_meta.forget_detect(build_info["out_path"])
         with open(build_info["out_path"], 'wb') as f:
             f.write(data)
 
@@ -388,7 +365,7 @@ class build_meta():
         return image_type in box_types
 
 
-    def build_blob(build_info, endian, romfs_blob, data_blob = b'', autodisk_blob = b'', level1_build_blob = b'', level1_lzj_version = None, tmpfs_blob = b'', silent = False):
+    def build_blob(build_info, endian, romfs_blob, data_blob = b'', autodisk_blob = b'', level1_build_blob = b'', level1_lzj_version = None, tmpfs_blob = b'', silent = False, level1_lzj_match_finder = None, cache_dir = None, level1_lzj_progress = None, level1_lzj_summaries = None, workers = 0):
         AUTODISK_FILEM_BGN_MAGIC = 0x39592841
         AUTODISK_FILEM_END_MAGIC = 0x11993456
         build_info["romfs_address"] -= 8
@@ -418,10 +395,13 @@ class build_meta():
                     compressed_blob = b''
                     if build_info["bootrom_level1_compression"] == FILE_COMPRESSION.LZSS:
                         d = lzss()
-                        compressed_blob = d.Lzss_Compress(level1_build_blob)
+                        compressed_blob = compress_cache.compress(cache_dir, level1_build_blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION, d.Lzss_Compress, silent)
                     else:
-                        d = lzj(LZJ_VERSION.VERSION1)
-                        compressed_blob = d.Lzj_Compress(level1_build_blob)
+                        d = lzj(LZJ_VERSION.VERSION1, progress_callback = level1_lzj_progress, checkpoint_dir = compress_cache.checkpoint_dir(cache_dir))
+                        compressed_blob = compress_cache.compress(cache_dir, level1_build_blob, LZJ_VERSION.VERSION1, lzj.ENCODER_REVISION, d.Lzj_Compress, silent)
+
+                        if level1_lzj_summaries != None and d.summary != None:
+                            level1_lzj_summaries.append(d.summary)
 
                     if len(compressed_blob) > 0:
                         compressed_level1_build_blob = bytearray(0x10) + compressed_blob
@@ -440,8 +420,15 @@ class build_meta():
                     elif build_info["level1_lzj_version"] == -1:
                         build_info["level1_lzj_version"] = LZJ_VERSION.VERSION2
 
-                    d = lzj(LZJ_VERSION(build_info["level1_lzj_version"]))
-                    compressed_blob = d.Lzj_Compress(level1_build_blob)
+                    if level1_lzj_match_finder == None:
+                        level1_lzj_match_finder = LZJ_MATCH_FINDER.RADIX
+
+                    d = lzj(LZJ_VERSION(build_info["level1_lzj_version"]), level1_lzj_match_finder, workers, progress_callback = level1_lzj_progress, checkpoint_dir = compress_cache.checkpoint_dir(cache_dir))
+                    compressed_blob = compress_cache.compress(cache_dir, level1_build_blob, LZJ_VERSION(build_info["level1_lzj_version"]), lzj.ENCODER_REVISION, d.Lzj_Compress, silent)
+
+                    # A cache hit leaves no summary.
+                    if level1_lzj_summaries != None and d.summary != None:
+                        level1_lzj_summaries.append(d.summary)
 
                     if len(compressed_blob) > 0:
                         compressed_level1_build_blob = compressed_blob
@@ -678,36 +665,35 @@ class build_meta():
                     compressed_level1_build_size
                 )
             else:
-                struct.pack_into(
+                # The header fields go in through code_image so the checksum is kept up to date as they do.
+                code_image = checksum_image(code_blob)
+
+                code_image.pack_into(
                     endian + "II",
-                    code_blob,
                     0x08,
                     0x00000000,
                     build_size >> 2
                 )
 
                 if data_blob != None and len(data_blob) > 0:
-                    struct.pack_into(
+                    code_image.pack_into(
                         endian + "I",
-                        code_blob,
                         0x10,
                         len(code_blob) >> 2
                     )
 
-                    struct.pack_into(
+                    code_image.pack_into(
                         endian + "I",
-                        code_blob,
                         0x1c,
                         data_size >> 2
                     )
-                    struct.pack_into(
+                    code_image.pack_into(
                         endian + "I",
-                        code_blob,
                         0x38,
                         compressed_data_size
                     )
                     
-                code_checksum = build_meta.chunked_checksum(code_blob)
+                code_checksum = code_image.checksum()
                 struct.pack_into(
                     endian + "I",
                     code_blob,
@@ -770,6 +756,14 @@ class build_meta():
         
         return build_info
 
+    SCRAMBLED_SIGNATURES = {}
+
+    def scrambled_signature(signature):
+        if signature not in build_meta.SCRAMBLED_SIGNATURES:
+            build_meta.SCRAMBLED_SIGNATURES[signature] = romfs_cipher.scramble(signature)
+
+        return build_meta.SCRAMBLED_SIGNATURES[signature]
+
     def test_romfs(f, base, file_size = 0xffffffff, start_offset = 0):
         base += start_offset
 
@@ -865,7 +859,12 @@ class build_meta():
             romfs_sig = bytes(f.read(len(sig_test["signature"])))
 
             if sig_test["image_type"] == IMAGE_TYPE.VIEWER_SCRAMBLED:
-                if romfs_cipher.unscramble(romfs_sig) == sig_test["signature"]:
+                # TEA maps whole blocks one to one, so a full block can be matched against the scrambled
+                # signature rather than unscrambling what was read on every test.
+                if len(romfs_sig) == 8:
+                    if romfs_sig == build_meta.scrambled_signature(sig_test["signature"]):
+                        return sig_test["image_type"]
+                elif romfs_cipher.unscramble(romfs_sig) == sig_test["signature"]:
                     return sig_test["image_type"]
             else:
                 if romfs_sig == sig_test["signature"]:
@@ -873,6 +872,19 @@ class build_meta():
 
         return None
         
+    def read_words(f, words_struct, position = -1, start_offset = 0):
+        # Reads a run of big-endian 32-bit words in one go. Words past the end of the file get
+        # whatever bytes were there, the same as reading each one with read32bit would give.
+        if position != -1:
+            f.seek(start_offset + position)
+
+        data = bytes(f.read(words_struct.size))
+
+        if len(data) == words_struct.size:
+            return words_struct.unpack(data)
+        else:
+            return [int.from_bytes(data[i:(i + 4)], "big") for i in range(0, words_struct.size, 4)]
+
     def read32bit(f, endian = "big", position = -1, start_offset = 0):
         if position != -1:
             f.seek(start_offset + position)
@@ -983,7 +995,64 @@ class build_meta():
        }
 
     
-    def detect(path):
+    # Windows of words detect() reads its fields through, each with a single read.
+    HEADER_STRUCT = struct.Struct(">16I") # Build header 0x00-0x3f
+    AUTODISK_HEADER_STRUCT = struct.Struct(">6I") # Autodisk metadata header 0x00-0x17
+    WINCE_ROMHDR_STRUCT = struct.Struct(">18I") # WinCE ROMHDR 0x00-0x47
+
+    # detect() results by file identity, so an image that's detected again in the same run isn't probed again.
+    DETECT_CACHE = {}
+    DETECT_CACHE_STATS = {
+        "hits": 0,
+        "misses": 0
+    }
+
+    def detect_cache_key(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return (os.path.realpath(path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def forget_detect(path = None):
+        # Anything that writes an image calls this first so a same sized rewrite within the mtime resolution isn't missed.
+        if path == None:
+            build_meta.DETECT_CACHE.clear()
+        else:
+            real_path = os.path.realpath(path)
+
+            for key in [key for key in build_meta.DETECT_CACHE.keys() if key[0] == real_path]:
+                del build_meta.DETECT_CACHE[key]
+
+    def detect(path, opened_file = None):
+        # Only whole files at path are remembered, an already opened file could be reading anything.
+        if opened_file != None:
+            return build_meta.detect_uncached(path, opened_file)
+
+        key = build_meta.detect_cache_key(path)
+
+        if key != None and key in build_meta.DETECT_CACHE:
+            build_meta.DETECT_CACHE_STATS["hits"] += 1
+
+            build_info = build_meta.DETECT_CACHE[key]
+        else:
+            build_meta.DETECT_CACHE_STATS["misses"] += 1
+
+            build_info = build_meta.detect_uncached(path)
+
+            if key != None:
+                build_meta.forget_detect(path)
+                build_meta.DETECT_CACHE[key] = build_info
+
+        # Callers fill in and change what they get back so each gets its own copy. Everything detect sets is a
+        # plain value so a shallow copy is enough. The path is kept the way this caller spelled it.
+        build_info = dict(build_info)
+        build_info["path"] = path
+
+        return build_info
+
+    def detect_uncached(path, opened_file = None):
         BUILD_START = b'\x10\x00\x00'
         UTV_START = b'\x10\x00\x04'
         ALPHA_START = b'\x10\x00\x01'
@@ -1003,27 +1072,29 @@ class build_meta():
 
             f.seek(start_offset)
             if bytes(f.read(len(COMPRESSED_BUILD_START))) == COMPRESSED_BUILD_START:
-                build_info["code_checksum"] = build_meta.read32bit(f, "big", 0x08, build_info["start_offset"])
-                build_info["build_size"] = build_meta.read32bit(f, "big", 0x0c, build_info["start_offset"]) << 2
-                build_info["code_size"] = build_meta.read32bit(f, "big", 0x10, build_info["start_offset"]) << 2
+                header = build_meta.read_words(f, build_meta.HEADER_STRUCT, 0x00, build_info["start_offset"])
+
+                build_info["code_checksum"] = header[0x08 >> 2]
+                build_info["build_size"] = header[0x0c >> 2] << 2
+                build_info["code_size"] = header[0x10 >> 2] << 2
 
-                build_info["build_version"] = build_meta.read32bit(f, "big", 0x14, build_info["start_offset"])
+                build_info["build_version"] = header[0x14 >> 2]
 
-                build_info["build_address"] = build_meta.read32bit(f, "big", 0x30, build_info["start_offset"])
+                build_info["build_address"] = header[0x30 >> 2]
 
                 build_info["end_offset"] = 0
                 build_info["level1_image_offset"] = 0x200
                 build_info["level1_image_address"] = build_info["build_address"] + build_info["level1_image_offset"]
-                build_info["level1_image_size"] = build_meta.read32bit(f, "big", 0x2c, build_info["start_offset"])
-                build_info["level1_lzj_version"] = build_meta.read32bit(f, "big", 0x28, build_info["start_offset"])
+                build_info["level1_image_size"] = header[0x2c >> 2]
+                build_info["level1_lzj_version"] = header[0x28 >> 2]
 
-                build_info["build_flags"] = build_meta.read32bit(f, "big", 0x34, build_info["start_offset"])
+                build_info["build_flags"] = header[0x34 >> 2]
 
-                build_info["data_address"] = build_meta.read32bit(f, "big", 0x18, build_info["start_offset"])
+                build_info["data_address"] = header[0x18 >> 2]
                 build_info["data_offset"] = build_info["data_address"] - build_info["build_address"]
-                build_info["data_size"] = build_meta.read32bit(f, "big", 0x1c, build_info["start_offset"]) << 2
-                build_info["bss_size"] = build_meta.read32bit(f, "big", 0x20, build_info["start_offset"]) << 2
-                build_info["compressed_data_size"] = build_meta.read32bit(f, "big", 0x38, build_info["start_offset"])
+                build_info["data_size"] = header[0x1c >> 2] << 2
+                build_info["bss_size"] = header[0x20 >> 2] << 2
+                build_info["compressed_data_size"] = header[0x38 >> 2]
 
                 return True
             else:
@@ -1032,21 +1103,23 @@ class build_meta():
                 if start == BUILD_START or start == UTV_START or start == ALPHA_START:
                     build_info["start_offset"] = start_offset
 
-                    build_info["code_checksum"] = build_meta.read32bit(f, "big", 0x08, build_info["start_offset"])
-                    build_info["build_size"] = build_meta.read32bit(f, "big", 0x0c, build_info["start_offset"]) << 2
-                    build_info["code_size"] = build_meta.read32bit(f, "big", 0x10, build_info["start_offset"]) << 2
-                    build_info["jump_offset"] = (build_meta.read16bit(f, "big", 0x02, build_info["start_offset"]) << 2) + 0x04
+                    header = build_meta.read_words(f, build_meta.HEADER_STRUCT, 0x00, build_info["start_offset"])
+
+                    build_info["code_checksum"] = header[0x08 >> 2]
+                    build_info["build_size"] = header[0x0c >> 2] << 2
+                    build_info["code_size"] = header[0x10 >> 2] << 2
+                    build_info["jump_offset"] = ((header[0x00 >> 2] & 0xffff) << 2) + 0x04
 
-                    build_info["build_version"] = build_meta.read32bit(f, "big", 0x14, build_info["start_offset"])
+                    build_info["build_version"] = header[0x14 >> 2]
 
-                    _romfs_address = build_meta.read32bit(f, "big", 0x24, build_info["start_offset"])
+                    _romfs_address = header[0x24 >> 2]
 
                     if build_info["jump_offset"] > 0x30:
-                        build_info["build_address"] = build_meta.read32bit(f, "big", 0x30, build_info["start_offset"])
-                        build_info["build_flags"] = build_meta.read32bit(f, "big", 0x34, build_info["start_offset"])
-                        build_info["compressed_data_size"] = build_meta.read32bit(f, "big", 0x38, build_info["start_offset"])
+                        build_info["build_address"] = header[0x30 >> 2]
+                        build_info["build_flags"] = header[0x34 >> 2]
+                        build_info["compressed_data_size"] = header[0x38 >> 2]
 
-                        _compressed_bootrom_level1_address = build_meta.read32bit(f, "big", 0x3c, build_info["start_offset"])
+                        _compressed_bootrom_level1_address = header[0x3c >> 2]
                         if _compressed_bootrom_level1_address > 0 and _compressed_bootrom_level1_address > build_info["build_address"]:
                             _bootrom_level1_offset = (_compressed_bootrom_level1_address - build_info["build_address"])
                             _romfs_offset = file_size
@@ -1064,10 +1137,10 @@ class build_meta():
                         else:
                             build_info["build_address"] = 0x9f000000 # bf0 Classic AppROM
 
-                    build_info["data_address"] = build_meta.read32bit(f, "big", 0x18, build_info["start_offset"])
+                    build_info["data_address"] = header[0x18 >> 2]
                     build_info["data_offset"] = build_info["data_address"] - build_info["build_address"]
-                    build_info["data_size"] = build_meta.read32bit(f, "big", 0x1c, build_info["start_offset"]) << 2
-                    build_info["bss_size"] = build_meta.read32bit(f, "big", 0x20, build_info["start_offset"]) << 2
+                    build_info["data_size"] = header[0x1c >> 2] << 2
+                    build_info["bss_size"] = header[0x20 >> 2] << 2
 
                     _romfs_offset = (_romfs_address - build_info["build_address"])
 
@@ -1084,10 +1157,12 @@ class build_meta():
                             build_info["footer_offset"] = _romfs_offset
                             build_info["footer_address"] = _romfs_address
 
-                            autodisk_metadata_begin_magic = build_meta.read32bit(f, "big", _romfs_offset, build_info["start_offset"])
+                            autodisk_header = build_meta.read_words(f, build_meta.AUTODISK_HEADER_STRUCT, _romfs_offset, build_info["start_offset"])
+
+                            autodisk_metadata_begin_magic = autodisk_header[0x00 >> 2]
                             if autodisk_metadata_begin_magic == AUTODISK_FILEM_BGN_MAGIC:
-                                autodisk_metadata_size = build_meta.read32bit(f, "big", _romfs_offset + 0x10, build_info["start_offset"])
-                                autodisk_file_count = build_meta.read32bit(f, "big", _romfs_offset + 0x14, build_info["start_offset"])
+                                autodisk_metadata_size = autodisk_header[0x10 >> 2]
+                                autodisk_file_count = autodisk_header[0x14 >> 2]
 
                                 if autodisk_metadata_size > 0 and autodisk_metadata_size <= 0x10000 and autodisk_file_count > 0 and autodisk_file_count <= 0x400:
                                     autodisk_filedata_offset = _romfs_offset + autodisk_metadata_size
@@ -1105,12 +1180,17 @@ class build_meta():
 
                     return True
 
-        with open(path, "rb") as f:
+        # opened_file can be an already opened file (like a level1_reader) to detect something that isn't at path, it's
+        # left open for the caller. Otherwise the file is mapped once rather than going to the OS for every small read.
+        with (mapped_file(path) if opened_file == None else contextlib.nullcontext(opened_file)) as f:
             f.seek(0, os.SEEK_END)
             file_size = f.tell()
 
             build_info["start_offset"] = 0
 
+            # Files too small to hold a build are left as UNKNOWN.
+            detected_image_type = None
+
             if file_size > MIN_FILE_SIZE:
                 if not check_offsets(f, 0) and check_offsets(f, 0x20):
                     build_info["start_offset"] = 0x20
@@ -1195,26 +1275,362 @@ class build_meta():
 
                 build_info["wince_romhdr_address"] = build_meta.read32bit(f, "big", 0x1044, build_info["start_offset"])
                 build_info["wince_romhdr_offset"] =  (build_info["wince_romhdr_address"] - build_info["build_address"])
-                build_info["wince_romhdr_dllfirst"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x00, build_info["start_offset"])
-                build_info["wince_romhdr_dlllast"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x04, build_info["start_offset"])
-                build_info["wince_romhdr_physfirst"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x08, build_info["start_offset"])
-                build_info["wince_romhdr_physlast"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x0c, build_info["start_offset"])
-                build_info["wince_romhdr_ramstart"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x14, build_info["start_offset"])
-                build_info["wince_romhdr_ramfree"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x18, build_info["start_offset"])
-                build_info["wince_romhdr_ramend"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x1c, build_info["start_offset"])
-                build_info["wince_romhdr_kernelflags"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x34, build_info["start_offset"])
-                build_info["wince_romhdr_fsrampercent"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x38, build_info["start_offset"])
-                build_info["wince_romhdr_uscputype"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x40, build_info["start_offset"])
-                build_info["wince_romhdr_usmiscflags"] = build_meta.read32bit(f, "big", build_info["wince_romhdr_offset"] + 0x44, build_info["start_offset"])
 
-            f.close()
+                wince_romhdr = build_meta.read_words(f, build_meta.WINCE_ROMHDR_STRUCT, build_info["wince_romhdr_offset"], build_info["start_offset"])
 
+                build_info["wince_romhdr_dllfirst"] = wince_romhdr[0x00 >> 2]
+                build_info["wince_romhdr_dlllast"] = wince_romhdr[0x04 >> 2]
+                build_info["wince_romhdr_physfirst"] = wince_romhdr[0x08 >> 2]
+                build_info["wince_romhdr_physlast"] = wince_romhdr[0x0c >> 2]
+                build_info["wince_romhdr_ramstart"] = wince_romhdr[0x14 >> 2]
+                build_info["wince_romhdr_ramfree"] = wince_romhdr[0x18 >> 2]
+                build_info["wince_romhdr_ramend"] = wince_romhdr[0x1c >> 2]
+                build_info["wince_romhdr_kernelflags"] = wince_romhdr[0x34 >> 2]
+                build_info["wince_romhdr_fsrampercent"] = wince_romhdr[0x38 >> 2]
+                build_info["wince_romhdr_uscputype"] = wince_romhdr[0x40 >> 2]
+                build_info["wince_romhdr_usmiscflags"] = wince_romhdr[0x44 >> 2]
 
         return build_info
 
+class mapped_file():
+    # Read only file object over an mmap of a whole file. Acts like a file opened "rb", seeking
+    # past the end included, without a trip to the OS for each read.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+
+            # Empty files can't be mapped
+            if self.size > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = b''
+
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_END:
+            position = self.size + offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        else:
+            position = offset
+
+        if position < 0:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        self.position = position
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+        if size < 0:
+            data = self.map[self.position:]
+        else:
+            data = self.map[self.position:(self.position + size)]
+
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+class checksum_image():
+    # Keeps build_meta.chunked_checksum(data[start:end], chunk_size) up to date as fields in data are
+    # patched. Only the words a patch touches are summed again, so fixing up a header is the same
+    # amount of work however big the image is. The whole range is only summed on load and by verify().
+    def __init__(self, data, start = 0, end = -1, chunk_size = 4):
+        self.data = data
+        self.start = start
+        self.end = len(data) if end < 0 else end
+        self.chunk_size = chunk_size
+        self.word_sum = 0
+
+        self.verify()
+
+    def range_sum(self, start, end):
+        # Sum of the words from start to end, widened out to whole words and clipped to the checksum range.
+        start = max(start, self.start)
+        end = min(end, self.end)
+
+        if end <= start:
+            return 0
+
+        start -= (start - self.start) % self.chunk_size
+        end += (self.chunk_size - ((end - self.start) % self.chunk_size)) % self.chunk_size
+        end = min(end, self.end)
+
+        return build_meta.chunked_checksum(self.data[start:end], self.chunk_size)
+
+    def write(self, offset, data):
+        if offset < 0 or (offset + len(data)) > len(self.data):
+            raise Exception("Can't patch " + hex(len(data)) + " bytes at " + hex(offset) + ", it's past the end of the image")
+
+        old_sum = self.range_sum(offset, offset + len(data))
+        self.data[offset:(offset + len(data))] = data
+        new_sum = self.range_sum(offset, offset + len(data))
+
+        self.word_sum = (self.word_sum + new_sum - old_sum) & 0xffffffff
+
+    def pack_into(self, format, offset, *values):
+        self.write(offset, struct.pack(format, *values))
+
+    def checksum(self):
+        return self.word_sum
+
+    def verify(self):
+        # Sums the whole range again. Returns if the running sum was right and keeps the new one either way.
+        word_sum = build_meta.chunked_checksum(memoryview(self.data)[self.start:self.end], self.chunk_size)
+
+        matches = (word_sum == self.word_sum)
+        self.word_sum = word_sum
+
+        return matches
+
+class crc32_stream():
+    # build_meta.crc32 over data that comes in pieces.
+    def __init__(self, crc = 0xffffffff):
+        self.crc = crc & 0xffffffff
+
+    def update(self, data):
+        self.crc = build_meta.crc32(data, self.crc)
+
+        return self
+
+    def value(self):
+        return self.crc
+
+class level1_reader():
+    # Read only file object over an image that's still compressed. Data is only expanded
+    # as far as something has been read so detect() can look at the header without a full expand.
+    def __init__(self, size, expand_more, close = None, data = b''):
+        # expand_more(end) returns the next decoded bytes (at least up to end if it can) or b'' once there's no more.
+        self.size = size
+        self.expand_more = expand_more
+        self.on_close = close
+        self.data = bytearray(data)
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def expand_to(self, end):
+        end = min(end, self.size)
+
+        while len(self.data) < end:
+            data = self.expand_more(end)
+            if len(data) == 0:
+                break
+
+            self.data += data
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_END:
+            self.position = self.size + offset
+        elif whence == os.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = offset
+
+        self.position = max(self.position, 0)
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+        if size < 0:
+            end = self.size
+        else:
+            end = min(self.position + size, self.size)
+
+        self.expand_to(end)
+
+        data = bytes(self.data[self.position:end])
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        if self.on_close != None:
+            self.on_close()
+            self.on_close = None
+
+class scrambled_reader():
+    # Read only file object over a scrambled vwr file. Blocks are unscrambled as they're read and
+    # the last few chunks are kept so detect() and the ROMFS walk can work on it without a temp file.
+    CHUNK_SIZE = 0x1000
+    CACHE_CHUNKS = 0x10
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.f.seek(0, os.SEEK_END)
+        self.size = self.f.tell()
+        self.scrambled_size = romfs_cipher.scrambled_size(self.size)
+        self.chunks = {}
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def unscramble_range(self, start, end):
+        self.f.seek(start)
+        data = self.f.read(end - start)
+
+        scrambled_end = min(max(self.scrambled_size - start, 0), len(data))
+
+        return romfs_cipher.unscramble_blocks(data[0:scrambled_end]) + data[scrambled_end:]
+
+    def read_chunk(self, index):
+        if index in self.chunks:
+            return self.chunks[index]
+
+        chunk = self.unscramble_range(index * self.CHUNK_SIZE, (index + 1) * self.CHUNK_SIZE)
+
+        # Dicts keep insertion order so the first one is the oldest.
+        if len(self.chunks) >= self.CACHE_CHUNKS:
+            del self.chunks[next(iter(self.chunks))]
+
+        self.chunks[index] = chunk
+
+        return chunk
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_END:
+            self.position = self.size + offset
+        elif whence == os.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = offset
+
+        self.position = max(self.position, 0)
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+        if size < 0:
+            end = self.size
+        else:
+            end = min(self.position + size, self.size)
+
+        if end <= self.position:
+            return b''
+
+        first_chunk = self.position // self.CHUNK_SIZE
+        last_chunk = (end - 1) // self.CHUNK_SIZE
+
+        if (last_chunk - first_chunk) >= self.CACHE_CHUNKS:
+            # Too big for the cache so it's unscrambled in one go.
+            data = self.unscramble_range(first_chunk * self.CHUNK_SIZE, (last_chunk + 1) * self.CHUNK_SIZE)
+        else:
+            data = b''.join([self.read_chunk(index) for index in range(first_chunk, last_chunk + 1)])
+
+        start = self.position - (first_chunk * self.CHUNK_SIZE)
+        data = data[start:(start + end - self.position)]
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        self.f.close()
+        self.chunks = {}
+
 class build_matryoshka():
+    def open_level1(build_info):
+        # Gives a level1_reader over the compressed level1 image or None if there isn't one.
+        if build_info["image_type"] == IMAGE_TYPE.COMPRESSED_BOOTROM and build_info["bootrom_level1_compression"] == FILE_COMPRESSION.LZSS:
+            f = open(build_info["path"], "rb")
+            f.seek(0, os.SEEK_END)
+            read_size = f.tell() - (build_info["bootrom_level1_offset"] + 0x10)
+            f.seek(build_info["bootrom_level1_offset"] + 0x10)
+
+            d = LzssDecompressor(build_info["bootrom_level1_size"])
+
+            def expand_more(end):
+                nonlocal read_size
+
+                while read_size > 0 and not d.eof:
+                    data = f.read(min(read_size, 0x10000))
+                    if len(data) == 0:
+                        break
+
+                    read_size -= len(data)
+                    data = d.feed(data)
+                    if len(data) > 0:
+                        return data
+
+                return b''
+
+            return level1_reader(build_info["bootrom_level1_size"], expand_more, f.close)
+        elif build_info["image_type"] == IMAGE_TYPE.COMPRESSED_BOOTROM or build_info["image_type"] == IMAGE_TYPE.COMPRESSED_BOX:
+            with open(build_info["path"], "rb") as f:
+                if build_info["image_type"] == IMAGE_TYPE.COMPRESSED_BOOTROM:
+                    f.seek(build_info["bootrom_level1_offset"] + 0x10)
+                    data = f.read()
+
+                    d = lzj(LZJ_VERSION.VERSION1)
+                else:
+                    f.seek(build_info["level1_image_offset"])
+                    data = f.read(build_info["level1_image_size"])
+
+                    d = lzj(LZJ_VERSION(build_info["level1_lzj_version"]))
+
+                f.close()
+
+            if d.version == LZJ_VERSION.VERSIONX:
+                return level1_reader(len(data), lambda end: b'', None, data)
+
+            d.Lzj_Expand(data, 0)
+
+            def expand_more(end):
+                start = d.uncompressed_index
+                d.Lzj_ExpandTo(max(end, start + 0x10000))
+
+                return bytes(d.uncompressed_data[start:d.uncompressed_index])
+
+            return level1_reader(d.uncompressed_length, expand_more)
+        else:
+            return None
+
+    def detect_level1(build_info):
+        # Like expand_level1/expand_bootrom_level1 but only expands as much as detect needs and doesn't write a file.
+        # The expanded image is never written so its path is the image it's in. This is only good for looking at its build info.
+        f = build_matryoshka.open_level1(build_info)
+
+        if f != None:
+            with f:
+                new_build_info = build_meta.detect(build_info["path"], f)
+
+            new_build_info["is_level1_image"] = True
+            new_build_info["original_path"] = build_info["path"]
+
+            return new_build_info
+        else:
+            return build_info
+
     def expand_bootrom_level1(build_info):
         td, tmp_path = tempfile.mkstemp()
+        build_meta.forget_detect(tmp_path)
 
         if build_info["bootrom_level1_offset"] > 0:
             with os.fdopen(td, "wb") as t:
@@ -1223,12 +1639,22 @@ class build_matryoshka():
                     file_size = f.tell()
 
                     f.seek(build_info["bootrom_level1_offset"] + 0x10)
-                    data = f.read(file_size - (build_info["bootrom_level1_offset"] + 0x10))
+                    read_size = file_size - (build_info["bootrom_level1_offset"] + 0x10)
 
                     if build_info["bootrom_level1_compression"] == FILE_COMPRESSION.LZSS:
-                        d = lzss()
-                        t.write(d.Lzss_Expand(data, build_info["bootrom_level1_size"]))
+                        # Stream it through so neither the compressed or expanded image needs to be held in memory.
+                        d = LzssDecompressor(build_info["bootrom_level1_size"])
+                        while read_size > 0 and not d.eof:
+                            data = f.read(min(read_size, 0x10000))
+                            if len(data) == 0:
+                                break
+
+                            read_size -= len(data)
+                            t.write(d.feed(data))
+                        t.write(d.flush())
                     else:
+                        data = f.read(read_size)
+
                         d = lzj(LZJ_VERSION.VERSION1)
                         t.write(d.Lzj_Expand(data))
 
@@ -1246,6 +1672,7 @@ class build_matryoshka():
 
     def expand_level1(build_info):
         td, tmp_path = tempfile.mkstemp()
+        build_meta.forget_detect(tmp_path)
 
         with os.fdopen(td, "wb") as t:
             with open(build_info["path"], "rb") as f:
@@ -1270,6 +1697,8 @@ class build_matryoshka():
 
 class romfs_cipher():
     SCRAMBLE_KEY =b'\xFE\x0F\x8A\x50\x40\x38\x8A\x7C\x14\x22\x84\x7C\xBF\x52\xA4\x50'
+    # vwr files are run through TEA this many bytes at a time. Progress is shown after each chunk.
+    CHUNK_SIZE = 0x100000
 
     def unscramble(data):
         return tea.decrypt(data, romfs_cipher.SCRAMBLE_KEY)
@@ -1277,6 +1706,36 @@ class romfs_cipher():
     def scramble(data):
         return tea.encrypt(data, romfs_cipher.SCRAMBLE_KEY)
 
+    def unscramble_blocks(data):
+        return tea.decrypt_blocks(data, romfs_cipher.SCRAMBLE_KEY)
+
+    def scramble_blocks(data):
+        return tea.encrypt_blocks(data, romfs_cipher.SCRAMBLE_KEY)
+
+    def scrambled_size(file_size):
+        # Everything but the last 8 bytes or less is scrambled, those are left as they are.
+        return max(file_size - 1, 0) & ~0x07
+
+    def open_vwr_file(path):
+        return scrambled_reader(path)
+
+    def open_image(build_info):
+        # Opens the image build_info was detected from, unscrambling it on the way if it needs it.
+        if "is_scrambled" in build_info and build_info["is_scrambled"]:
+            return romfs_cipher.open_vwr_file(build_info["path"])
+        else:
+            return open(build_info["path"], "rb")
+
+    def detect_vwr_file(build_info):
+        # Like unscramble_vwr_file but reads the vwr file in place rather than writing an unscrambled copy.
+        new_build_info = build_meta.detect(build_info["path"], romfs_cipher.open_vwr_file(build_info["path"]))
+
+        new_build_info["is_scrambled"] = True
+        new_build_info["is_level1_image"] = True
+        new_build_info["original_path"] = build_info["path"]
+
+        return new_build_info
+
     def write_vwr_file(build_info, data, silent = False):
         td, tmp_path = tempfile.mkstemp()
 
@@ -1284,12 +1743,16 @@ class romfs_cipher():
             print("\tScrambling ROMFS file...")
 
         file_size = len(data)
+        scrambled_size = romfs_cipher.scrambled_size(file_size)
+        build_meta.forget_detect(build_info["out_path"])
         with open(build_info["out_path"], "wb") as f:
             current_position = 0
-            while (file_size - current_position) > 8:
-                f.write(romfs_cipher.scramble(data[current_position:(current_position + 8)]))
+            while current_position < scrambled_size:
+                chunk_size = min(romfs_cipher.CHUNK_SIZE, scrambled_size - current_position)
 
-                current_position += 8
+                f.write(romfs_cipher.scramble_blocks(data[current_position:(current_position + chunk_size)]))
+
+                current_position += chunk_size
 
                 if not silent:
                     print("\r\t\t" + str(int((current_position / file_size) * 100)) + "%", end='', flush=True)
@@ -1303,24 +1766,35 @@ class romfs_cipher():
         if not silent:
             print("\tWrote ROMFS to '" + build_info["out_path"] + "'")
 
-    def unscramble_vwr_file(build_info, silent = False):
-        td, tmp_path = tempfile.mkstemp()
+    def unscramble_vwr_file(build_info, silent = False, out_path = None):
+        # Writes to a temp file unless out_path is given.
+        if out_path != None:
+            tmp_path = out_path
+            t = open(out_path, "wb")
+        else:
+            td, tmp_path = tempfile.mkstemp()
+            t = os.fdopen(td, "wb")
+
+        build_meta.forget_detect(tmp_path)
 
         if not silent:
             print("\tUnscrambling vwr file...")
 
-        with os.fdopen(td, "wb") as t:
+        with t:
             with open(build_info["path"], "rb") as f:
                 f.seek(0, os.SEEK_END)
                 file_size = f.tell()
+                scrambled_size = romfs_cipher.scrambled_size(file_size)
 
                 current_position = 0
-                while (file_size - current_position) > 8:
+                while current_position < scrambled_size:
+                    chunk_size = min(romfs_cipher.CHUNK_SIZE, scrambled_size - current_position)
+
                     f.seek(current_position)
 
-                    t.write(romfs_cipher.unscramble(f.read(8)))
+                    t.write(romfs_cipher.unscramble_blocks(f.read(chunk_size)))
 
-                    current_position += 8
+                    current_position += chunk_size
 
                     if not silent:
                         print("\r\t\t" + str(int((current_position / file_size) * 100)) + "%", end='', flush=True)
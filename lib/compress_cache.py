@@ -0,0 +1,113 @@
+import os
+import hashlib
+import tempfile
+from enum import Enum
+
+class compress_cache():
+    # Default size limit for a cache folder. The least recently used entries are dropped past this.
+    MAX_SIZE = 0x40000000
+    FILE_EXTENSION = ".bin"
+    # lzj checkpoints go in here so they don't count against (or push out) the compressed outputs.
+    CHECKPOINT_FOLDER = "checkpoints"
+
+    def codec_name(codec):
+        if isinstance(codec, Enum):
+            return codec.name
+        else:
+            return str(codec)
+
+    def key(blob, codec, encoder_revision):
+        # Anything that changes the compressed bytes needs to be in the key. The match finder doesn't.
+        return hashlib.sha256(blob).hexdigest() + "-" + compress_cache.codec_name(codec).lower() + "-" + "{:02x}".format(encoder_revision)
+
+    def checkpoint_dir(cache_dir):
+        if cache_dir == None:
+            return None
+        else:
+            return os.path.join(cache_dir, compress_cache.CHECKPOINT_FOLDER)
+
+    def get(cache_dir, key):
+        path = os.path.join(cache_dir, key + compress_cache.FILE_EXTENSION)
+
+        try:
+            with open(path, "rb") as f:
+                data = bytearray(f.read())
+
+            # Bump the mtime so eviction sees this as recently used.
+            os.utime(path)
+
+            return data
+        except OSError:
+            return None
+
+    def put(cache_dir, key, data, max_size = MAX_SIZE):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Write to a temp file and move it into place so a half written entry is never picked up.
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+
+                os.replace(tmp_path, os.path.join(cache_dir, key + compress_cache.FILE_EXTENSION))
+            except Exception:
+                os.remove(tmp_path)
+                raise
+
+            compress_cache.evict(cache_dir, max_size)
+        except OSError:
+            # The cache is only a shortcut, a build shouldn't fail because it can't be written.
+            pass
+
+    def remove(cache_dir, key):
+        try:
+            os.remove(os.path.join(cache_dir, key + compress_cache.FILE_EXTENSION))
+        except OSError:
+            pass
+
+    def evict(cache_dir, max_size = MAX_SIZE):
+        entries = []
+        total_size = 0
+        for name in os.listdir(cache_dir):
+            if not name.endswith(compress_cache.FILE_EXTENSION):
+                continue
+
+            try:
+                st = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+
+            entries.append((st.st_mtime, st.st_size, name))
+            total_size += st.st_size
+
+        entries.sort()
+
+        for mtime, size, name in entries:
+            if total_size <= max_size:
+                break
+
+            try:
+                os.remove(os.path.join(cache_dir, name))
+                total_size -= size
+            except OSError:
+                pass
+
+    def compress(cache_dir, blob, codec, encoder_revision, compress_function, silent = False, max_size = MAX_SIZE):
+        if cache_dir == None:
+            return compress_function(blob)
+
+        key = compress_cache.key(blob, codec, encoder_revision)
+
+        data = compress_cache.get(cache_dir, key)
+        if data != None:
+            if not silent:
+                print("\tUsing cached " + compress_cache.codec_name(codec) + " compression.")
+
+            return data
+
+        data = compress_function(blob)
+
+        compress_cache.put(cache_dir, key, data, max_size)
+
+        return data
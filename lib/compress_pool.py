@@ -0,0 +1,106 @@
+import os
+import concurrent.futures
+from lib.lzpf import *
+from lib.lzss import *
+from lib.build_meta import *
+
+class compress_pool():
+    def compress_one(codec, blob, ignore_errors = False, size_limit = -1):
+        # With a size_limit this returns None when the output would come out bigger than it.
+        try:
+            if codec == FILE_COMPRESSION.LZSS:
+                return lzss().Lzss_Compress(blob, size_limit)
+            elif codec == FILE_COMPRESSION.LZPF:
+                data = lzpf().Lzpf_Compress(blob)
+            elif codec == FILE_COMPRESSION.NONE:
+                data = bytearray(blob)
+            else:
+                raise Exception("Don't know how to compress with '" + str(codec) + "'")
+
+            if size_limit >= 0 and len(data) > size_limit:
+                return None
+
+            return data
+        except Exception:
+            if ignore_errors:
+                return None
+            else:
+                raise
+
+    def estimate_one(codec, blob, ignore_errors = False, size_limit = -1):
+        # The compressed size without building the output. Past size_limit it stops early and
+        # returns something bigger than size_limit.
+        try:
+            if codec == FILE_COMPRESSION.LZSS:
+                return lzss().Lzss_EstimateSize(blob, size_limit)
+            elif codec == FILE_COMPRESSION.LZPF:
+                return lzpf().Lzpf_EstimateSize(blob, size_limit)
+            elif codec == FILE_COMPRESSION.NONE:
+                return len(blob)
+            else:
+                raise Exception("Don't know how to compress with '" + str(codec) + "'")
+        except Exception:
+            if ignore_errors:
+                return None
+            else:
+                raise
+
+    def compress_many(blobs, codec, workers = 0, use_threads = False, ignore_errors = False, size_limits = None, executor = None):
+        return compress_pool.run_many(compress_pool.compress_one, blobs, codec, workers, use_threads, ignore_errors, size_limits, executor)
+
+    def estimate_many(blobs, codec, workers = 0, use_threads = False, ignore_errors = False, size_limits = None, executor = None):
+        return compress_pool.run_many(compress_pool.estimate_one, blobs, codec, workers, use_threads, ignore_errors, size_limits, executor)
+
+    def worker_count(workers = 0):
+        # 0 (or less) means one worker per CPU.
+        if workers <= 0:
+            return os.cpu_count() or 1
+        else:
+            return workers
+
+    def open_executor(workers = 0, use_threads = False):
+        # A pool that can be handed to every *_many call of a pack so they share the same workers instead of
+        # starting a pool each. None when there's only one worker, the *_many calls then run everything inline.
+        workers = compress_pool.worker_count(workers)
+
+        if workers <= 1:
+            return None
+        elif use_threads:
+            return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        else:
+            return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    def run_many(function, blobs, codec, workers = 0, use_threads = False, ignore_errors = False, size_limits = None, executor = None):
+        # Every codec instance owns its state, so each blob gets its own instance wherever it runs.
+        # Threads are safe but the codecs are pure Python so only a process pool actually speeds things up.
+        # With an executor the work goes to it (and it's left open), otherwise a pool is started just for this call.
+        blobs = list(blobs)
+
+        if size_limits == None:
+            size_limits = [-1] * len(blobs)
+        else:
+            size_limits = list(size_limits)
+
+        workers = compress_pool.worker_count(workers)
+
+        if workers > len(blobs):
+            workers = len(blobs)
+
+        if workers <= 1:
+            return [function(codec, blob, ignore_errors, size_limit) for blob, size_limit in zip(blobs, size_limits)]
+
+        if executor != None:
+            return compress_pool.map_executor(executor, function, blobs, codec, workers, ignore_errors, size_limits)
+        else:
+            with compress_pool.open_executor(workers, use_threads) as executor:
+                return compress_pool.map_executor(executor, function, blobs, codec, workers, ignore_errors, size_limits)
+
+    def map_executor(executor, function, blobs, codec, workers, ignore_errors, size_limits):
+        return list(executor.map(
+            function,
+            [codec] * len(blobs),
+            blobs,
+            [ignore_errors] * len(blobs),
+            size_limits,
+            chunksize=max(1, len(blobs) // (workers * 4))
+        ))
@@ -1,5 +1,21 @@
+import os
+import sys
+import time
+import tracemalloc
+import struct
+import zlib
+import array
 import ctypes
+import concurrent.futures
+from multiprocessing import shared_memory
 from enum import Enum
+from lib.compress_cache import compress_cache
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows. Peak RSS is left out of the summary there.
+    resource = None
 
 # By Eric MacDonald
 
@@ -31,14 +47,75 @@ class LZJ_VERSION(int, Enum):
     def get_value(_self, name):
         return getattr(_self, name)
 
+class LZJ_MATCH_FINDER(str, Enum):
+    RADIX = "RADIX" # The original recursive radix sort, one group at a time.
+    NUMPY = "NUMPY" # Refines every group a prefix length at a time with numpy sorts. Same tables, needs numpy.
+    PARALLEL = "PARALLEL" # RADIX with the word groups spread over a process pool. Same tables.
+
+    def __str__(_self):
+        return str(_self.name)
+
+    @classmethod
+    def has_name(_self, name):
+        return hasattr(_self, name.upper())
+
+    @classmethod
+    def has_value(_self, value):
+        return value in _self._value2member_map_
+
+    @classmethod
+    def get_value(_self, name):
+        return getattr(_self, name)
+
+class LZJ_PHASE(str, Enum):
+    FIND_MATCHES = "FIND_MATCHES"     # Builds the match tables.
+    RANK_MATCHES = "RANK_MATCHES"     # Picks the cheapest parse, walking from the end back to the start.
+    ENCODE_MATCHES = "ENCODE_MATCHES" # Writes the picked parse out as bits.
+
+    def __str__(_self):
+        return str(_self.name)
+
+    @classmethod
+    def has_name(_self, name):
+        return hasattr(_self, name.upper())
+
+    @classmethod
+    def has_value(_self, value):
+        return value in _self._value2member_map_
+
+    @classmethod
+    def get_value(_self, name):
+        return getattr(_self, name)
+
 class lzj():
-    def __init__(self, version: LZJ_VERSION = LZJ_VERSION.VERSION0):
+    # Bump whenever a change to the encoder changes its output, this keys the compression cache.
+    ENCODER_REVISION = 0x01
+    CHECKPOINT_MAGIC = b'LZJK'
+    CHECKPOINT_FORMAT = 0x01
+    # Decode tables only depend on the version and block size so they're built once per process and shared.
+    PREFIX_TABLES = {}
+
+    def __init__(self, version: LZJ_VERSION = LZJ_VERSION.VERSION0, match_finder: LZJ_MATCH_FINDER = LZJ_MATCH_FINDER.RADIX, match_finder_workers = 0, progress_callback = None, track_memory = False, checkpoint_dir = None):
+        self.match_finder = match_finder
+        # Only used by LZJ_MATCH_FINDER.PARALLEL. 0 uses every CPU.
+        self.match_finder_workers = match_finder_workers
+        # Called as progress_callback(phase, positions_done, total) at the start and end of each LZJ_PHASE and every PROGRESS_INTERVAL positions in between.
+        self.progress_callback = progress_callback
+        # Exact peak memory per phase needs tracemalloc which slows everything down a lot, so it's opt-in.
+        # Without it the summary only has the process's peak RSS so far.
+        self.track_memory = track_memory
+        # The match tables and the ranked parse are saved here as they're done so a later run on the same data can pick up from there.
+        self.checkpoint_dir = checkpoint_dir
         self.clear(version)
 
     def clear(self, version: LZJ_VERSION = LZJ_VERSION.VERSION0):
         self.BLOCK_SIZE = 0x100
         self.MAX_LENGTH = self.BLOCK_SIZE + 0x08
+        self.MATCH_LENGTH_CHUNK_SIZE = 0x10000
+        # Below this starting up a process pool costs more than it saves.
+        self.PARALLEL_MIN_SIZE = 0x40000
         self.WEIGHT_PROFILE_SIZE = 0x200
+        self.PROGRESS_INTERVAL = 0x10000
 
         self.version = version
 
@@ -55,13 +132,24 @@ class lzj():
         self.flag_bit_index = 0
 
         self.next_block_position = -1
+        self.summary = None
+        self.phase_start_time = 0
+        self.checkpoint_key = None
+        self.prefix_tables = None
+        self.expand_stopped = False
 
         self.match_block_index_length = 0
         self.match_block_position = 0
         self.match_offset_diff = 0
 
-        self.CloseMatchesNOffsetDiffs = []
-        self.DistantMatchesNLengths = []
+        # One fixed width column per match level. FindMatches fills these in and RankMatches reuses
+        # CloseMatchesNOffsetDiffs for the chosen offsets and Level2Matches for the chosen lengths (MatchLengths).
+        self.CloseMatchesNOffsetDiffs = array.array("I")
+        self.Level2Matches = array.array("H")
+        self.Level3Matches = array.array("I")
+        self.Level4Matches = array.array("I")
+        self.Level5Matches = array.array("I")
+        self.MatchLengths = array.array("H")
 
         if self.version == LZJ_VERSION.VERSION0:
             # Used to find and extract matches
@@ -343,11 +431,18 @@ class lzj():
                     if matchDiff < self.OffsetChecks[1][0]:
                         self.CloseMatchesNOffsetDiffs[curUncompressedIndex] = matchDiff + self.OffsetChecks[1][3]
                     elif matchDiff < self.OffsetChecks[2][0]:
-                        self.DistantMatchesNLengths[curUncompressedIndex] = matchDiff + self.OffsetChecks[2][3]
+                        self.Level2Matches[curUncompressedIndex] = matchDiff + self.OffsetChecks[2][3]
+                        self.Level3Matches[curUncompressedIndex] = 0
+                        self.Level4Matches[curUncompressedIndex] = 0
+                        self.Level5Matches[curUncompressedIndex] = 0
                     elif matchDiff < self.OffsetChecks[3][0]: 
-                        self.DistantMatchesNLengths[curUncompressedIndex] = (self.DistantMatchesNLengths[curUncompressedIndex] & 0x7fff) | ((matchDiff + self.OffsetChecks[3][3]) << 0x0f)
+                        self.Level3Matches[curUncompressedIndex] = matchDiff + self.OffsetChecks[3][3]
+                        self.Level4Matches[curUncompressedIndex] = 0
+                        self.Level5Matches[curUncompressedIndex] = 0
                     elif matchDiff < self.OffsetChecks[4][0]:
-                        self.DistantMatchesNLengths[curUncompressedIndex] = (self.DistantMatchesNLengths[curUncompressedIndex] & 0xffffffffffffffff) | ((matchDiff + self.OffsetChecks[4][3]) << 0x47)
+                        # These used to be packed into one int that was masked to 64 bits here, cutting off the top of the level 4 offset.
+                        self.Level4Matches[curUncompressedIndex] &= 0x1fffff
+                        self.Level5Matches[curUncompressedIndex] = matchDiff + self.OffsetChecks[4][3]
                 else:
                     if byteNMatchesIndexStart < (checkMatchIndex - 2):
                         self.Find5PlusByteMatches((currentFindLength + 1), byteNMatchesIndexStart, (checkMatchIndex - 1), byteNM1MatchesIndexStart, not flipped, WordMatches, ByteMatches, byteNMatches)
@@ -412,11 +507,11 @@ class lzj():
                     if matchDiff < self.OffsetChecks[1][0]:
                         self.CloseMatchesNOffsetDiffs[curUncompressedIndex] = matchDiff + self.OffsetChecks[1][3]
                     elif matchDiff < self.OffsetChecks[2][0]:
-                        self.DistantMatchesNLengths[curUncompressedIndex] = matchDiff + self.OffsetChecks[2][3]
+                        self.Level2Matches[curUncompressedIndex] = matchDiff + self.OffsetChecks[2][3]
                     elif matchDiff < self.OffsetChecks[3][0]:
-                        self.DistantMatchesNLengths[curUncompressedIndex] |= (matchDiff + self.OffsetChecks[3][3]) << 0x0f
+                        self.Level3Matches[curUncompressedIndex] = matchDiff + self.OffsetChecks[3][3]
                     elif matchDiff < self.OffsetChecks[4][0]:
-                        self.DistantMatchesNLengths[curUncompressedIndex] = (self.DistantMatchesNLengths[curUncompressedIndex] & 0xfffffffff) | ((matchDiff + self.OffsetChecks[4][3]) << 0x2B)
+                        self.Level4Matches[curUncompressedIndex] = matchDiff + self.OffsetChecks[4][3]
                 else:
                     if byte4MatchesIndexStart < (checkMatchIndex - 2):
                         self.Find5PlusByteMatches(5, byte4MatchesIndexStart, (checkMatchIndex - 1), byte3MatchesIndexStart, False, WordMatches, ByteMatches, byteNMatches)
@@ -450,7 +545,7 @@ class lzj():
 
                 byte3Matches[byte] -= 1
                 ByteMatches[byte3Matches[byte]] = uncompressed_index
-                self.DistantMatchesNLengths[uncompressed_index] = 0
+                self.Level2Matches[uncompressed_index] = 0
 
                 wordMatchesIndex -= 1
             
@@ -469,7 +564,7 @@ class lzj():
                     if matchDiff < self.OffsetChecks[1][0]:
                         self.CloseMatchesNOffsetDiffs[curUncompressedIndex] = matchDiff + self.OffsetChecks[1][3]
                     elif matchDiff < self.OffsetChecks[2][0]:
-                        self.DistantMatchesNLengths[curUncompressedIndex] = matchDiff + self.OffsetChecks[2][3]
+                        self.Level2Matches[curUncompressedIndex] = matchDiff + self.OffsetChecks[2][3]
                 else:
                     self.Find4ByteMatches(byte3MatchesIndexStart, (checkMatchIndex - 1), wordMatchesIndexStart, WordMatches, ByteMatches)
 
@@ -480,10 +575,12 @@ class lzj():
 
             self.Find4ByteMatches(byte3MatchesIndexStart, byte3MatchesIndexEnd, wordMatchesIndexStart, WordMatches, ByteMatches)
         else:
-            self.DistantMatchesNLengths[WordMatches[wordMatchesIndexStart]] = 0
+            self.Level2Matches[WordMatches[wordMatchesIndexStart]] = 0
 
-    def FindMatches(self):
-        WordMatches = [0x00000000] * (self.uncompressed_length)
+    def SortWordMatches(self):
+        # Counting sort of every position by the 2 bytes (word) there. Positions sharing a word end up next to each
+        # other in ascending order and WordCount ends up with where each word's group starts in WordMatches.
+        WordMatches = array.array("I", [0x00000000]) * (self.uncompressed_length)
         WordCount = [0x00000000] * 0x10000
 
         uncompressed_index = 0
@@ -500,8 +597,6 @@ class lzj():
             totalCount += WordCount[word]
             WordCount[word] = totalCount
 
-        ByteMatches = [0x00000000] * ((highCount + 1))
-
         uncompressed_index = (self.uncompressed_length - 1)
         while uncompressed_index > 0:
             uncompressed_index -= 1
@@ -509,6 +604,11 @@ class lzj():
             WordCount[word] -= 1
             WordMatches[WordCount[word]] = uncompressed_index
 
+        return WordMatches, WordCount, highCount
+
+    def FindMatches(self):
+        WordMatches, WordCount, highCount = self.SortWordMatches()
+        ByteMatches = array.array("I", [0x00000000]) * ((highCount + 1))
 
         self.CloseMatchesNOffsetDiffs[WordMatches[0]] = 0
 
@@ -516,7 +616,11 @@ class lzj():
         wordMatchesEnd = (len(WordMatches) - 1)
         prevUncompressedIndex = WordMatches[0]
         prevWord = int.from_bytes(self.uncompressed_data[prevUncompressedIndex:prevUncompressedIndex+2], signed=False, byteorder='little')
+        progress_interval = self.PROGRESS_INTERVAL
         for checkMatchIndex in range(1, wordMatchesEnd):
+            if (checkMatchIndex % progress_interval) == 0:
+                self.report_progress(LZJ_PHASE.FIND_MATCHES, checkMatchIndex, self.uncompressed_length)
+
             curUncompressedIndex = WordMatches[checkMatchIndex]
             curWord = int.from_bytes(self.uncompressed_data[curUncompressedIndex:curUncompressedIndex+2], signed=False, byteorder='little')
 
@@ -539,6 +643,221 @@ class lzj():
 
         self.Find3ByteMatches(wordMatchesIndexStart, (wordMatchesEnd - 1), WordMatches, ByteMatches)
     
+    def FindWordGroupMatches(self, wordMatchesIndexStart, wordMatchesIndexEnd, WordMatches, ByteMatches):
+        # What FindMatches does for one word group. Only the group's own positions (and its own part of WordMatches)
+        # are touched so groups can be done in any order or at the same time.
+        prevUncompressedIndex = WordMatches[wordMatchesIndexStart]
+        self.CloseMatchesNOffsetDiffs[prevUncompressedIndex] = 0
+
+        for checkMatchIndex in range(wordMatchesIndexStart + 1, wordMatchesIndexEnd + 1):
+            curUncompressedIndex = WordMatches[checkMatchIndex]
+            matchDiff = (curUncompressedIndex - prevUncompressedIndex) & 0xffffffff
+
+            if matchDiff < self.OffsetChecks[1][0]:
+                self.CloseMatchesNOffsetDiffs[curUncompressedIndex] = matchDiff + self.OffsetChecks[1][4]
+            else:
+                self.CloseMatchesNOffsetDiffs[curUncompressedIndex] = 0
+
+            prevUncompressedIndex = curUncompressedIndex
+
+        self.Find3ByteMatches(wordMatchesIndexStart, wordMatchesIndexEnd, WordMatches, ByteMatches)
+
+    def FindMatchesParallel(self):
+        # Same tables as FindMatches with the word groups spread over a process pool. The input, WordMatches and
+        # the columns live in shared memory and every worker only writes to its own groups' positions.
+        workers = self.match_finder_workers
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+
+        if workers <= 1 or self.uncompressed_length < self.PARALLEL_MIN_SIZE:
+            return self.FindMatches()
+
+        WordMatches, WordCount, highCount = self.SortWordMatches()
+
+        # Group starts in order, then cut them into batches of about the same number of positions.
+        group_starts = sorted(set(WordCount[word] for word in range(0x10000) if WordCount[word] < (self.uncompressed_length - 1)))
+        group_starts.append(self.uncompressed_length - 1)
+
+        batch_size = max(1, (self.uncompressed_length // (workers * 8)))
+        batches = [[]]
+        batch_length = 0
+        for i in range(len(group_starts) - 1):
+            batches[-1].append((group_starts[i], group_starts[i + 1] - 1))
+            batch_length += group_starts[i + 1] - group_starts[i]
+
+            if batch_length >= batch_size:
+                batches.append([])
+                batch_length = 0
+
+        if len(batches[-1]) == 0:
+            batches.pop()
+
+        shared_columns = [
+            (bytes(self.uncompressed_data), "B"),
+            (WordMatches.tobytes(), "I"),
+            (self.CloseMatchesNOffsetDiffs.tobytes(), "I"),
+            (self.Level2Matches.tobytes(), "H"),
+            (self.Level3Matches.tobytes(), "I"),
+            (self.Level4Matches.tobytes(), "I"),
+            (self.Level5Matches.tobytes(), "I"),
+        ]
+        del WordMatches
+
+        shared_blocks = []
+        try:
+            for column_data, column_type in shared_columns:
+                shared_block = shared_memory.SharedMemory(create=True, size=max(len(column_data), 1))
+                shared_block.buf[0:len(column_data)] = column_data
+                shared_blocks.append(shared_block)
+
+            shared_names = [(shared_block.name, len(column_data), column_type) for shared_block, (column_data, column_type) in zip(shared_blocks, shared_columns)]
+            del shared_columns
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(batches))) as executor:
+                positions_done = 0
+                for batch, result in zip(batches, executor.map(
+                    lzj.FindWordGroupMatchesWorker,
+                    [self.version] * len(batches),
+                    [self.uncompressed_length] * len(batches),
+                    [highCount] * len(batches),
+                    [shared_names] * len(batches),
+                    batches
+                )):
+                    positions_done += batch[-1][1] + 1 - batch[0][0]
+                    self.report_progress(LZJ_PHASE.FIND_MATCHES, positions_done, self.uncompressed_length)
+
+            self.CloseMatchesNOffsetDiffs = array.array("I", bytes(shared_blocks[2].buf[0:shared_names[2][1]]))
+            self.Level2Matches = array.array("H", bytes(shared_blocks[3].buf[0:shared_names[3][1]]))
+            self.Level3Matches = array.array("I", bytes(shared_blocks[4].buf[0:shared_names[4][1]]))
+            self.Level4Matches = array.array("I", bytes(shared_blocks[5].buf[0:shared_names[5][1]]))
+            self.Level5Matches = array.array("I", bytes(shared_blocks[6].buf[0:shared_names[6][1]]))
+        finally:
+            for shared_block in shared_blocks:
+                shared_block.close()
+                shared_block.unlink()
+
+    @staticmethod
+    def FindWordGroupMatchesWorker(version, uncompressed_length, highCount, shared_names, groups):
+        # Runs in a FindMatchesParallel worker process.
+        shared_blocks = [shared_memory.SharedMemory(name=name) for name, size, column_type in shared_names]
+        columns = [shared_block.buf[0:size].cast(column_type) for shared_block, (name, size, column_type) in zip(shared_blocks, shared_names)]
+
+        try:
+            d = lzj(version)
+            d.uncompressed_data = columns[0]
+            d.uncompressed_length = uncompressed_length
+            d.CloseMatchesNOffsetDiffs, d.Level2Matches, d.Level3Matches, d.Level4Matches, d.Level5Matches = columns[2:]
+
+            ByteMatches = array.array("I", [0x00000000]) * ((highCount + 1))
+            for wordMatchesIndexStart, wordMatchesIndexEnd in groups:
+                d.FindWordGroupMatches(wordMatchesIndexStart, wordMatchesIndexEnd, columns[1], ByteMatches)
+
+            d = None
+        finally:
+            for column in columns:
+                column.release()
+
+            for shared_block in shared_blocks:
+                shared_block.close()
+
+    def FindMatchesNumpy(self):
+        # Builds the same columns as FindMatches. FindMatches sorts each group of positions that share a
+        # prefix by the next byte and recurses, this does one prefix length at a time for every group at
+        # once. Within a group positions stay in order so the one before is always the closest match.
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("The " + str(LZJ_MATCH_FINDER.NUMPY) + " LZJ match finder needs numpy installed. Use " + str(LZJ_MATCH_FINDER.RADIX) + " or install numpy.")
+
+        uncompressed_length = self.uncompressed_length
+        data = numpy.frombuffer(bytes(self.uncompressed_data), dtype=numpy.uint8)
+
+        CloseMatches = numpy.zeros(uncompressed_length, dtype=numpy.int32)
+        Level2Matches = numpy.zeros(uncompressed_length, dtype=numpy.int32)
+        Level3Matches = numpy.zeros(uncompressed_length, dtype=numpy.int32)
+        Level4Matches = numpy.zeros(uncompressed_length, dtype=numpy.int32)
+        Level5Matches = numpy.zeros(uncompressed_length, dtype=numpy.int32)
+
+        # Every position with a full word after it, grouped by its first byte.
+        positions = numpy.arange(max(uncompressed_length - 1, 0), dtype=numpy.int32)
+        group_ids = data[positions].astype(numpy.int32)
+        parent_sizes = numpy.zeros(len(positions), dtype=numpy.int32)
+
+        match_length = 2
+        while match_length < self.MAX_LENGTH and len(positions) > 0:
+            # Positions drop out once their group can't match any further.
+            self.report_progress(LZJ_PHASE.FIND_MATCHES, uncompressed_length - len(positions), uncompressed_length)
+
+            keys = (group_ids.astype(numpy.int64) << 8) | data[positions + (match_length - 1)]
+            del group_ids
+            order = numpy.argsort(keys, kind="stable")
+            positions = positions[order]
+            keys = keys[order]
+            parent_sizes = parent_sizes[order]
+
+            group_starts = numpy.empty(len(keys), dtype=bool)
+            group_starts[0] = True
+            numpy.not_equal(keys[1:], keys[:-1], out=group_starts[1:])
+            start_indexes = numpy.flatnonzero(group_starts)
+            sizes = numpy.diff(numpy.append(start_indexes, len(keys))).astype(numpy.int32)
+            group_sizes = numpy.repeat(sizes, sizes)
+            del keys, order, start_indexes, sizes
+
+            has_match = ~group_starts
+            if match_length >= 5:
+                # Find5PlusByteMatches moves straight to the next byte when a small group all shares this one.
+                has_match &= ~((parent_sizes <= 0x64) & (group_sizes == parent_sizes))
+
+            match_indexes = numpy.flatnonzero(has_match)
+            match_positions = positions[match_indexes]
+            match_diffs = match_positions - positions[match_indexes - 1]
+
+            close = match_diffs < self.OffsetChecks[1][0]
+            if match_length == 2:
+                CloseMatches[match_positions[close]] = match_diffs[close] + self.OffsetChecks[1][4]
+            else:
+                CloseMatches[match_positions[close]] = match_diffs[close] + self.OffsetChecks[1][3]
+
+                level2 = ~close & (match_diffs < self.OffsetChecks[2][0])
+                level2_positions = match_positions[level2]
+                Level2Matches[level2_positions] = match_diffs[level2] + self.OffsetChecks[2][3]
+                Level3Matches[level2_positions] = 0
+                Level4Matches[level2_positions] = 0
+                Level5Matches[level2_positions] = 0
+
+                if match_length >= 4:
+                    level3 = (match_diffs >= self.OffsetChecks[2][0]) & (match_diffs < self.OffsetChecks[3][0])
+                    level3_positions = match_positions[level3]
+                    Level3Matches[level3_positions] = match_diffs[level3] + self.OffsetChecks[3][3]
+
+                    level4 = (match_diffs >= self.OffsetChecks[3][0]) & (match_diffs < self.OffsetChecks[4][0])
+                    level4_positions = match_positions[level4]
+
+                    if match_length == 4:
+                        Level4Matches[level4_positions] = match_diffs[level4] + self.OffsetChecks[4][3]
+                        Level5Matches[level4_positions] = 0
+                    else:
+                        Level4Matches[level3_positions] = 0
+                        Level5Matches[level3_positions] = 0
+
+                        # Find5PlusByteMatches masks the packed value to 64 bits here, which cuts off the top of the level 4 offset.
+                        Level4Matches[level4_positions] &= 0x1fffff
+                        Level5Matches[level4_positions] = match_diffs[level4] + self.OffsetChecks[4][3]
+
+            # Groups of one or two stop at Find4ByteMatches.
+            keep = group_sizes >= (3 if match_length >= 4 else 2)
+            positions = positions[keep]
+            group_ids = numpy.cumsum(group_starts, dtype=numpy.int32)[keep]
+            parent_sizes = group_sizes[keep]
+
+            match_length += 1
+
+        self.CloseMatchesNOffsetDiffs = array.array("I", CloseMatches.astype(numpy.uint32).tobytes())
+        self.Level2Matches = array.array("H", Level2Matches.astype(numpy.uint16).tobytes())
+        self.Level3Matches = array.array("I", Level3Matches.astype(numpy.uint32).tobytes())
+        self.Level4Matches = array.array("I", Level4Matches.astype(numpy.uint32).tobytes())
+        self.Level5Matches = array.array("I", Level5Matches.astype(numpy.uint32).tobytes())
+
     def FindOffsetMatchScore(self, best_match_offset_diff, match_length, copy_offset_match = False, uncompressed_index = -1):
         if copy_offset_match and len(self.BitWeights) >= 8:
             if len(self.EncoderConfig) > 1 and self.uncompressed_index > self.EncoderConfig[1][0]:
@@ -563,55 +882,140 @@ class lzj():
         if maxMatchLength > distanceToEnd:
             maxMatchLength = distanceToEnd
 
+        # Most matches are short so go byte by byte first and only compare 8 byte slices once a match gets long.
+        uncompressed_data = self.uncompressed_data
         matchLength = 0
-        while self.uncompressed_data[(currentIndex)] == self.uncompressed_data[(matchIndex)]:
-            matchIndex += 1
-            currentIndex += 1
-
-            if matchLength >= maxMatchLength:
-                return matchLength
-
+        while matchLength < 8 and matchLength < maxMatchLength and uncompressed_data[(currentIndex + matchLength)] == uncompressed_data[(matchIndex + matchLength)]:
             matchLength += 1
 
-        return matchLength
+        if matchLength == 8:
+            while (matchLength + 8) <= maxMatchLength and uncompressed_data[(currentIndex + matchLength):(currentIndex + matchLength + 8)] == uncompressed_data[(matchIndex + matchLength):(matchIndex + matchLength + 8)]:
+                matchLength += 8
 
-    def start_new_flag_byte(self):
-        self.compressed_flag_index = self.compressed_index
-        self.compressed_data[self.compressed_flag_index] = 0
-        self.compressed_index += 1
-        self.flag_bit_index = 0
-
-    def write_flag_bit(self, bit_value):
-        self.flag_bit_index += 1
+            while matchLength < maxMatchLength and uncompressed_data[(currentIndex + matchLength)] == uncompressed_data[(matchIndex + matchLength)]:
+                matchLength += 1
 
-        if self.flag_bit_index >= 8:
-            self.start_new_flag_byte()
+        return matchLength
 
-        if bit_value or bit_value == 1:
-            bef = self.compressed_data[self.compressed_flag_index]
-            self.compressed_data[self.compressed_flag_index] |= (1 << self.flag_bit_index) & 0xFF
+    def FindMatchLengthsNumpy(self, numpy, data_words, currentIndexes, matchIndexes, maxMatchLengths):
+        # data_words[i] is the 8 bytes starting at i read as a little endian number, so the first
+        # mismatching byte is the lowest set bit of the xor divided by 8.
+        matchLengths = numpy.zeros(len(currentIndexes), dtype=numpy.int64)
+        active = numpy.flatnonzero(maxMatchLengths > 0)
+
+        while len(active) > 0:
+            activeLengths = matchLengths[active]
+            difference = data_words[currentIndexes[active] + activeLengths] ^ data_words[matchIndexes[active] + activeLengths]
+            equal = (difference == 0)
+
+            mismatched = active[~equal]
+            difference = difference[~equal]
+            lowest_bit = difference & (~difference + numpy.uint64(1))
+            matchLengths[mismatched] += (numpy.log2(lowest_bit.astype(numpy.float64)).astype(numpy.int64) >> 3)
+
+            active = active[equal]
+            matchLengths[active] += 8
+            active = active[matchLengths[active] < maxMatchLengths[active]]
+
+        return numpy.minimum(matchLengths, maxMatchLengths)
+
+    def FindChunkMatchLengths(self, numpy, data_words, chunk_start, chunk_end):
+        # Match lengths for every level of every position in the chunk, worked out in bulk so RankMatches
+        # can read them instead of calling FindMatchLength up to five times per position.
+        currentIndexes = numpy.arange(chunk_start, chunk_end, dtype=numpy.int64)
+        maxMatchLengths = numpy.minimum(self.uncompressed_length - currentIndexes, self.MAX_LENGTH)
+
+        matches = numpy.frombuffer(self.CloseMatchesNOffsetDiffs, dtype=numpy.uint32)[chunk_start:chunk_end].astype(numpy.int64)
+        level_offset_diffs = [(
+            (matches & self.OffsetChecks[1][5]) != 0,
+            (matches & self.OffsetChecks[1][4]) + self.OffsetChecks[1][2]
+        )]
+
+        matches = numpy.frombuffer(self.Level2Matches, dtype=numpy.uint16)[chunk_start:chunk_end].astype(numpy.int64)
+        level_offset_diffs.append((
+            (matches & self.OffsetChecks[2][5]) != 0,
+            (matches & self.OffsetChecks[2][4]) + self.OffsetChecks[2][2]
+        ))
+
+        matches = numpy.frombuffer(self.Level3Matches, dtype=numpy.uint32)[chunk_start:chunk_end].astype(numpy.int64)
+        level_offset_diffs.append((
+            (matches & self.OffsetChecks[3][5]) != 0,
+            (matches + self.OffsetChecks[3][2]) & self.OffsetChecks[3][4]
+        ))
+
+        for level_matches in [self.Level4Matches, self.Level5Matches]:
+            matches = numpy.frombuffer(level_matches, dtype=numpy.uint32)[chunk_start:chunk_end].astype(numpy.int64)
+            level_offset_diffs.append((
+                (matches & self.OffsetChecks[4][5]) != 0,
+                (matches + self.OffsetChecks[4][2]) & self.OffsetChecks[4][4]
+            ))
+
+        chunk_lengths = []
+        for has_match, offset_diffs in level_offset_diffs:
+            lengths = numpy.zeros(chunk_end - chunk_start, dtype=numpy.int64)
+            match_indexes = numpy.flatnonzero(has_match)
+            lengths[match_indexes] = self.FindMatchLengthsNumpy(
+                numpy,
+                data_words,
+                currentIndexes[match_indexes],
+                currentIndexes[match_indexes] - offset_diffs[match_indexes],
+                maxMatchLengths[match_indexes]
+            )
+            chunk_lengths.append(lengths.tolist())
+
+        return chunk_lengths
 
     def RankMatches(self):
         WeightProfileRing    = [0x0000000000000000] * self.WEIGHT_PROFILE_SIZE
         WeightProfileRing[(self.uncompressed_length - 0) & (self.WEIGHT_PROFILE_SIZE - 1)] = self.BitWeights[0][1]
         WeightProfileRing[(self.uncompressed_length - 1) & (self.WEIGHT_PROFILE_SIZE - 1)] = self.BitWeights[0][0]
 
-        self.DistantMatchesNLengths[len(self.DistantMatchesNLengths) - 1] = 1
-        self.CloseMatchesNOffsetDiffs[len(self.CloseMatchesNOffsetDiffs) - 1] = 1
+        CloseMatches = self.CloseMatchesNOffsetDiffs
+        Level2Matches = self.Level2Matches
+        Level3Matches = self.Level3Matches
+        Level4Matches = self.Level4Matches
+        Level5Matches = self.Level5Matches
+
+        Level2Matches[len(Level2Matches) - 1] = 1
+        Level3Matches[len(Level3Matches) - 1] = 0
+        Level4Matches[len(Level4Matches) - 1] = 0
+        Level5Matches[len(Level5Matches) - 1] = 0
+        CloseMatches[len(CloseMatches) - 1] = 1
+
+        # With numpy around the match lengths are worked out a chunk at a time ahead of the walk.
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy != None:
+            data = numpy.frombuffer(bytes(self.uncompressed_data), dtype=numpy.uint8)
+            data_words = numpy.ndarray(shape=(len(data) - 7,), dtype="<u8", buffer=data, strides=(1,))
+            chunk_start = self.uncompressed_length
+            chunk_lengths = None
 
         best_match_offset_diff = 0
         uncompressed_index = (self.uncompressed_length - 1)
         prev_match_offset_diff = -1
         copy_check_max_index = uncompressed_index - self.MAX_LENGTH
+        progress_interval = self.PROGRESS_INTERVAL
         while 0 <= uncompressed_index:
+            if (uncompressed_index % progress_interval) == 0:
+                self.report_progress(LZJ_PHASE.RANK_MATCHES, self.uncompressed_length - 1 - uncompressed_index, self.uncompressed_length)
+
+            if numpy != None and uncompressed_index < chunk_start:
+                chunk_end = chunk_start
+                chunk_start = max(0, chunk_end - self.MATCH_LENGTH_CHUNK_SIZE)
+                chunk_lengths = self.FindChunkMatchLengths(numpy, data_words, chunk_start, chunk_end)
+
             # Default: Level 0 (no match, copy byte)
             best_position_weight = WeightProfileRing[(uncompressed_index + 1) & (self.WEIGHT_PROFILE_SIZE - 1)] + self.BitWeights[0][0]
             best_match_length = 0x01
 
             # Level 1 (match offset less than 0x101 away)
-            if (self.CloseMatchesNOffsetDiffs[uncompressed_index] & self.OffsetChecks[1][5]) != 0:
-                current_match_offset_diff = (self.CloseMatchesNOffsetDiffs[uncompressed_index] & self.OffsetChecks[1][4]) + self.OffsetChecks[1][2]
-                max_length = self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
+            if (CloseMatches[uncompressed_index] & self.OffsetChecks[1][5]) != 0:
+                current_match_offset_diff = (CloseMatches[uncompressed_index] & self.OffsetChecks[1][4]) + self.OffsetChecks[1][2]
+                max_length = chunk_lengths[0][uncompressed_index - chunk_start] if numpy != None else self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
                 start_length = self.MAX_LENGTH if (max_length == self.MAX_LENGTH) else 0x02
 
                 if max_length >= 0x02:
@@ -632,9 +1036,9 @@ class lzj():
 
 
             # Level 2 (match offset less than 0x1101 away)
-            if (self.DistantMatchesNLengths[uncompressed_index] & self.OffsetChecks[2][5]) != 0:
-                current_match_offset_diff = (self.DistantMatchesNLengths[uncompressed_index] & self.OffsetChecks[2][4]) + self.OffsetChecks[2][2]
-                max_length = self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
+            if (Level2Matches[uncompressed_index] & self.OffsetChecks[2][5]) != 0:
+                current_match_offset_diff = (Level2Matches[uncompressed_index] & self.OffsetChecks[2][4]) + self.OffsetChecks[2][2]
+                max_length = chunk_lengths[1][uncompressed_index - chunk_start] if numpy != None else self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
                 start_length = self.MAX_LENGTH if (max_length == self.MAX_LENGTH) else 0x03
 
                 if max_length >= 0x03:
@@ -654,9 +1058,9 @@ class lzj():
                         after_match_offset += 1
 
             # Level 3 (match offset less than 0x11101 away)
-            if ((self.DistantMatchesNLengths[uncompressed_index] >> 0x0f) & self.OffsetChecks[3][5]) != 0:
-                current_match_offset_diff = ((self.DistantMatchesNLengths[uncompressed_index] >> 0x0f) + self.OffsetChecks[3][2]) & self.OffsetChecks[3][4]
-                max_length = self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
+            if (Level3Matches[uncompressed_index] & self.OffsetChecks[3][5]) != 0:
+                current_match_offset_diff = (Level3Matches[uncompressed_index] + self.OffsetChecks[3][2]) & self.OffsetChecks[3][4]
+                max_length = chunk_lengths[2][uncompressed_index - chunk_start] if numpy != None else self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
                 start_length = self.MAX_LENGTH if (max_length == self.MAX_LENGTH) else 0x04
                 
                 if max_length >= 0x04:
@@ -676,9 +1080,9 @@ class lzj():
                         after_match_offset += 1
 
             # Level 4 (match offset less than 0x111101 away; matched in Find4ByteMatches)
-            if ((self.DistantMatchesNLengths[uncompressed_index] >> 0x2B) & self.OffsetChecks[4][5]) != 0:
-                current_match_offset_diff = ((self.DistantMatchesNLengths[uncompressed_index] >> 0x2B) + self.OffsetChecks[4][2]) & self.OffsetChecks[4][4]
-                max_length = self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
+            if (Level4Matches[uncompressed_index] & self.OffsetChecks[4][5]) != 0:
+                current_match_offset_diff = (Level4Matches[uncompressed_index] + self.OffsetChecks[4][2]) & self.OffsetChecks[4][4]
+                max_length = chunk_lengths[3][uncompressed_index - chunk_start] if numpy != None else self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
                 start_length = self.MAX_LENGTH if (max_length == self.MAX_LENGTH) else 0x04
                 
                 if max_length >= 0x04:
@@ -698,9 +1102,9 @@ class lzj():
                         after_match_offset += 1
 
             # Level 5 (match offset less than 0x111101 away; matched in Find5PlusByteMatches)
-            if ((self.DistantMatchesNLengths[uncompressed_index] >> 0x47) & self.OffsetChecks[4][5]) != 0:
-                current_match_offset_diff = ((self.DistantMatchesNLengths[uncompressed_index] >> 0x47) + self.OffsetChecks[4][2]) & self.OffsetChecks[4][4]
-                max_length = self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
+            if (Level5Matches[uncompressed_index] & self.OffsetChecks[4][5]) != 0:
+                current_match_offset_diff = (Level5Matches[uncompressed_index] + self.OffsetChecks[4][2]) & self.OffsetChecks[4][4]
+                max_length = chunk_lengths[4][uncompressed_index - chunk_start] if numpy != None else self.FindMatchLength(uncompressed_index, (uncompressed_index - current_match_offset_diff), self.MAX_LENGTH)
                 start_length = self.MAX_LENGTH if (max_length == self.MAX_LENGTH) else 0x04
                 
                 if max_length >= 0x04:
@@ -720,98 +1124,166 @@ class lzj():
                         after_match_offset += 1
 
             WeightProfileRing[uncompressed_index & (self.WEIGHT_PROFILE_SIZE - 1)] = best_position_weight
-            self.CloseMatchesNOffsetDiffs[uncompressed_index] = best_match_offset_diff
-            self.DistantMatchesNLengths[uncompressed_index] = best_match_length
+            # This position's levels have been read so its columns can hold the result.
+            CloseMatches[uncompressed_index] = best_match_offset_diff
+            Level2Matches[uncompressed_index] = best_match_length
 
             uncompressed_index -= 1
 
+        self.MatchLengths = Level2Matches
+        self.Level2Matches = array.array("H")
+        self.Level3Matches = array.array("I")
+        self.Level4Matches = array.array("I")
+        self.Level5Matches = array.array("I")
+
     def EncodeMatches(self):
-        self.compressed_data = bytearray(self.uncompressed_length)
-
-        csize = self.uncompressed_length.to_bytes(4, "little")
-        self.compressed_data[0] = csize[0]
-        self.compressed_data[1] = csize[1]
-        self.compressed_data[2] = csize[2]
-        self.compressed_data[3] = csize[3]
-        self.compressed_index += 4
-
-        self.RankMatches()
-
-        self.start_new_flag_byte()
-        self.uncompressed_index = 0
-        last_block_uncompressed_position = self.uncompressed_index
-        last_block_compressed_position = self.compressed_index
-        last_block_flag_position = self.compressed_flag_index
-        last_block_flag = self.compressed_data[self.compressed_flag_index]
-        last_block_flag_bit_index = self.flag_bit_index
+        # Flag bits go into their flag byte from bit 0 up and a flag byte takes the next spot in the output
+        # the moment its first bit is needed, so literal and length bytes end up between flag bytes.
+        # The flag byte being filled is held in flag and only written out once it's full or the encoding is done.
+        BLOCK_SIZE = self.BLOCK_SIZE
+        uncompressed_data = self.uncompressed_data
+        uncompressed_length = self.uncompressed_length
+        MatchLengths = self.MatchLengths
+        MatchOffsetDiffs = self.CloseMatchesNOffsetDiffs
+        OffsetChecks = self.OffsetChecks
+        bit_reverse = [int(format(byte, "08b")[::-1], 2) for byte in range(0x100)]
+
+        compressed_data = bytearray(uncompressed_length)
+
+        csize = uncompressed_length.to_bytes(4, "little")
+        compressed_data[0] = csize[0]
+        compressed_data[1] = csize[1]
+        compressed_data[2] = csize[2]
+        compressed_data[3] = csize[3]
+        compressed_index = self.compressed_index + 4
+
+        self.start_phase(LZJ_PHASE.ENCODE_MATCHES)
+        next_progress_index = self.PROGRESS_INTERVAL
+
+        flag_index = compressed_index
+        compressed_data[flag_index] = 0
+        compressed_index += 1
+        flag = 0
+        flag_bit_index = 0
+
+        def write_bit(bit_value):
+            nonlocal compressed_index, flag_index, flag, flag_bit_index
+
+            if flag_bit_index == 7:
+                compressed_data[flag_index] = flag
+                flag_index = compressed_index
+                compressed_data[flag_index] = 0
+                compressed_index += 1
+                flag = 0
+                flag_bit_index = 0
+            else:
+                flag_bit_index += 1
+
+            if bit_value:
+                flag |= 1 << flag_bit_index
+
+        def write_bits(value, bit_count):
+            # Writes the low bit_count bits of value, highest first, as many at a time as fit in the flag byte.
+            nonlocal compressed_index, flag_index, flag, flag_bit_index
+
+            value = ((bit_reverse[value & 0xff] << 24) | (bit_reverse[(value >> 8) & 0xff] << 16) | (bit_reverse[(value >> 16) & 0xff] << 8) | bit_reverse[(value >> 24) & 0xff]) >> (0x20 - bit_count)
+            while bit_count > 0:
+                free_bits = 7 - flag_bit_index
+                if free_bits == 0:
+                    compressed_data[flag_index] = flag
+                    flag_index = compressed_index
+                    compressed_data[flag_index] = 0
+                    compressed_index += 1
+                    flag = 0
+                    flag_bit_index = -1
+                    free_bits = 8
+
+                if free_bits > bit_count:
+                    free_bits = bit_count
+
+                flag |= (value & ((1 << free_bits) - 1)) << (flag_bit_index + 1)
+                value >>= free_bits
+                flag_bit_index += free_bits
+                bit_count -= free_bits
+
+        uncompressed_index = 0
+        last_block_uncompressed_position = uncompressed_index
+        last_block_compressed_position = compressed_index
+        last_block_flag_position = flag_index
+        last_block_flag = flag
+        last_block_flag_bit_index = flag_bit_index
         last_block_match_offset_diff = -1
         last_block_match_length = -1
         last_match_offset_diff = -1
         last_match_length = -1
-        while self.uncompressed_index < self.uncompressed_length:
-            if (self.uncompressed_index - last_block_uncompressed_position) >= self.BLOCK_SIZE:
-                if (self.compressed_index - last_block_compressed_position) > self.BLOCK_SIZE:
-                    self.compressed_index = last_block_compressed_position
-                    self.compressed_flag_index = last_block_flag_position
-                    self.compressed_data[self.compressed_flag_index] = last_block_flag
-                    self.flag_bit_index = last_block_flag_bit_index
-                    self.uncompressed_index = last_block_uncompressed_position
+        while uncompressed_index < uncompressed_length:
+            if (uncompressed_index - last_block_uncompressed_position) >= BLOCK_SIZE:
+                if (compressed_index - last_block_compressed_position) > BLOCK_SIZE:
+                    # Took more room than the block itself, store it as is instead.
+                    compressed_index = last_block_compressed_position
+                    flag_index = last_block_flag_position
+                    flag = last_block_flag
+                    flag_bit_index = last_block_flag_bit_index
+                    uncompressed_index = last_block_uncompressed_position
                     last_match_offset_diff = last_block_match_offset_diff
                     last_match_length = last_block_match_length
 
-                    self.write_flag_bit(1)
+                    write_bit(1)
 
-                    while self.uncompressed_index < (last_block_uncompressed_position + self.BLOCK_SIZE):
-                        self.compressed_data[self.compressed_index + 0] = self.uncompressed_data[self.uncompressed_index + 0]
-                        self.compressed_data[self.compressed_index + 1] = self.uncompressed_data[self.uncompressed_index + 1]
-                        self.compressed_data[self.compressed_index + 2] = self.uncompressed_data[self.uncompressed_index + 2]
-                        self.compressed_data[self.compressed_index + 3] = self.uncompressed_data[self.uncompressed_index + 3]
+                    if (compressed_index + BLOCK_SIZE) > len(compressed_data):
+                        raise Exception("LZJ output would be bigger than the input, a stored block at " + hex(uncompressed_index) + " doesn't fit in the " + hex(len(compressed_data)) + " byte output!")
 
-                        self.compressed_index += 4
-                        self.uncompressed_index += 4
+                    compressed_data[compressed_index:compressed_index + BLOCK_SIZE] = uncompressed_data[uncompressed_index:uncompressed_index + BLOCK_SIZE]
+                    compressed_index += BLOCK_SIZE
+                    uncompressed_index += BLOCK_SIZE
 
-                last_block_uncompressed_position = self.uncompressed_index
-                last_block_compressed_position = self.compressed_index
-                last_block_flag_position = self.compressed_flag_index
-                last_block_flag = self.compressed_data[self.compressed_flag_index]
-                last_block_flag_bit_index = self.flag_bit_index
+                last_block_uncompressed_position = uncompressed_index
+                last_block_compressed_position = compressed_index
+                last_block_flag_position = flag_index
+                last_block_flag = flag
+                last_block_flag_bit_index = flag_bit_index
                 last_block_match_offset_diff = last_match_offset_diff
                 last_block_match_length = last_match_length
 
-                self.write_flag_bit(0)
+                if uncompressed_index >= next_progress_index:
+                    self.report_progress(LZJ_PHASE.ENCODE_MATCHES, uncompressed_index, uncompressed_length)
+                    next_progress_index += self.PROGRESS_INTERVAL
 
-            match_length = self.DistantMatchesNLengths[self.uncompressed_index]
-            match_offset_diff = self.CloseMatchesNOffsetDiffs[self.uncompressed_index]
+                write_bit(0)
+
+            match_length = MatchLengths[uncompressed_index]
+            match_offset_diff = MatchOffsetDiffs[uncompressed_index]
 
             EncoderConfig = self.EncoderConfig[0][2]
             can_copy_prev_offset = self.EncoderConfig[0][1]
-            if len(self.EncoderConfig) > 1 and self.uncompressed_index > self.EncoderConfig[1][0]:
+            if len(self.EncoderConfig) > 1 and uncompressed_index > self.EncoderConfig[1][0]:
                 EncoderConfig = self.EncoderConfig[1][2]
                 can_copy_prev_offset = self.EncoderConfig[1][1]
 
             if can_copy_prev_offset:
                 if match_offset_diff > 0 and match_offset_diff != last_match_offset_diff:
-                    copy_offset_length = self.FindMatchLength(self.uncompressed_index, (self.uncompressed_index - last_match_offset_diff), self.MAX_LENGTH)
+                    copy_offset_length = self.FindMatchLength(uncompressed_index, (uncompressed_index - last_match_offset_diff), self.MAX_LENGTH)
 
                     if copy_offset_length >= 3:
                         if copy_offset_length >= match_length:
                             match_offset_diff = last_match_offset_diff
                             match_length = copy_offset_length
                         else:
+                            self.uncompressed_index = uncompressed_index
                             current_bit_weight = self.FindOffsetMatchScore(match_offset_diff, match_length)
-                            copy_offset_bit_weight = self.FindOffsetMatchScore(match_offset_diff, copy_offset_length, True, self.uncompressed_index)
+                            copy_offset_bit_weight = self.FindOffsetMatchScore(match_offset_diff, copy_offset_length, True, uncompressed_index)
 
                             if (current_bit_weight - copy_offset_bit_weight) > ((match_length - copy_offset_length) * 8):
                                 match_offset_diff = last_match_offset_diff
                                 match_length = copy_offset_length
 
             if match_length == 1:
-                self.write_flag_bit(1)
-                self.compressed_data[self.compressed_index] = self.uncompressed_data[self.uncompressed_index]
-                self.compressed_index += 1
-                self.uncompressed_index += 1
+                write_bit(1)
+                compressed_data[compressed_index] = uncompressed_data[uncompressed_index]
+                compressed_index += 1
+                uncompressed_index += 1
             else:
-                self.write_flag_bit(0)
+                write_bit(0)
 
                 encoded_offset_bits = EncoderConfig[0][0][0]
                 cpy_prv_offset_bits = EncoderConfig[0][0][2]
@@ -821,7 +1293,7 @@ class lzj():
                     encoded_match_offset = match_offset_diff + EncoderConfig[1][0][1]
                     cpy_prv_offset_bits = EncoderConfig[1][0][2]
                 elif match_length == 3:
-                    if match_offset_diff > self.OffsetChecks[1][1] or match_offset_diff == 0x101:#(self.version == LZJ_VERSION.VERSION1 and match_offset_diff == 0x101):
+                    if match_offset_diff > OffsetChecks[1][1] or match_offset_diff == 0x101:#(self.version == LZJ_VERSION.VERSION1 and match_offset_diff == 0x101):
                         encoded_offset_bits = EncoderConfig[2][1][0]
                         encoded_match_offset = match_offset_diff + EncoderConfig[2][1][1]
                         cpy_prv_offset_bits = EncoderConfig[2][1][2]
@@ -831,179 +1303,336 @@ class lzj():
                         cpy_prv_offset_bits = EncoderConfig[1][1][2]
                 else:
                     if match_length == 4:
-                        self.write_flag_bit(0)
-                        self.write_flag_bit(1)
-                    else:
-                        self.write_flag_bit(1)
+                        write_bits(0b01, 2)
+                    elif match_length >= 9:
+                        write_bits(0b11, 2)
 
-                        if match_length >= 9:
-                            self.write_flag_bit(1)
-                            
-                            self.compressed_data[self.compressed_index] = (match_length - 0x09) & 0xFF
-                            self.compressed_index += 1
-                        else:
-                            self.write_flag_bit(0)
-                            self.write_flag_bit((((match_length - 1) & 2) != 0))
-                            self.write_flag_bit((((match_length - 1) & 1) != 0))
-
-                    if match_offset_diff >= self.OffsetChecks[1][1]:
-                        if match_offset_diff >= self.OffsetChecks[3][1]:
-                            if match_length >= 5:
-                                encoded_offset_bits = EncoderConfig[4][3][0]
-                                encoded_match_offset = match_offset_diff + EncoderConfig[4][3][1]
-                                cpy_prv_offset_bits = EncoderConfig[4][3][2]
-                            else:
-                                encoded_offset_bits = EncoderConfig[4][2][0]
-                                encoded_match_offset = match_offset_diff + EncoderConfig[4][2][1]
-                                cpy_prv_offset_bits = EncoderConfig[4][2][2]
-                        else:
-                            if match_offset_diff >= self.OffsetChecks[2][1]:
-                                if match_length >= 5:
-                                    encoded_offset_bits = EncoderConfig[3][3][0]
-                                    encoded_match_offset = match_offset_diff + EncoderConfig[3][3][1]
-                                    cpy_prv_offset_bits = EncoderConfig[3][3][2]
-                                else:
-                                    encoded_offset_bits = EncoderConfig[3][2][0]
-                                    encoded_match_offset = match_offset_diff + EncoderConfig[3][2][1]
-                                    cpy_prv_offset_bits = EncoderConfig[3][2][2]
-                            else:
-                                if match_length >= 5:
-                                    encoded_offset_bits = EncoderConfig[2][3][0]
-                                    encoded_match_offset = match_offset_diff + EncoderConfig[2][3][1]
-                                    cpy_prv_offset_bits = EncoderConfig[2][3][2]
-                                else:
-                                    encoded_offset_bits = EncoderConfig[2][2][0]
-                                    encoded_match_offset = match_offset_diff + EncoderConfig[2][2][1]
-                                    cpy_prv_offset_bits = EncoderConfig[2][2][2]
+                        compressed_data[compressed_index] = (match_length - 0x09) & 0xFF
+                        compressed_index += 1
                     else:
-                        if match_length >= 5:
-                            encoded_offset_bits = EncoderConfig[1][3][0]
-                            encoded_match_offset = match_offset_diff + EncoderConfig[1][3][1]
-                            cpy_prv_offset_bits = EncoderConfig[1][3][2]
+                        # 10 then the low 2 bits of match_length - 1
+                        write_bits(0b1000 | ((match_length - 1) & 3), 4)
+
+                    if match_offset_diff >= OffsetChecks[1][1]:
+                        if match_offset_diff >= OffsetChecks[3][1]:
+                            level = 4
+                        elif match_offset_diff >= OffsetChecks[2][1]:
+                            level = 3
                         else:
-                            encoded_offset_bits = EncoderConfig[1][2][0]
-                            encoded_match_offset = match_offset_diff + EncoderConfig[1][2][1]
-                            cpy_prv_offset_bits = EncoderConfig[1][2][2]
+                            level = 2
+                    else:
+                        level = 1
 
-                encoded_match = (encoded_match_offset << (0x20 - encoded_offset_bits)) & 0xffffffffffffffff # LZJ "64"
+                    length_class = 3 if match_length >= 5 else 2
+                    encoded_offset_bits = EncoderConfig[level][length_class][0]
+                    encoded_match_offset = match_offset_diff + EncoderConfig[level][length_class][1]
+                    cpy_prv_offset_bits = EncoderConfig[level][length_class][2]
 
                 if can_copy_prev_offset and cpy_prv_offset_bits > 0x00 and match_length >= 3 and match_offset_diff == last_match_offset_diff:
                     if match_length == 3:
-                        self.write_flag_bit(0)
-                        self.write_flag_bit(0)
-                        self.write_flag_bit(1)
-                        self.write_flag_bit(1)
+                        write_bits(0b0011, 4)
                     elif match_length == 4:
-                        self.write_flag_bit(0)
-                        self.write_flag_bit(1)
-                    elif match_length >= 5:
-                        self.write_flag_bit(1)
-                        self.write_flag_bit(1)
-
-                    while cpy_prv_offset_bits > 0:
-                        self.write_flag_bit(0)
+                        write_bits(0b01, 2)
+                    else:
+                        write_bits(0b11, 2)
 
-                        cpy_prv_offset_bits -= 1
+                    write_bits(0, cpy_prv_offset_bits)
                 else:
-                    while encoded_offset_bits > 0:
-                        self.write_flag_bit((encoded_match & 0x80000000) != 0)
-
-                        encoded_match <<= 1
-                        encoded_offset_bits -= 1
+                    write_bits(encoded_match_offset, encoded_offset_bits)
 
                 last_match_offset_diff = match_offset_diff
                 last_match_length = match_length
 
-                self.uncompressed_index += match_length
+                uncompressed_index += match_length
+
+        compressed_data[flag_index] = flag
+
+        self.compressed_index = compressed_index
+        self.compressed_flag_index = flag_index
+        self.flag = flag
+        self.flag_bit_index = flag_bit_index
+        self.uncompressed_index = uncompressed_index
+        self.compressed_data = compressed_data[0:compressed_index]
+
+        self.end_phase(LZJ_PHASE.ENCODE_MATCHES)
+
+    def report_progress(self, phase, positions_done, total):
+        if self.progress_callback != None:
+            self.progress_callback(phase, positions_done, total)
+
+    def start_phase(self, phase):
+        self.report_progress(phase, 0, self.uncompressed_length)
 
+        if self.track_memory:
+            tracemalloc.reset_peak()
 
-        self.compressed_data = self.compressed_data[0:self.compressed_index]
+        self.phase_start_time = time.perf_counter()
+
+    def end_phase(self, phase):
+        phase_summary = {
+            "seconds": time.perf_counter() - self.phase_start_time
+        }
+
+        # Neither counts the PARALLEL worker processes.
+        if resource != None:
+            phase_summary["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 0x400)
+
+        if self.track_memory:
+            phase_summary["peak_memory"] = tracemalloc.get_traced_memory()[1]
+
+        if self.summary != None:
+            self.summary["phases"][str(phase)] = phase_summary
+
+        self.report_progress(phase, self.uncompressed_length, self.uncompressed_length)
 
     def Lzj_Compress(self, uncompressed_data):
         if self.version == LZJ_VERSION.VERSIONX:
             return uncompressed_data
         else:
-            self.uncompressed_data = bytearray(uncompressed_data)
-            self.uncompressed_length = len(uncompressed_data)
+            self.summary = {
+                "version": str(self.version),
+                "match_finder": str(self.match_finder),
+                "uncompressed_size": len(uncompressed_data),
+                "compressed_size": 0,
+                "seconds": 0,
+                "phases": {}
+            }
+            start_time = time.perf_counter()
+
+            started_tracemalloc = False
+            if self.track_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracemalloc = True
+
+            try:
+                self.CompressPhases(uncompressed_data)
+            finally:
+                if started_tracemalloc:
+                    tracemalloc.stop()
+
+            self.summary["compressed_size"] = len(self.compressed_data)
+            self.summary["seconds"] = time.perf_counter() - start_time
 
-            for i in range(0x108):
-                self.uncompressed_data.append(0x00)
+            return self.compressed_data
 
-            self.CloseMatchesNOffsetDiffs = [0x0000000000000000] * (self.uncompressed_length)
-            self.DistantMatchesNLengths = [0x0000000000000000] * (self.uncompressed_length)
+    def Lzj_CompressWithSummary(self, uncompressed_data):
+        compressed_data = self.Lzj_Compress(uncompressed_data)
 
-            self.FindMatches()
-            self.EncodeMatches()
+        return compressed_data, self.summary
 
-            return self.compressed_data
+    def CompressPhases(self, uncompressed_data):
+        self.uncompressed_data = bytearray(uncompressed_data)
+        self.uncompressed_length = len(uncompressed_data)
 
-    def read_flag_bit(self):
-        prev_bit = ((self.flag & 1) == 1)
+        for i in range(0x108):
+            self.uncompressed_data.append(0x00)
 
-        self.flag >>= 1
-        self.flag_bit_index -= 1
+        self.CloseMatchesNOffsetDiffs = array.array("I", [0x00000000]) * self.uncompressed_length
+        self.Level2Matches = array.array("H", [0x0000]) * self.uncompressed_length
+        self.Level3Matches = array.array("I", [0x00000000]) * self.uncompressed_length
+        self.Level4Matches = array.array("I", [0x00000000]) * self.uncompressed_length
+        self.Level5Matches = array.array("I", [0x00000000]) * self.uncompressed_length
 
-        if self.flag_bit_index <= 0:
-            self.flag_bit_index = 8 
-            self.flag = self.compressed_data[self.compressed_index] if self.compressed_index < self.compressed_length else 0x00
-            self.compressed_index += 1
+        if self.checkpoint_dir != None:
+            self.checkpoint_key = compress_cache.key(uncompressed_data, self.version, self.ENCODER_REVISION)
 
-        return prev_bit
+        ranked_columns = self.LoadCheckpoint(LZJ_PHASE.RANK_MATCHES, "IH")
+        if ranked_columns != None:
+            self.CloseMatchesNOffsetDiffs, self.MatchLengths = ranked_columns
+            self.Level2Matches = array.array("H")
+            self.Level3Matches = array.array("I")
+            self.Level4Matches = array.array("I")
+            self.Level5Matches = array.array("I")
+            self.summary["resumed_after"] = str(LZJ_PHASE.RANK_MATCHES)
+        else:
+            match_columns = self.LoadCheckpoint(LZJ_PHASE.FIND_MATCHES, "IHIII")
+            if match_columns != None:
+                self.CloseMatchesNOffsetDiffs, self.Level2Matches, self.Level3Matches, self.Level4Matches, self.Level5Matches = match_columns
+                self.summary["resumed_after"] = str(LZJ_PHASE.FIND_MATCHES)
+            else:
+                self.start_phase(LZJ_PHASE.FIND_MATCHES)
+                if self.match_finder == LZJ_MATCH_FINDER.NUMPY:
+                    self.FindMatchesNumpy()
+                elif self.match_finder == LZJ_MATCH_FINDER.PARALLEL:
+                    self.FindMatchesParallel()
+                else:
+                    self.FindMatches()
+                self.end_phase(LZJ_PHASE.FIND_MATCHES)
 
-    def _add_byte(self, byte):
-        self.uncompressed_data[self.uncompressed_index] = byte
-        self.uncompressed_index += 1
+                self.SaveCheckpoint(LZJ_PHASE.FIND_MATCHES, [self.CloseMatchesNOffsetDiffs, self.Level2Matches, self.Level3Matches, self.Level4Matches, self.Level5Matches])
 
-    def _copy_bytes(self, size):
-        for p in range(size):
-            self._add_byte(self.compressed_data[self.compressed_index])
-            self.compressed_index += 1
+            self.start_phase(LZJ_PHASE.RANK_MATCHES)
+            self.RankMatches()
+            self.end_phase(LZJ_PHASE.RANK_MATCHES)
 
-    def DecodeLiteral(self, match_length):
-        block_index = 0
+            self.SaveCheckpoint(LZJ_PHASE.RANK_MATCHES, [self.CloseMatchesNOffsetDiffs, self.MatchLengths])
 
-        can_stop_early = (self.version == LZJ_VERSION.VERSION2 and self.match_block_index_length == 0x0c)
-        while self.match_block_index_length != 0:
-            self.read_flag_bit()
+        self.EncodeMatches()
 
-            block_index = (block_index * 2) + (self.flag & 1)
-            self.match_block_index_length -= 1
+        # Encoding is quick so there's nothing left worth keeping once it's done.
+        self.RemoveCheckpoints()
 
-            if self.match_block_index_length <= 0x08 and can_stop_early:
-                if block_index != 0:
-                    can_stop_early = False
-                else:
-                    break
+    def SaveCheckpoint(self, phase, columns):
+        # Magic, format and length then each column's type, count and items (little endian), all deflated.
+        # The tables are mostly zeros so even the fastest deflate level shrinks them a lot.
+        if self.checkpoint_key == None:
+            return
+
+        compressor = zlib.compressobj(1)
+        checkpoint_data = [compressor.compress(struct.pack("<4sBI", self.CHECKPOINT_MAGIC, self.CHECKPOINT_FORMAT, self.uncompressed_length))]
+        for column in columns:
+            if sys.byteorder != "little":
+                column = array.array(column.typecode, column)
+                column.byteswap()
+
+            checkpoint_data.append(compressor.compress(struct.pack("<cI", column.typecode.encode(), len(column))))
+            checkpoint_data.append(compressor.compress(column))
+        checkpoint_data.append(compressor.flush())
+
+        compress_cache.put(self.checkpoint_dir, self.checkpoint_key + "-" + str(phase).lower(), b''.join(checkpoint_data))
+
+    def LoadCheckpoint(self, phase, column_types):
+        if self.checkpoint_key == None:
+            return None
+
+        checkpoint_data = compress_cache.get(self.checkpoint_dir, self.checkpoint_key + "-" + str(phase).lower())
+        if checkpoint_data == None:
+            return None
+
+        # Anything off and it's thrown away so the phase just runs again.
+        try:
+            checkpoint_data = zlib.decompress(checkpoint_data)
+
+            magic, checkpoint_format, uncompressed_length = struct.unpack_from("<4sBI", checkpoint_data, 0)
+            if magic != self.CHECKPOINT_MAGIC or checkpoint_format != self.CHECKPOINT_FORMAT or uncompressed_length != self.uncompressed_length:
+                return None
+
+            offset = struct.calcsize("<4sBI")
+            columns = []
+            for column_type in column_types:
+                typecode, column_length = struct.unpack_from("<cI", checkpoint_data, offset)
+                offset += struct.calcsize("<cI")
+
+                column = array.array(column_type)
+                if typecode.decode() != column_type or column_length != self.uncompressed_length:
+                    return None
+
+                column_size = column_length * column.itemsize
+                if (offset + column_size) > len(checkpoint_data):
+                    return None
+
+                column.frombytes(checkpoint_data[offset:offset + column_size])
+                if sys.byteorder != "little":
+                    column.byteswap()
+
+                columns.append(column)
+                offset += column_size
+
+            return columns
+        except (zlib.error, struct.error, UnicodeDecodeError):
+            return None
+
+    def RemoveCheckpoints(self):
+        if self.checkpoint_key == None:
+            return
+
+        for phase in [LZJ_PHASE.FIND_MATCHES, LZJ_PHASE.RANK_MATCHES]:
+            compress_cache.remove(self.checkpoint_dir, self.checkpoint_key + "-" + str(phase).lower())
+
+    def BuildPrefixTable(self, far_offsets = True):
+        # Walks the same decision tree the bit by bit decoder used for every run of up to 8 flag bits.
+        # Entries are (match_length, block_position, index_length, bits_consumed) or None when more bits are needed.
+        # A match_length of 0 is a literal byte and -1 means a length byte follows in the compressed data.
+        # Entries from (2 << 8) on are for the offset class bits that come after that length byte.
+        if self.version == LZJ_VERSION.VERSION2:
+            match_block_adder = 0
+        else:
+            match_block_adder = self.BLOCK_SIZE
 
-        if not can_stop_early:
-            self.match_offset_diff = (self.match_block_position + block_index)
+        def offset_class(next_bit):
+            if next_bit():
+                if next_bit():
+                    if self.version != LZJ_VERSION.VERSION2 or far_offsets:
+                        if next_bit():
+                            return (match_block_adder + 0x111000 + 0x01, 0x17)
+                        else:
+                            return (match_block_adder + 0x01, 0x0c)
+                    else:
+                        return (match_block_adder + 0x01, 0x0c)
+                else:
+                    return (match_block_adder + 0x11000 + 0x01, 0x14)
+            else:
+                if next_bit():
+                    return (match_block_adder + 0x1000 + 0x01, 0x10)
+                else:
+                    return (0x01, 0x08)
 
-        match_index = self.uncompressed_index - self.match_offset_diff
+        def prefix(next_bit):
+            if next_bit():
+                return (0x00, 0, 0)
 
-        if self.uncompressed_length < (match_index + match_length):
-            match_length = self.uncompressed_length - match_index
-        elif match_index > self.uncompressed_index:
-            print("BORKED [" + hex(match_index) + " > " + hex(self.uncompressed_index) + "]! Returning, stopped at offset " + hex(self.compressed_index))
+            bit2 = next_bit()
+            bit3 = next_bit()
+            if bit2:
+                if bit3:
+                    return (-1, 0, 0)
 
-            return False
-        elif match_index < 0x00:
-            print("BORKED [match_index=" + hex(match_index) + " < 0x00, match_offset_diff=" + hex(self.match_offset_diff) + ", uncompressed_index=" + hex(self.uncompressed_index) + "]! Returning, stopped at offset " + hex(self.compressed_index))
+                match_length = 0x07 if next_bit() else 0x05
+                if next_bit():
+                    match_length += 0x01
 
-            return False
+                return (match_length,) + offset_class(next_bit)
+            else:
+                bit4 = next_bit()
+                if bit3:
+                    if bit4:
+                        return (0x04,) + ((match_block_adder + 0x11000 + 0x01, 0x14) if next_bit() else (match_block_adder + 0x1000 + 0x01, 0x10))
+                    else:
+                        return (0x04,) + ((match_block_adder + 0x01, 0x0c) if next_bit() else (0x01, 0x08))
+                elif bit4:
+                    if self.version == LZJ_VERSION.VERSION0:
+                        if next_bit():
+                            return (0x03, match_block_adder + 0x1000 + 0x01, 0x10)
+                        else:
+                            return (0x03,) + ((match_block_adder + 0x01, 0x0c) if next_bit() else (0x01, 0x08))
+                    else:
+                        return (0x03,) + ((match_block_adder + 0x01, 0x0c) if next_bit() else (0x01, 0x08))
+                else:
+                    return (0x02, 0x01, 0x08)
+
+        table = [None] * (2 << 8) * 2
+        for bit_count in range(0x01, 0x09):
+            for bits in range(1 << bit_count):
+                for table_offset, walk in [(0, prefix), (2 << 8, lambda next_bit: (0x00,) + offset_class(next_bit))]:
+                    consumed = [0]
+                    def next_bit():
+                        if consumed[0] >= bit_count:
+                            raise IndexError
+
+                        consumed[0] += 1
+                        return ((bits >> (consumed[0] - 1)) & 1) == 1
+
+                    try:
+                        entry = walk(next_bit)
+                    except IndexError:
+                        continue
 
-        while match_length != 0:
-            self._add_byte(self.uncompressed_data[match_index])
-            match_index += 1
+                    table[table_offset + ((1 << bit_count) | bits)] = entry + (consumed[0],)
 
-            match_length -= 1
+        return table
 
-        return True
+    def PrefixTables(self):
+        table_key = (self.version, self.BLOCK_SIZE)
+        if table_key not in lzj.PREFIX_TABLES:
+            # VERSION2 only allows the farthest offset class once the output is past it.
+            lzj.PREFIX_TABLES[table_key] = (self.BuildPrefixTable(False), self.BuildPrefixTable(True))
 
-    def Lzj_Expand(self, compressed_data):
-        self.neat = {}
+        return lzj.PREFIX_TABLES[table_key]
 
+    def Lzj_Expand(self, compressed_data, stop_after = -1):
+        # With stop_after only about that many bytes are decoded and returned. Lzj_ExpandTo can carry on from there.
         if self.version == LZJ_VERSION.VERSIONX:
-            return compressed_data
+            return compressed_data if stop_after < 0 else compressed_data[0:stop_after]
         else:
             self.compressed_data = compressed_data
             self.compressed_length = len(compressed_data)
@@ -1012,122 +1641,176 @@ class lzj():
             self.uncompressed_data = bytearray(self.uncompressed_length)
             self.compressed_index += 4
 
-            match_block_adder = self.BLOCK_SIZE
-            if self.version == LZJ_VERSION.VERSION2:
-                match_block_adder = 0
+            self.prefix_tables = self.PrefixTables()
+            self.expand_stopped = False
+
+            self.Lzj_ExpandTo(stop_after)
+
+            if stop_after < 0 or stop_after >= self.uncompressed_length:
+                return self.uncompressed_data
             else:
-                match_block_adder = self.BLOCK_SIZE
+                return self.uncompressed_data[0:stop_after]
+
+    def Lzj_ExpandTo(self, stop_after = -1):
+        # Keeps decoding what Lzj_Expand started until at least stop_after bytes are out (or all of them with -1)
+        # and returns how many bytes have been decoded so far.
+        if self.expand_stopped:
+            return self.uncompressed_index
+
+        near_table, far_table = self.prefix_tables
+        far_start = 0x111000 + 0x01
+        bit_reverse = [int(format(byte, "08b")[::-1], 2) for byte in range(0x100)]
+
+        if stop_after < 0 or stop_after > self.uncompressed_length:
+            stop_after = self.uncompressed_length
+
+        # Flag bits are kept LSB first in bits (self.flag between calls). A flag byte is only pulled in once a bit
+        # from it is needed because literal and length bytes are interleaved with them in the compressed data.
+        bits = self.flag
+        bit_count = self.flag_bit_index
+
+        compressed_data = self.compressed_data
+        uncompressed_data = self.uncompressed_data
+        uncompressed_length = self.uncompressed_length
+        uncompressed_index = self.uncompressed_index
+        compressed_length = self.compressed_length
+        compressed_index = self.compressed_index
+        next_block_position = self.next_block_position
+        match_offset_diff = self.match_offset_diff
+        can_stop_early = (self.version == LZJ_VERSION.VERSION2)
+        while stop_after > uncompressed_index:
+            if bit_count == 0:
+                bits = compressed_data[compressed_index] if compressed_index < compressed_length else 0x00
+                bit_count = 8
+                compressed_index += 1
+
+            if uncompressed_index >= next_block_position:
+                next_block_position = uncompressed_index + self.BLOCK_SIZE
+
+                bit = bits & 1
+                bits >>= 1
+                bit_count -= 1
+
+                if bit == 1:
+                    if (uncompressed_index + self.BLOCK_SIZE) > uncompressed_length or (compressed_index + self.BLOCK_SIZE) > compressed_length:
+                        raise IndexError("LZJ stored block at " + hex(uncompressed_index) + " runs past the end of the data, stopped at offset " + hex(compressed_index))
+
+                    uncompressed_data[uncompressed_index:(uncompressed_index + self.BLOCK_SIZE)] = compressed_data[compressed_index:(compressed_index + self.BLOCK_SIZE)]
+                    uncompressed_index += self.BLOCK_SIZE
+                    compressed_index += self.BLOCK_SIZE
+
+                continue
+
+            table = far_table if uncompressed_index > far_start else near_table
+            table_offset = 0
+            while True:
+                if bit_count >= 8:
+                    entry = table[table_offset + (0x100 | (bits & 0xff))]
+                else:
+                    entry = table[table_offset + ((1 << bit_count) | bits)]
+
+                if entry == None:
+                    bits |= (compressed_data[compressed_index] if compressed_index < compressed_length else 0x00) << bit_count
+                    bit_count += 8
+                    compressed_index += 1
+                    continue
+
+                match_length, match_block_position, match_block_index_length, consumed = entry
+                bits >>= consumed
+                bit_count -= consumed
+
+                if match_length == -1:
+                    match_length = compressed_data[compressed_index] + 0x09
+                    compressed_index += 1
+
+                    table_offset = (2 << 8)
+                    entry = None
+                    while entry == None:
+                        if bit_count >= 8:
+                            entry = table[table_offset + (0x100 | (bits & 0xff))]
+                        else:
+                            entry = table[table_offset + ((1 << bit_count) | bits)]
 
-            while self.uncompressed_length > self.uncompressed_index:
-                match_length = 0x00
-                self.read_flag_bit() # read bit 1
+                        if entry == None:
+                            bits |= (compressed_data[compressed_index] if compressed_index < compressed_length else 0x00) << bit_count
+                            bit_count += 8
+                            compressed_index += 1
 
-                if self.uncompressed_index >= self.next_block_position:
-                    self.next_block_position = self.uncompressed_index + self.BLOCK_SIZE
+                    _, match_block_position, match_block_index_length, consumed = entry
+                    bits >>= consumed
+                    bit_count -= consumed
 
-                    if (self.flag & 1) == 1: # check bit 1
-                        self._copy_bytes(self.BLOCK_SIZE)
+                break
 
-                elif (self.flag & 1) == 1: # check bit 1
-                    self._copy_bytes(1)
-                else:
-                    self.read_flag_bit() # read bit 2
+            if match_length == 0x00:
+                uncompressed_data[uncompressed_index] = compressed_data[compressed_index]
+                uncompressed_index += 1
+                compressed_index += 1
+                continue
+
+            # VERSION2 reuses the last offset when the top 4 bits of a 12 bit block index are zero.
+            # Only those 4 bits are read in that case so the next flag byte mustn't be pulled in early.
+            stop_early = False
+            if can_stop_early and match_block_index_length == 0x0c:
+                if bit_count < 4:
+                    bits |= (compressed_data[compressed_index] if compressed_index < compressed_length else 0x00) << bit_count
+                    bit_count += 8
+                    compressed_index += 1
+
+                stop_early = ((bits & 0x0f) == 0)
+
+            if stop_early:
+                bits >>= 4
+                bit_count -= 4
+            else:
+                while bit_count < match_block_index_length:
+                    bits |= (compressed_data[compressed_index] if compressed_index < compressed_length else 0x00) << bit_count
+                    bit_count += 8
+                    compressed_index += 1
 
-                    if self.read_flag_bit(): # read bit 3, check bit 2
-                        match_length = 0x05
+                # The block index is stored MSB first.
+                block_index = bits & ((1 << match_block_index_length) - 1)
+                block_index = (bit_reverse[block_index & 0xff] << 16) | (bit_reverse[(block_index >> 8) & 0xff] << 8) | bit_reverse[block_index >> 16]
+                block_index >>= (24 - match_block_index_length)
 
-                        if (self.flag & 1) == 1: # check bit 3
-                            match_length = compressed_data[self.compressed_index] + 0x09
-                            
-                            self.compressed_index += 1
-                        else:
-                            self.read_flag_bit() # read bit 4
-
-                            if (self.flag & 1) == 1: # check bit 4
-                                match_length = 0x07
-
-                            self.read_flag_bit() # read bit 5
-
-                            if (self.flag & 1) == 1: # check bit 5
-                                match_length += 0x01
-
-                        self.read_flag_bit() # read bit 6
-
-                        if self.read_flag_bit(): # read bit 7, check bit 6
-                            if (self.flag & 1) == 1: # check bit 7
-                                if self.version != LZJ_VERSION.VERSION2 or self.uncompressed_index > (0x111000 + 0x01):
-                                    self.read_flag_bit() # read bit 8
-
-                                    if (self.flag & 1) == 1: # check bit 8
-                                        self.match_block_position = match_block_adder + 0x111000 + 0x01
-                                        self.match_block_index_length = 0x17
-                                    else:
-                                        self.match_block_position = match_block_adder + 0x01 ## need this
-                                        self.match_block_index_length = 0x0c
-                                else:
-                                    self.match_block_position = match_block_adder + 0x01
-                                    self.match_block_index_length = 0x0c
-                            else:
-                                self.match_block_position = match_block_adder + 0x11000 + 0x01
-                                self.match_block_index_length = 0x14
-                        else:
-                            if (self.flag & 1) == 1: # check bit 7
-                                self.match_block_position = match_block_adder + 0x1000 + 0x01 ## got this
-                                self.match_block_index_length = 0x10
-                            else:
-                                self.match_block_position = 0x01
-                                self.match_block_index_length = 0x08
-                    else:
-                        if self.read_flag_bit(): # read bit 4, check bit 3
-                            match_length = 0x04
-
-                            if self.read_flag_bit(): # read bit 5, check bit 4
-                                if (self.flag & 1) == 1: # check bit 5
-                                    self.match_block_position = match_block_adder + 0x11000 + 0x01
-                                    self.match_block_index_length = 0x14
-                                else:
-                                    self.match_block_position = match_block_adder + 0x1000 + 0x01
-                                    self.match_block_index_length = 0x10
-                            else:
-                                if (self.flag & 1) == 1: # check bit 5
-                                    self.match_block_position = match_block_adder + 0x01
-                                    self.match_block_index_length = 0x0c
-                                else:
-                                    self.match_block_position = 0x01
-                                    self.match_block_index_length = 0x08
-                        else:
-                            if (self.flag & 1) == 1: # check bit 4
-                                match_length = 0x03
-
-                                self.read_flag_bit() # read bit 5
-
-                                if self.version == LZJ_VERSION.VERSION0:
-                                    if (self.flag & 1) == 1: # check bit 5
-                                        self.match_block_position = match_block_adder + 0x1000 + 0x01
-                                        self.match_block_index_length = 0x10
-                                    else:
-                                        self.read_flag_bit() # read bit 6
-
-                                        if (self.flag & 1) == 1: # check bit 6
-                                            self.match_block_position = match_block_adder + 0x01
-                                            self.match_block_index_length = 0x0c
-                                        else:
-                                            self.match_block_position = 0x01
-                                            self.match_block_index_length = 0x08
-                                else:
-                                    if (self.flag & 1) == 1: # check bit 5
-                                        self.match_block_position = match_block_adder + 0x01
-                                        self.match_block_index_length = 0x0c
-                                    else:
-                                        self.match_block_position = 0x01
-                                        self.match_block_index_length = 0x08
-                            else:
-                                match_length = 0x02
-
-                                self.match_block_position = 0x01
-                                self.match_block_index_length = 0x08
-                    
-                    if not self.DecodeLiteral(match_length):
-                        break
+                bits >>= match_block_index_length
+                bit_count -= match_block_index_length
+
+                match_offset_diff = (match_block_position + block_index)
+
+            match_index = uncompressed_index - match_offset_diff
+
+            if uncompressed_length < (match_index + match_length):
+                match_length = uncompressed_length - match_index
+            elif match_index > uncompressed_index:
+                print("BORKED [" + hex(match_index) + " > " + hex(uncompressed_index) + "]! Returning, stopped at offset " + hex(compressed_index))
+
+                self.expand_stopped = True
+                break
+            elif match_index < 0x00:
+                print("BORKED [match_index=" + hex(match_index) + " < 0x00, match_offset_diff=" + hex(match_offset_diff) + ", uncompressed_index=" + hex(uncompressed_index) + "]! Returning, stopped at offset " + hex(compressed_index))
+
+                self.expand_stopped = True
+                break
+
+            if (uncompressed_index + match_length) > uncompressed_length:
+                raise IndexError("LZJ match at " + hex(uncompressed_index) + " runs past the end of the output, stopped at offset " + hex(compressed_index))
+
+            if match_offset_diff >= match_length:
+                uncompressed_data[uncompressed_index:(uncompressed_index + match_length)] = uncompressed_data[match_index:(match_index + match_length)]
+            elif match_offset_diff > 0:
+                # Overlapping copy, repeat the pattern between the match and here.
+                pattern = uncompressed_data[match_index:uncompressed_index]
+                uncompressed_data[uncompressed_index:(uncompressed_index + match_length)] = (pattern * ((match_length // match_offset_diff) + 1))[:match_length]
+            # A zero offset copies the not yet written (zero) output onto itself so there's nothing to do.
+
+            uncompressed_index += match_length
+
+        self.uncompressed_index = uncompressed_index
+        self.compressed_index = compressed_index
+        self.next_block_position = next_block_position
+        self.match_offset_diff = match_offset_diff
+        self.flag = bits
+        self.flag_bit_index = bit_count
 
-            return self.uncompressed_data
+        return uncompressed_index
@@ -1,14 +1,16 @@
+import array
 import ctypes
 
 class lzpf():
-    context = {
-        "current_literal": 0,
-        "current_length": 0,
-        "compressed_data": None,
-        "filler_byte": 0x00,
-        "ring_buffer": [],
-        "flag_table": [],
-    }
+    # Each instance owns its bit buffer, ring buffer and flag table so separate instances can run side by side.
+    __slots__ = (
+        "current_literal",
+        "current_length",
+        "compressed_data",
+        "filler_byte",
+        "ring_buffer",
+        "flag_table",
+    )
 
     tables = {
         "bitMask": [
@@ -383,233 +385,329 @@ class lzpf():
         ]
 	}
 
+    # Flat copies of the encode tables for Lzpf_Compress. Codes are lined up at the top of 32 bits like EncodeLiteral wants them.
+    # A literal after a flag lookup missed its match gets a 0 bit in front of its normal code.
+    NOMATCH_CODES = [(code << 0x10) for code, code_length in tables["nomatchEncode"]]
+    NOMATCH_CODE_LENGTHS = [code_length for code, code_length in tables["nomatchEncode"]]
+    MISSED_MATCH_CODES = [(code << 0x0F) for code, code_length in tables["nomatchEncode"]]
+    MISSED_MATCH_CODE_LENGTHS = [(code_length + 1) for code, code_length in tables["nomatchEncode"]]
+    MATCH_CODES = [code for code, code_length in tables["matchEncode"]]
+    MATCH_CODE_LENGTHS = [code_length for code, code_length in tables["matchEncode"]]
+
     def __init__(self):
+        self.filler_byte = 0x00
         self.clear()
     
     def clear(self):
-        self.context["current_length"] = ctypes.c_int32(0)
-        self.context["current_literal"] = ctypes.c_uint32(0)
-        self.context["compressed_data"] = bytearray()
-        self.context["ring_buffer"] = bytearray(0x2000)
-        self.context["flag_table"] = [0xFFFF] * 0x1000
+        self.current_length = ctypes.c_int32(0)
+        self.current_literal = ctypes.c_uint32(0)
+        self.compressed_data = bytearray()
+        self.ring_buffer = bytearray(0x2000)
+        self.flag_table = array.array("I", [0xFFFF]) * 0x1000
 
     def EncodeLiteral(self, code_length, code):
-        self.context["current_literal"].value |= code >> (self.context["current_length"].value & 0x1F)
-        self.context["current_length"].value += code_length
+        self.current_literal.value |= code >> (self.current_length.value & 0x1F)
+        self.current_length.value += code_length
 
-        while self.context["current_length"].value > 7:
-            self.context["compressed_data"].append((self.context["current_literal"].value >> 0x18) & 0xFF)
+        while self.current_length.value > 7:
+            self.compressed_data.append((self.current_literal.value >> 0x18) & 0xFF)
 
-            self.context["current_length"].value -= 8
-            self.context["current_literal"].value <<= 8
+            self.current_length.value -= 8
+            self.current_literal.value <<= 8
 
     def Lzpf_Compress(self, uncompressed_data):
+        return self.Lzpf_Encode(uncompressed_data)
+
+    def Lzpf_EstimateSize(self, uncompressed_data, size_limit = -1):
+        # Runs the same encoder but only counts the bits it would write. Once the count goes
+        # over size_limit it stops and returns what it has so far, so anything over size_limit
+        # just means it lost.
+        return self.Lzpf_Encode(uncompressed_data, True, size_limit)
+
+    def Lzpf_Encode(self, uncompressed_data, size_only = False, size_limit = -1):
+        # Plain ints masked to the widths the c_uint32/c_uint16 math used, with the tables and state in locals.
+        nomatch_codes = self.NOMATCH_CODES
+        nomatch_code_lengths = self.NOMATCH_CODE_LENGTHS
+        missed_match_codes = self.MISSED_MATCH_CODES
+        missed_match_code_lengths = self.MISSED_MATCH_CODE_LENGTHS
+        match_codes = self.MATCH_CODES
+        match_code_lengths = self.MATCH_CODE_LENGTHS
+        ring_buffer = self.ring_buffer
+        flag_table = self.flag_table
+        compressed_data = self.compressed_data
+        current_literal = self.current_literal.value
+        current_length = self.current_length.value
+
         uncompressed_len = len(uncompressed_data)
 
+        if size_only:
+            # Bytes come out 8 bits at a time plus the last partial byte and the filler byte.
+            if size_limit >= 0:
+                size_limit_bits = (size_limit - 1) * 8
+            else:
+                # Nothing gets near 0x20 bits per input byte.
+                size_limit_bits = (uncompressed_len + 1) * 0x20
+
         i = 0
-        sum = ctypes.c_uint16(0)
-        working_data = ctypes.c_uint32(0)
+        sum = 0
+        working_data = 0
         flag = 0xFFFF
         flags_index = 0
         match_index = 0
         type_index = 0
         while i < uncompressed_len:
-            code_length = -1
-            code = -1
+            code_length = 0
 
-            byte = ctypes.c_uint32(uncompressed_data[i]).value
+            byte = uncompressed_data[i]
 
-            self.context["ring_buffer"][i & 0x1FFF] = byte
+            ring_buffer[i & 0x1FFF] = byte
 
             if match_index > 0:
-                if byte != self.context["ring_buffer"][flag] or match_index > 0x0127:
-                    code_length = self.tables["matchEncode"][match_index][1]
-                    code = self.tables["matchEncode"][match_index][0]
+                if byte != ring_buffer[flag] or match_index > 0x0127:
+                    code_length = match_code_lengths[match_index]
+                    code = match_codes[match_index]
                     match_index = 0
                     type_index = 3
                 else:
                     match_index += 1
                     flag = (flag + 1) & 0x1FFF
-                    sum.value += byte
-                    working_data.value = (working_data.value * 0x0100) + byte
+                    sum = (sum + byte) & 0xFFFF
+                    working_data = ((working_data << 8) | byte) & 0xFFFFFFFF
                     i += 1
             else:
                 flag = 0xFFFF
 
                 if i >= 3:
-                    flags_index = (working_data.value >> 0x0B ^ working_data.value) & 0x0FFF
+                    flags_index = (working_data >> 0x0B ^ working_data) & 0x0FFF
 
-                    flag = self.context["flag_table"][flags_index]
-                    self.context["flag_table"][flags_index] = i & 0x1FFF
+                    flag = flag_table[flags_index]
+                    flag_table[flags_index] = i & 0x1FFF
                 else:
                     type_index += 1
 
                 if flag == 0xFFFF:
-                    code_length = self.tables["nomatchEncode"][byte][1]
-                    code = self.tables["nomatchEncode"][byte][0] << 0x10
-                elif byte == self.context["ring_buffer"][flag]:
+                    code_length = nomatch_code_lengths[byte]
+                    code = nomatch_codes[byte]
+                elif byte == ring_buffer[flag]:
                     match_index = 1
                     flag = (flag + 1) & 0x1FFF
 
                     type_index = 4
                 else:
-                    code_length = self.tables["nomatchEncode"][byte][1] + 1
-                    code = self.tables["nomatchEncode"][byte][0] << 0x0F
+                    code_length = missed_match_code_lengths[byte]
+                    code = missed_match_codes[byte]
 
-                sum.value += byte
-                working_data.value = (working_data.value * 0x0100) + byte
+                sum = (sum + byte) & 0xFFFF
+                working_data = ((working_data << 8) | byte) & 0xFFFFFFFF
                 i += 1
 
             if code_length > 0:
-                self.EncodeLiteral(code_length, code)
+                if size_only:
+                    # current_length counts every bit rather than what's left of the last byte.
+                    current_length += code_length
+
+                    if current_length > size_limit_bits:
+                        return (current_length + 7) // 8 + 1
+                else:
+                    # Same as EncodeLiteral
+                    current_literal |= code >> current_length
+                    current_length += code_length
+
+                    while current_length > 7:
+                        compressed_data.append(current_literal >> 0x18)
+
+                        current_length -= 8
+                        current_literal = (current_literal << 8) & 0xFFFFFFFF
 
+        end_codes = []
         if type_index == 2:
-            self.EncodeLiteral(0x10, 0x00990000)
+            end_codes.append([0x10, 0x00990000])
         elif type_index >= 3:
             if type_index == 4:
-                code_length = self.tables["matchEncode"][match_index][1]
-                code = self.tables["matchEncode"][match_index][0]
-                self.EncodeLiteral(code_length, code)
+                end_codes.append([self.tables["matchEncode"][match_index][1], self.tables["matchEncode"][match_index][0]])
 
-            flags_index = (working_data.value >> 0x0B ^ working_data.value) & 0x0FFF
-            flag = self.context["flag_table"][flags_index]
+            flags_index = (working_data >> 0x0B ^ working_data) & 0x0FFF
+            flag = self.flag_table[flags_index]
             if flag == 0xFFFF:
-                self.EncodeLiteral(0x10, 0x00990000)
+                end_codes.append([0x10, 0x00990000])
             else:
-                self.EncodeLiteral(0x11, 0x004c8000)
+                end_codes.append([0x11, 0x004c8000])
 
         # Encode checksum
-        self.EncodeLiteral(0x08, (sum.value << 0x10))
-        self.EncodeLiteral(0x08, (sum.value << 0x18))
-
-        # End
-        if self.context["current_length"].value != 0:
-            self.context["compressed_data"].append(self.context["current_literal"].value >> 0x18)
-        self.context["compressed_data"].append(self.context["filler_byte"])
+        end_codes.append([0x08, (sum << 0x10)])
+        end_codes.append([0x08, (sum << 0x18)])
 
-        return self.context["compressed_data"]
+        if size_only:
+            for code_length, code in end_codes:
+                current_length += code_length
 
-    def Lzpf_Expand(self, compressed_data):
-        uncompressed_data = bytearray()
-        block = ctypes.c_uint32(0)
-        flags = 0xFFFF
-
-        compressed_len = len(compressed_data)
-
-        iii = 0
-        for i in range(compressed_len):
-            byte = ctypes.c_uint32(compressed_data[i]).value
+            return (current_length + 7) // 8 + 1
 
-            self.context["current_literal"].value = self.context["current_literal"].value | (byte << (0x18 - (self.context["current_length"].value & 0x1f)))
-            self.context["current_length"].value = self.context["current_length"].value + 8
+        self.current_literal.value = current_literal
+        self.current_length.value = current_length
 
-            while self.context["current_length"].value >= 0x13:
-                if (self.context["current_literal"].value & 0x80000000) == 0x80000000 and flags != 0xFFFF:
-                    match = self.ReadMatch()
+        for code_length, code in end_codes:
+            self.EncodeLiteral(code_length, code)
 
-                    ring_buffer_index = flags
-                    for ii in range(match):
-                        matched_byte = self.context["ring_buffer"][ring_buffer_index & 0x1FFF]
-                        
-                        uncompressed_data.append(matched_byte)
-                        self.context["ring_buffer"][iii & 0x1FFF] = matched_byte
-                        iii += 1
-
-                        block.value = (block.value << 8) | matched_byte
-                        ring_buffer_index += 1
-                else:
-                    byte = 0
-
-                    if flags == 0xFFFF:
-                        byte = self.HuffDecodeLiteralNoFlags()
-                    else:
-                        byte = self.HuffDecodeLiteral()
+        # End
+        if self.current_length.value != 0:
+            self.compressed_data.append(self.current_literal.value >> 0x18)
+        self.compressed_data.append(self.filler_byte)
 
-                    if byte != None:
-                        uncompressed_data.append(byte)
-                        self.context["ring_buffer"][iii & 0x1FFF] = byte
-                        iii += 1
+        return self.compressed_data
 
-                        block.value = (block.value << 8) | byte
-                    else:
-                        return uncompressed_data
+    # Built on first use by BuildDecodeTables.
+    @staticmethod
+    def BuildDecodeTables():
+        # Literal codes are never longer than 16 bits so the top 16 bits always decode one literal (or the end code).
+        # A literal after a flag hit has a 0 bit in front so it's looked up one bit further down and is one bit longer.
+        tables = lzpf.tables
+        literal_values = [None] * 0x10000
+        literal_widths = [0] * 0x10000
+        for prefix in range(0x10000):
+            literal = prefix << 0x10
 
-                if len(uncompressed_data) >= 3:
-                    flags_index = ((block.value >> 0x0B) ^ block.value) & 0xFFF
-                    flags = self.context["flag_table"][flags_index]
+            data_width = tables["peekTable"][literal >> 0x17]
 
-                    self.context["flag_table"][flags_index] = len(uncompressed_data)
+            if data_width == 0:
+                code = literal >> 0x16
+                data_width = 0x0A
 
-                    if len(uncompressed_data) == 3:
-                        break
-
-        return uncompressed_data
+                while code < tables["parents"][data_width]:
+                    data_width += 1
 
-    def ReadMatch(self):
-        match = 0
+                    code = literal >> (0x20 - data_width)
+            else:
+                code = (literal & tables["bitMask"][data_width]) >> (0x20 - data_width)
 
-        width_index = (self.context["current_literal"].value >> 0x19) & 0x3E
-        data_width = self.tables["matchDecode"][width_index + 1]
+            literal_widths[prefix] = data_width
 
-        if data_width == 0:
-            if (self.context["current_literal"].value & 0x3e00000) == 0x3e00000:
-                match = ((self.context["current_literal"].value >> 0x0D) & 0xFF) + 0x2A
-                data_width = 0x13
+            if code == 0x99 and data_width == 0x10:
+                literal_values[prefix] = -1
+            else:
+                lit_base = tables["lit_base"][data_width]
+                if lit_base >= 0x80:
+                    lit_base -= 0x100
+
+                # None where the old decoder ran off the end of huff_lits.
+                if (code + lit_base) < len(tables["huff_lits"]):
+                    literal_values[prefix] = tables["huff_lits"][code + lit_base]
+
+        # Match lengths are decided by the top 11 bits. -1 is the longest code where the length is in the next 8 bits.
+        match_lengths = [0] * 0x800
+        match_widths = [0] * 0x800
+        for prefix in range(0x800):
+            literal = prefix << 0x15
+
+            width_index = (literal >> 0x19) & 0x3E
+            data_width = tables["matchDecode"][width_index + 1]
+
+            if data_width == 0:
+                if (literal & 0x3e00000) == 0x3e00000:
+                    match_lengths[prefix] = -1
+                    match_widths[prefix] = 0x13
+                else:
+                    match_lengths[prefix] = ((literal & 0x3e00000) >> 0x15) + 0x0B
+                    match_widths[prefix] = 0x0B
             else:
-                match = ((self.context["current_literal"].value & 0x3e00000) >> 0x15) + 0x0B
-                data_width = 0x0B
-        else:
-            match = self.tables["matchDecode"][width_index]
+                match_lengths[prefix] = tables["matchDecode"][width_index]
+                match_widths[prefix] = data_width
 
-        self.context["current_literal"].value <<= (data_width & 0x1F)
-        self.context["current_length"].value -= data_width
+        return literal_values, literal_widths, match_lengths, match_widths
 
-        return match
+    def Lzpf_Expand(self, compressed_data):
+        # The bit buffer is a plain int and each symbol is one table lookup. The ring buffer is only the last 0x2000
+        # bytes of the output so matches copy straight out of the output and the ring buffer is caught up at the end.
+        literal_values, literal_widths, match_lengths, match_widths = lzpf.DECODE_TABLES
+        ring_buffer = self.ring_buffer
+        flag_table = self.flag_table
+        current_literal = self.current_literal.value
+        current_length = self.current_length.value
 
-    def HuffDecodeLiteralNoFlags(self):
-        code = 0
+        uncompressed_data = bytearray()
+        uncompressed_length = 0
+        flags = 0xFFFF
 
-        data_width = self.tables["peekTable"][self.context["current_literal"].value >> 0x17]
+        done = False
+        for byte in compressed_data:
+            current_literal = (current_literal | (byte << (0x18 - (current_length & 0x1f)))) & 0xFFFFFFFF
+            current_length += 8
+
+            while current_length >= 0x13:
+                if (current_literal & 0x80000000) == 0x80000000 and flags != 0xFFFF:
+                    prefix = current_literal >> 0x15
+                    match = match_lengths[prefix]
+                    data_width = match_widths[prefix]
+
+                    if match < 0:
+                        match = ((current_literal >> 0x0D) & 0xFF) + 0x2A
+
+                    current_literal = (current_literal << data_width) & 0xFFFFFFFF
+                    current_length -= data_width
+
+                    match_offset_diff = uncompressed_length - flags
+                    if match_offset_diff > 0 and match_offset_diff <= 0x2000:
+                        # Still in the ring buffer, so the same bytes are in the output.
+                        if match <= match_offset_diff:
+                            uncompressed_data += uncompressed_data[flags:flags + match]
+                        else:
+                            uncompressed_data += (uncompressed_data[flags:uncompressed_length] * ((match // match_offset_diff) + 1))[0:match]
+                    else:
+                        # Reads whatever the ring buffer would have had in that slot.
+                        for ring_buffer_index in range(flags, flags + match):
+                            ring_buffer_slot = ring_buffer_index & 0x1FFF
+                            if len(uncompressed_data) > ring_buffer_slot:
+                                uncompressed_data.append(uncompressed_data[ring_buffer_slot + ((len(uncompressed_data) - 1 - ring_buffer_slot) & ~0x1FFF)])
+                            else:
+                                uncompressed_data.append(ring_buffer[ring_buffer_slot])
+
+                    uncompressed_length += match
+                else:
+                    if flags == 0xFFFF:
+                        prefix = current_literal >> 0x10
+                        data_width = literal_widths[prefix]
+                    else:
+                        prefix = (current_literal >> 0x0F) & 0xFFFF
+                        data_width = literal_widths[prefix] + 1
 
-        if data_width == 0:
-            code = self.context["current_literal"].value >> 0x16
-            data_width = 0x0A
-            
-            while code < self.tables["parents"][data_width]:
-                data_width += 1
+                    byte = literal_values[prefix]
 
-                code = self.context["current_literal"].value >> (0x20 - (data_width & 0x1F))
-        else:
-            code = (self.context["current_literal"].value & self.tables["bitMask"][data_width]) >> (0x20 - (data_width & 0x1F))
+                    current_literal = (current_literal << data_width) & 0xFFFFFFFF
+                    current_length -= data_width
 
-        self.context["current_literal"].value <<= (data_width & 0x1F)
-        self.context["current_length"].value -= data_width
+                    if byte == None:
+                        raise Exception("Bad LZPF data, the code at output offset " + hex(uncompressed_length) + " doesn't decode to a literal!")
+                    elif byte < 0:
+                        done = True
+                        break
+
+                    uncompressed_data.append(byte)
+                    uncompressed_length += 1
 
-        if code == 0x99 and data_width == 0x10:
-            return None
-        else:
-            return self.tables["huff_lits"][(code + ctypes.c_byte(self.tables["lit_base"][data_width]).value)]
+                if uncompressed_length >= 3:
+                    block = int.from_bytes(uncompressed_data[-4:], "big")
+                    flags_index = ((block >> 0x0B) ^ block) & 0xFFF
+                    flags = flag_table[flags_index]
 
-    def HuffDecodeLiteral(self):
-        code = 0
+                    flag_table[flags_index] = uncompressed_length
 
-        data_width = self.tables["peekTable"][self.context["current_literal"].value >> 0x16]
+                    if uncompressed_length == 3:
+                        break
 
-        if data_width == 0:
-            code = self.context["current_literal"].value >> 0x15
-            data_width = 0x0A
+            if done:
+                break
 
-            while code < self.tables["parents"][data_width]:
-                data_width += 1
+        self.current_literal.value = current_literal
+        self.current_length.value = current_length
 
-                code = self.context["current_literal"].value >> (0x1F - (data_width & 0x1F))
-        else:
-            code = (self.context["current_literal"].value & self.tables["bitMask"][(data_width + 1)]) >> (0x1F - (data_width & 0x1F))
+        ring_buffer_index = max(0, uncompressed_length - 0x2000)
+        while ring_buffer_index < uncompressed_length:
+            ring_buffer_slot = ring_buffer_index & 0x1FFF
+            run_length = min(uncompressed_length - ring_buffer_index, 0x2000 - ring_buffer_slot)
+            ring_buffer[ring_buffer_slot:ring_buffer_slot + run_length] = uncompressed_data[ring_buffer_index:ring_buffer_index + run_length]
+            ring_buffer_index += run_length
 
-        self.context["current_literal"].value <<= ((data_width + 1) & 0x1F)
-        self.context["current_length"].value -= (data_width + 1)
+        return uncompressed_data
 
-        if code == 0x99 and data_width == 0x10:
-            return None
-        else:
-            return self.tables["huff_lits"][(code + ctypes.c_byte(self.tables["lit_base"][data_width]).value)]
+# Only depends on the class tables so it's built once here instead of on every Lzpf_Expand.
+lzpf.DECODE_TABLES = lzpf.BuildDecodeTables()
@@ -1,271 +1,601 @@
-import ctypes
+import array
+from enum import Enum
 
-class lzss():
-    context = {
-        "ring_buffer_size": 0x1000,
-        "root_index": 0x1000,
-        "max_match_length": 0x12,#0x11,
-        "match_threshold": 0x03,
-        "match_position": 0x00,
-        "match_length": 0x00,
-        "ring_buffer": [],
-        "parent": [],
-        "lchild": [],
-        "rchild": [],
-    }
-
-    def __init__(self):
-        self.clear()
-
-    def clear(self):
-        self.context["match_position"] = 0x00
-        self.context["match_length"] = 0x00
-        self.context["ring_buffer"] = bytearray(self.context["ring_buffer_size"] + self.context["max_match_length"])
-        self.context["parent"] = [0x00000000] * (self.context["ring_buffer_size"] + 0x01)
-        self.context["rchild"] = [0x00000000] * ((self.context["ring_buffer_size"] * 2) + 0x01) 
-        self.context["lchild"] = [0x00000000] * ((self.context["ring_buffer_size"] * 2) + 0x01)
-
-        for ii in range(self.context["ring_buffer_size"] - self.context["max_match_length"]):
-            self.context["ring_buffer"][ii] = 0x20
-
-        for ii in range(self.context["ring_buffer_size"] + 1, len(self.context["rchild"])):
-            self.context["rchild"][ii] = self.context["root_index"]
-
-        for ii in range(self.context["ring_buffer_size"] - 1):
-            self.context["parent"][ii] = self.context["root_index"]
-
-    def InsertNode(self, i):
-        keyi = self.context["ring_buffer"][i]
-        keyii = self.context["ring_buffer"][i + 1] ^ self.context["ring_buffer"][i + 2]
-        keyii = ((keyii ^ (keyii >> 4)) & 0x0F) << 8
-
-        parent_index = i
-        parent_link =  (self.context["root_index"] + 1) + keyi + keyii
-        child_index = parent_link
-        child_link = i
-
-        self.context["rchild"][i] = self.context["root_index"]
-        self.context["lchild"][i] = self.context["root_index"]
-        self.context["match_length"] = 0x00
-
-        matched_list = self.context["rchild"]
-        cmp_index = 1
-        looped = 0
-        while True:
-            looped += 1
+# The original WebTV encoder kept its matches in a binary tree but it only ever walks
+# the right side of it, so every tree is really just a chain of ring positions that
+# share the same first byte and a 4-bit hash of the next two. The match finders below
+# walk those chains in flat arrays rather than calling per-byte tree methods.
 
-            if looped >= 0xFFFF:
-                raise Exception('Runaway loop')
+class LZSS_MATCH_FINDER(str, Enum):
+    EXACT = "EXACT" # Same chains and ordering as the WebTV encoder, byte-for-byte identical output
+    FAST  = "FAST"  # Newest-first 3-byte hash chains with a bounded depth. Still valid LZSS, just not identical.
 
-            if cmp_index >= 0:
-                cmp_index = self.context["rchild"][parent_link]
-                matched_list = self.context["rchild"]
-            else:
-                cmp_index = self.context["lchild"][parent_link]
-                matched_list = self.context["lchild"]
+    def __str__(_self):
+        return str(_self.name)
 
-            if cmp_index == self.context["root_index"]:
-                parent_index = i
-                child_index = parent_link
-                child_link = i
-                break
+    @classmethod
+    def has_name(_self, name):
+        return hasattr(_self, name.upper())
 
-            parent_link = cmp_index
-            ii = 1
-            while ii < self.context["max_match_length"]:
-                if self.context["ring_buffer"][i + ii] != self.context["ring_buffer"][parent_link + ii]:
-                    break
+    @classmethod
+    def has_value(_self, value):
+        return value in _self._value2member_map_
 
-                ii += 1
+    @classmethod
+    def get_value(_self, name):
+        return getattr(_self, name)
 
-            if ii > self.context["match_length"]:
-                self.context["match_length"] = ii
-                self.context["match_position"] = parent_link
+class lzss():
+    RING_BUFFER_SIZE = 0x1000
+    ROOT_INDEX = 0x1000
+    MAX_MATCH_LENGTH = 0x12#0x11
+    MATCH_THRESHOLD = 0x03
+    # Bump whenever a change to the encoder changes its output, this keys the compression cache.
+    ENCODER_REVISION = 0x01
+
+    # Each instance owns its ring buffer and chains so separate instances can run side by side.
+    __slots__ = (
+        "match_finder",
+        "max_chain_depth",
+        "ring_buffer",
+        "next_node",
+        "prev_node",
+    )
+
+    def __init__(self, match_finder = LZSS_MATCH_FINDER.EXACT):
+        self.match_finder = match_finder
+        self.max_chain_depth = 0x40
+        self.clear()
 
-                if ii > (self.context["max_match_length"] - 1):
-                    self.context["parent"][i] = self.context["parent"][parent_link]
+    def clear(self):
+        self.ring_buffer = bytearray(b'\x20' * (self.RING_BUFFER_SIZE - self.MAX_MATCH_LENGTH)) + bytearray(self.MAX_MATCH_LENGTH * 2)
+        # 0x0000-0x0fff: ring positions, 0x1000: end of chain, 0x1001-0x2000: chain heads
+        self.next_node = array.array("H", [self.ROOT_INDEX]) * ((self.RING_BUFFER_SIZE * 2) + 0x01)
+        self.prev_node = array.array("H", [self.ROOT_INDEX]) * (self.RING_BUFFER_SIZE + 0x01)
+
+    def Lzss_Compress(self, uncompressed_data, size_limit = -1):
+        # Gives up and returns None once the output is sure to go over size_limit.
+        if self.match_finder == LZSS_MATCH_FINDER.FAST:
+            return self.Lzss_CompressFast(uncompressed_data, size_limit)
+        else:
+            return self.Lzss_CompressExact(uncompressed_data, size_limit)
+
+    def Lzss_EstimateSize(self, uncompressed_data, size_limit = -1):
+        # Runs the same encoder but only counts the bytes it would write. Once the count goes
+        # over size_limit it stops and returns what it has so far, so anything over size_limit
+        # just means it lost.
+        if self.match_finder == LZSS_MATCH_FINDER.FAST:
+            steps = self.Lzss_CompressFastSteps(True, size_limit)
+        else:
+            steps = self.Lzss_CompressExactSteps(True, size_limit)
+
+        next(steps)
+        compressed_size = steps.send(bytes(uncompressed_data))
+        if size_limit < 0 or compressed_size <= size_limit:
+            compressed_size = steps.send(None)
+
+        return compressed_size
+
+    def Lzss_CompressSteps(self):
+        if self.match_finder == LZSS_MATCH_FINDER.FAST:
+            return self.Lzss_CompressFastSteps()
+        else:
+            return self.Lzss_CompressExactSteps()
+
+    def Lzss_RunSteps(self, steps, uncompressed_data, size_limit = -1):
+        # The one-shot compressors are the streaming ones handed everything at once.
+        next(steps)
+        compressed_data = bytearray(steps.send(bytes(uncompressed_data)))
+        if size_limit < 0 or len(compressed_data) <= size_limit:
+            compressed_data += steps.send(None)
+
+        if size_limit >= 0 and len(compressed_data) > size_limit:
+            return None
 
-                    self.context["rchild"][i] = self.context["rchild"][parent_link]
-                    self.context["lchild"][i] = self.context["lchild"][parent_link]
+        return compressed_data
 
-                    self.context["parent"][self.context["rchild"][i]] = i
-                    self.context["parent"][self.context["lchild"][i]] = i
+    def Lzss_CompressExact(self, uncompressed_data, size_limit = -1):
+        return self.Lzss_RunSteps(self.Lzss_CompressExactSteps(False, size_limit), uncompressed_data, size_limit)
+
+    def Lzss_CompressFast(self, uncompressed_data, size_limit = -1):
+        return self.Lzss_RunSteps(self.Lzss_CompressFastSteps(False, size_limit), uncompressed_data, size_limit)
+
+    def Lzss_CompressExactSteps(self, size_only = False, size_limit = -1):
+        # Generator: send() it input blocks and it yields the compressed bytes that are done so far.
+        # Sending None ends the input and it yields whatever is left.
+        # With size_only it yields the compressed size so far instead of the bytes. Either way it
+        # stops early and yields what it has once the output goes over size_limit.
+        ring_buffer = self.ring_buffer
+        next_node = self.next_node
+        prev_node = self.prev_node
+        ring_size = self.RING_BUFFER_SIZE
+        ring_mask = ring_size - 1
+        root_index = self.ROOT_INDEX
+        head_index = root_index + 1
+        max_match_length = self.MAX_MATCH_LENGTH
+        match_threshold = self.MATCH_THRESHOLD
 
-                    if self.context["rchild"][self.context["parent"][parent_link]] != parent_link:
-                        matched_list = self.context["lchild"]
-                    else:
-                        matched_list = self.context["rchild"]
+        compressed_data = bytearray()
+        compressed_size = 0
+        mask = 1
+        flag_index = 0
 
-                    child_index = self.context["parent"][parent_link]
-                    child_link = i
-                    parent_index = parent_link
-                    parent_link = self.context["root_index"]
-                    break
+        uncompressed_data = b''
+        uncompressed_size = 0
+        input_done = False
 
-        self.context["parent"][parent_index] = parent_link
+        def _next_block():
+            nonlocal flag_index, compressed_size
 
-        matched_list[child_index] = child_link
+            if size_only:
+                return (yield compressed_size)
 
-    def DeleteNode(self, i):
-        if self.context["parent"][i] != self.context["root_index"]:
-            ii = 0
-            if self.context["rchild"][i] == self.context["root_index"]:
-                ii = self.context["lchild"][i]
-            elif self.context["lchild"][i] == self.context["root_index"]:
-                ii = self.context["rchild"][i]
-            else:
-                ii = self.context["lchild"][i]
+            # Anything before the flag byte that's still being filled in is final.
+            done_size = len(compressed_data) if mask == 1 else flag_index
+            done_data = bytes(compressed_data[0:done_size])
+            del compressed_data[0:done_size]
+            flag_index -= done_size
+            compressed_size += done_size
 
-                if ii != self.context["root_index"]:
-                    looped = 0
-                    while ii != self.context["root_index"]:
-                        looped += 1
-                        if looped >= 0xFFFF:
-                            raise Exception('Runaway loop')
+            return (yield done_data)
 
-                        ii = self.context["rchild"][ii]
-                    
+        i = 0
+        ring_index = 0
+        ring_footer_start = root_index - max_match_length - 1
+        footer_index = ring_footer_start
 
-                    self.context["rchild"][self.context["parent"][ii]] = self.context["lchild"][ii]
-                    self.context["parent"][self.context["lchild"][ii]] = self.context["parent"][ii]
+        length = 0
+        while length <= max_match_length:
+            if i >= uncompressed_size:
+                if input_done:
+                    break
 
-                    self.context["lchild"][ii] = self.context["lchild"][i]
-                    self.context["parent"][self.context["lchild"][i]] = ii
+                uncompressed_data = yield from _next_block()
+                if uncompressed_data == None:
+                    uncompressed_data = b''
+                    input_done = True
+                uncompressed_size = len(uncompressed_data)
+                i = 0
+                continue
 
-                self.context["rchild"][ii] = self.context["rchild"][i]
-                self.context["parent"][self.context["rchild"][i]] = ii
+            ring_buffer[ring_footer_start + length] = uncompressed_data[i]
 
-            self.context["parent"][ii] = self.context["parent"][i]
+            i += 1
+            length += 1
 
-            parent_link = self.context["parent"][i]
-            if self.context["rchild"][parent_link] != i:
-                self.context["lchild"][parent_link] = ii
+        def _insert_node(insert_index):
+            # Walk the chain oldest to newest and take the first longest match. A full
+            # length match takes over the old position's spot in the chain.
+            keyii = ring_buffer[insert_index + 1] ^ ring_buffer[insert_index + 2]
+            node_link = head_index + ring_buffer[insert_index] + (((keyii ^ (keyii >> 4)) & 0x0F) << 8)
+
+            match_length = 0
+            match_position = 0
+            match_key = b''
+            node = next_node[node_link]
+            while node != root_index:
+                # Only a longer match matters so check what's already matched in one go.
+                if ring_buffer[insert_index + match_length] == ring_buffer[node + match_length] and ring_buffer[node + 1:node + match_length] == match_key:
+                    ii = match_length if match_length > 1 else 1
+                    while ii < max_match_length and ring_buffer[insert_index + ii] == ring_buffer[node + ii]:
+                        ii += 1
+
+                    if ii > match_length:
+                        match_length = ii
+                        match_position = node
+                        match_key = ring_buffer[insert_index + 1:insert_index + ii]
+
+                        if ii == max_match_length:
+                            next_index = next_node[node]
+                            prev_index = prev_node[node]
+
+                            next_node[insert_index] = next_index
+                            prev_node[insert_index] = prev_index
+                            prev_node[next_index] = insert_index
+                            next_node[prev_index] = insert_index
+                            prev_node[node] = root_index
+
+                            return match_length, match_position
+
+                node_link = node
+                node = next_node[node]
+
+            next_node[insert_index] = root_index
+            prev_node[insert_index] = node_link
+            next_node[node_link] = insert_index
+
+            return match_length, match_position
+
+        match_length, match_position = _insert_node(ring_footer_start)
+        while length > 0:
+            if match_length > length:
+                match_length = length
+
+            if mask == 1:
+                if size_only:
+                    if size_limit >= 0 and compressed_size > size_limit:
+                        break
+
+                    compressed_size += 1
+                else:
+                    # compressed_size only counts what's already been handed back here.
+                    if size_limit >= 0 and (compressed_size + len(compressed_data)) > size_limit:
+                        break
+
+                    flag_index = len(compressed_data)
+                    compressed_data.append(0x00)
+
+            if match_length >= match_threshold:
+                if size_only:
+                    compressed_size += 2
+                else:
+                    _match_position = (footer_index - match_position - 1) & ring_mask
+
+                    compressed_data.append(_match_position & 0xFF)
+                    compressed_data.append((((_match_position >> 4) & 0xF0) | (match_length - match_threshold)) & 0xFF)
             else:
-                self.context["rchild"][parent_link] = ii
+                match_length = 1
+                if size_only:
+                    compressed_size += 1
+                else:
+                    compressed_data[flag_index] |= mask
+                    compressed_data.append(ring_buffer[footer_index])
+
+            mask = (mask << 1) & 0xFF
+            if mask == 0:
+                mask = 1
 
-            self.context["parent"][i] = self.context["root_index"]
+            last_match_length = match_length
+            ii = 0
+            while ii < last_match_length:
+                # Drop the position that's about to be overwritten from its chain
+                prev_index = prev_node[ring_index]
+                if prev_index != root_index:
+                    next_index = next_node[ring_index]
+
+                    prev_node[next_index] = prev_index
+                    next_node[prev_index] = next_index
+                    prev_node[ring_index] = root_index
+
+                while i >= uncompressed_size and not input_done:
+                    uncompressed_data = yield from _next_block()
+                    if uncompressed_data == None:
+                        uncompressed_data = b''
+                        input_done = True
+                    uncompressed_size = len(uncompressed_data)
+                    i = 0
+
+                if i < uncompressed_size:
+                    ring_buffer[ring_index] = uncompressed_data[i]
+
+                    if ring_index <= (max_match_length - 1):
+                        ring_buffer[ring_size + ring_index] = uncompressed_data[i]
 
-    def Lzss_Compress(self, uncompressed_data):
-        uncompressed_size = len(uncompressed_data)
-        i = 0
-        ring_index = 0
-        ring_footer_start = self.context["root_index"] - self.context["max_match_length"] - 1
-        footer_index = ring_footer_start
+                    i += 1
+                else:
+                    length -= 1
 
-        length = 0
-        while length <= self.context["max_match_length"] and i < uncompressed_size:
-            self.context["ring_buffer"][ring_footer_start + length] = uncompressed_data[i]
+                ring_index = (ring_index + 1) & ring_mask
+                footer_index = (footer_index + 1) & ring_mask
 
-            i += 1
-            length += 1
+                if length != 0:
+                    match_length, match_position = _insert_node(footer_index)
 
-        mask = 1
-        code_buffer = bytearray(0x14)
-        code_buffer_index = 1
+                ii += 1
+
+        if size_only:
+            yield compressed_size
+        else:
+            yield bytes(compressed_data)
+
+    def Lzss_CompressFastSteps(self, size_only = False, size_limit = -1):
+        # Same send()/yield protocol as Lzss_CompressExactSteps.
+        max_match_length = self.MAX_MATCH_LENGTH
+        match_threshold = self.MATCH_THRESHOLD
+        max_chain_depth = self.max_chain_depth
+        # Keep to the same window the ring buffer encoder can reach.
+        max_distance = self.RING_BUFFER_SIZE - max_match_length - 1
+        # Room to look ahead for a full match and hash every position it covers.
+        min_lookahead = max_match_length + match_threshold - 1
+
+        hash_size = 0x8000
+        hash_mask = hash_size - 1
+        window_mask = 0xFFFF
+        chain_head = [-1] * hash_size
+        chain_prev = [-1] * (window_mask + 1)
 
         compressed_data = bytearray()
+        compressed_size = 0
+        mask = 1
+        flag_index = 0
 
-        self.InsertNode(ring_footer_start)
-        while length > 0:
-            if self.context["match_length"] > length:
-                self.context["match_length"] = length
-            
-            if self.context["match_length"] >= self.context["match_threshold"]:
-                _match_position = footer_index - self.context["match_position"] - 1
-                if _match_position < 0:
-                    _match_position += self.context["root_index"]
-
-                code_buffer[code_buffer_index] = _match_position & 0xFF
-                code_buffer_index += 1
-
-                code_buffer[code_buffer_index] = (((_match_position >> 4) & 0xF0) | (self.context["match_length"] - self.context["match_threshold"])) & 0xFF
-                code_buffer_index += 1
+        # Positions are relative to the start of uncompressed_data, which only holds the tail of the input.
+        uncompressed_data = bytearray()
+        uncompressed_size = 0
+        input_done = False
+
+        def _insert(position):
+            key = ((uncompressed_data[position] << 10) ^ (uncompressed_data[position + 1] << 5) ^ uncompressed_data[position + 2]) & hash_mask
+            chain_prev[position & window_mask] = chain_head[key]
+            chain_head[key] = position
+
+        i = 0
+        while True:
+            while (uncompressed_size - i) < min_lookahead and not input_done:
+                if size_only:
+                    uncompressed_block = yield compressed_size
+                else:
+                    done_size = len(compressed_data) if mask == 1 else flag_index
+                    uncompressed_block = yield bytes(compressed_data[0:done_size])
+                    del compressed_data[0:done_size]
+                    flag_index -= done_size
+                    compressed_size += done_size
+
+                if uncompressed_block == None:
+                    input_done = True
+                else:
+                    # Drop input that's out of reach. Shifting by a multiple of the chain
+                    # size keeps chain_prev's slots where they are.
+                    if i > (window_mask + 1) * 2:
+                        shift = window_mask + 1
+                        del uncompressed_data[0:shift]
+                        i -= shift
+                        chain_head = [(node - shift) if node >= shift else -1 for node in chain_head]
+                        chain_prev = [(node - shift) if node >= shift else -1 for node in chain_prev]
+
+                    uncompressed_data += uncompressed_block
+                    uncompressed_size = len(uncompressed_data)
+
+            if i >= uncompressed_size:
+                break
+
+            last_hash_position = uncompressed_size - match_threshold
+
+            match_length = 0
+            match_position = 0
+
+            if i <= last_hash_position:
+                max_length = uncompressed_size - i
+                if max_length > max_match_length:
+                    max_length = max_match_length
+
+                key = ((uncompressed_data[i] << 10) ^ (uncompressed_data[i + 1] << 5) ^ uncompressed_data[i + 2]) & hash_mask
+                node = chain_head[key]
+                depth = max_chain_depth
+                while node >= 0 and (i - node) <= max_distance and depth > 0:
+                    if uncompressed_data[node + match_length] == uncompressed_data[i + match_length]:
+                        ii = 0
+                        while ii < max_length and uncompressed_data[node + ii] == uncompressed_data[i + ii]:
+                            ii += 1
+
+                        if ii > match_length:
+                            match_length = ii
+                            match_position = node
+
+                            if ii == max_length:
+                                break
+
+                    node = chain_prev[node & window_mask]
+                    depth -= 1
+
+                chain_prev[i & window_mask] = chain_head[key]
+                chain_head[key] = i
+
+            if mask == 1:
+                if size_only:
+                    if size_limit >= 0 and compressed_size > size_limit:
+                        break
+
+                    compressed_size += 1
+                else:
+                    # compressed_size only counts what's already been handed back here.
+                    if size_limit >= 0 and (compressed_size + len(compressed_data)) > size_limit:
+                        break
+
+                    flag_index = len(compressed_data)
+                    compressed_data.append(0x00)
+
+            if match_length >= match_threshold:
+                if size_only:
+                    compressed_size += 2
+                else:
+                    _match_position = i - match_position - 1
+
+                    compressed_data.append(_match_position & 0xFF)
+                    compressed_data.append((((_match_position >> 4) & 0xF0) | (match_length - match_threshold)) & 0xFF)
+
+                ii = i + 1
+                i += match_length
+                while ii < i and ii <= last_hash_position:
+                    _insert(ii)
+                    ii += 1
             else:
-                self.context["match_length"] = 1
-                code_buffer[0] = (code_buffer[0] | mask) & 0xFF
-                code_buffer[code_buffer_index] = self.context["ring_buffer"][footer_index] & 0xFF
-                code_buffer_index += 1
+                if size_only:
+                    compressed_size += 1
+                else:
+                    compressed_data[flag_index] |= mask
+                    compressed_data.append(uncompressed_data[i])
 
-            mask <<= 1
-            mask &= 0xFF
+                i += 1
 
+            mask = (mask << 1) & 0xFF
             if mask == 0:
-                for ii in range(code_buffer_index):
-                    compressed_data.append(code_buffer[ii])
-
-                code_buffer[0] = 0
                 mask = 1
-                code_buffer_index = 1
 
+        if size_only:
+            yield compressed_size
+        else:
+            yield bytes(compressed_data)
 
-            last_match_length = self.context["match_length"]
-            if last_match_length > 0:
-                ii = 0
-                while ii < last_match_length:
-                    self.DeleteNode(ring_index)
+    def Lzss_Expand(self, compressed_data, uncompressed_size = 0, flags_start = 0x0000, stop_after = -1):
+        # With a known size the output is allocated once. Otherwise it starts small and doubles as needed.
+        # stop_after stops decoding once that many bytes are out, for when only the start of the data is wanted.
+        if uncompressed_size > 0:
+            stop_size = uncompressed_size
+        else:
+            stop_size = -1
 
-                    if i < uncompressed_size:
-                        self.context["ring_buffer"][ring_index] = uncompressed_data[i]
+        if stop_after >= 0 and (stop_size < 0 or stop_after < stop_size):
+            stop_size = stop_after
 
-                        if ring_index <= (self.context["max_match_length"] - 1):
-                            self.context["ring_buffer"][self.context["ring_buffer_size"] + ring_index] = uncompressed_data[i]
-                    else:
-                        i = (uncompressed_size - 1)
-                        length -= 1
+        if stop_size >= 0:
+            uncompressed_data = bytearray(stop_size)
+        else:
+            uncompressed_data = bytearray(max(len(compressed_data) * 2, 0x100))
 
-                    ring_index = (ring_index + 1) & (self.context["ring_buffer_size"] - 1)
-                    footer_index = (footer_index + 1) & (self.context["ring_buffer_size"] - 1)
+        i, r, flags = self.Lzss_ExpandInto(compressed_data, uncompressed_data, 0, flags_start, stop_size)
 
-                    if length != 0:
-                        self.InsertNode(footer_index)
+        if stop_after >= 0 and r > stop_after:
+            r = stop_after
 
-                    i += 1
-                    ii += 1
+        return uncompressed_data[0:r]
 
-        if code_buffer_index > 1:
-            for ii in range(code_buffer_index):
-                compressed_data.append(code_buffer[ii])
-        
-        return compressed_data
-            
-    def Lzss_Expand(self, compressed_data, uncompressed_size = 0, flags_start = 0x0000):
+    def Lzss_ExpandInto(self, compressed_data, uncompressed_data, r = 0, flags = 0x0000, stop_size = -1):
+        # Decodes into uncompressed_data from r on and returns where it stopped in both buffers
+        # along with the flag bits it was in the middle of, so a later call can pick up from there.
         compressed_size = len(compressed_data)
+        match_threshold = self.MATCH_THRESHOLD
 
-        if uncompressed_size == 0:
-            uncompressed_size = compressed_size * 10
-
-        uncompressed_data = bytearray(uncompressed_size + 0x100)
-
-        flags = flags_start
         i = 0
-        r = 0
-
-        def _add_byte(byte):
-            nonlocal r
-            uncompressed_data[r] = byte
-            r += 1
-
         while i < compressed_size:
             if (flags & 0x100) == 0:
-                flags = ctypes.c_uint32(compressed_data[i]).value | 0xFF00
+                flags = compressed_data[i] | 0xFF00
                 i += 1
 
-            byte = ctypes.c_uint32(compressed_data[i]).value
+                # Eight literals in a row can go in as one slice.
+                if flags == 0xFFFF and (i + 8) <= compressed_size and (stop_size < 0 or (r + 8) <= stop_size):
+                    uncompressed_data[r:r + 8] = compressed_data[i:i + 8]
+                    r += 8
+                    i += 8
+                    flags = 0x0000
+
+                    if r == stop_size:
+                        break
+
+                    continue
+
+                if i >= compressed_size:
+                    break
+
+            byte = compressed_data[i]
             if (flags & 0x01) == 0x01:
-                _add_byte(byte)
-            else:
-                i += 1
-                next_byte = ctypes.c_uint32(compressed_data[i]).value
+                if r >= len(uncompressed_data):
+                    uncompressed_data.extend(bytes(len(uncompressed_data) or 0x100))
 
-                m = ((next_byte & 0xF0) << 4) | byte
+                uncompressed_data[r] = byte
+                r += 1
+            else:
+                if (i + 1) >= compressed_size:
+                    # Only half of this match has arrived.
+                    break
 
-                for ii in range((next_byte & 0x0F) + self.context["match_threshold"]):
-                    _add_byte(uncompressed_data[r - (m + 1)])
+                i += 1
+                next_byte = compressed_data[i]
+
+                match_distance = (((next_byte & 0xF0) << 4) | byte) + 1
+                match_length = (next_byte & 0x0F) + match_threshold
+                match_start = r - match_distance
+
+                # Slice assignment grows the buffer if a match runs past the end of it.
+                if match_start < 0:
+                    # Anything before the start of the output reads as zeros, so the match repeats
+                    # those zeros followed by everything written so far.
+                    uncompressed_data[r:r + match_length] = ((bytes(-match_start) + uncompressed_data[0:r]) * ((match_length // match_distance) + 1))[0:match_length]
+                    r += match_length
+                elif match_distance >= match_length:
+                    uncompressed_data[r:r + match_length] = uncompressed_data[match_start:match_start + match_length]
+                    r += match_length
+                else:
+                    # An overlapping match just repeats the last match_distance bytes.
+                    uncompressed_data[r:r + match_length] = (uncompressed_data[match_start:r] * ((match_length // match_distance) + 1))[0:match_length]
+                    r += match_length
 
             flags >>= 1
             i += 1
 
-            if r >= uncompressed_size:
+            if stop_size >= 0 and r >= stop_size:
                 break
 
-        return uncompressed_data[0:r]
\ No newline at end of file
+        return i, r, flags
+
+class LzssCompressor():
+    # Incremental version of lzss().Lzss_Compress, like zlib.compressobj. Joining what feed()
+    # and flush() return gives the same bytes as compressing everything in one go.
+    __slots__ = ("steps",)
+
+    def __init__(self, match_finder = LZSS_MATCH_FINDER.EXACT):
+        self.steps = lzss(match_finder).Lzss_CompressSteps()
+        next(self.steps)
+
+    def feed(self, uncompressed_data):
+        if self.steps == None:
+            raise Exception("Can't feed an LZSS compressor that's already been flushed")
+
+        if len(uncompressed_data) == 0:
+            return b''
+
+        return self.steps.send(bytes(uncompressed_data))
+
+    def flush(self):
+        if self.steps == None:
+            return b''
+
+        compressed_data = self.steps.send(None)
+        self.steps.close()
+        self.steps = None
+
+        return compressed_data
+
+class LzssDecompressor():
+    # Incremental version of lzss().Lzss_Expand. Only the last window's worth of output is kept around.
+    __slots__ = ("codec", "uncompressed_size", "unused_data", "uncompressed_data", "uncompressed_index", "output_size", "flags", "eof")
+
+    def __init__(self, uncompressed_size = 0, flags_start = 0x0000):
+        self.codec = lzss()
+        self.uncompressed_size = uncompressed_size
+        self.unused_data = b''
+        self.uncompressed_data = bytearray(self.codec.RING_BUFFER_SIZE * 2)
+        self.uncompressed_index = 0
+        # Output bytes that have been dropped from the front of uncompressed_data
+        self.output_size = 0
+        self.flags = flags_start
+        self.eof = False
+
+    def feed(self, compressed_data):
+        if self.eof:
+            self.unused_data += bytes(compressed_data)
+            return b''
+
+        compressed_data = self.unused_data + bytes(compressed_data)
+
+        stop_size = -1
+        if self.uncompressed_size > 0:
+            stop_size = self.uncompressed_size - self.output_size
+
+        start_index = self.uncompressed_index
+        i, r, self.flags = self.codec.Lzss_ExpandInto(compressed_data, self.uncompressed_data, start_index, self.flags, stop_size)
+
+        self.unused_data = compressed_data[i:]
+        uncompressed_data = bytes(self.uncompressed_data[start_index:r])
+
+        if stop_size >= 0 and r >= stop_size:
+            self.eof = True
+
+        # Matches only reach back one ring buffer so that's all that needs keeping.
+        window_size = self.codec.RING_BUFFER_SIZE
+        if r > (window_size * 4):
+            del self.uncompressed_data[0:r - window_size]
+            self.output_size += r - window_size
+            r = window_size
+
+        self.uncompressed_index = r
+
+        return uncompressed_data
+
+    def flush(self):
+        # Everything that could be decoded already came out of feed(). Anything still held back is
+        # the first half of a match whose second byte never showed up.
+        if not self.eof and len(self.unused_data) > 0:
+            raise Exception("LZSS data ended in the middle of a match (" + str(len(self.unused_data)) + " undecoded byte(s) left)!")
+
+        return b''
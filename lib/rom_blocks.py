@@ -6,6 +6,7 @@ from enum import Enum
 from lib.lzss import *
 import zlib
 from lib.build_meta import *
+from lib.compress_pool import *
 
 """
     All integers are big endian.
@@ -101,6 +102,7 @@ class BLOCK_HEADER_VERSION(int, Enum):
 
 class rom_blocks():
     def write_object_file(out_path, data, silent = False):
+        build_meta.forget_detect(out_path)
         with open(out_path, 'wb') as f:
             f.write(data)
 
@@ -242,7 +244,7 @@ class rom_blocks():
                     block_info["compressed_data"] = build_meta.readData(f, block_info["compressed_data_size"], block_info["compressed_data_offset"])
 
                     if block_info["compression_type"] == BLOCK_COMPRESSION_TYPE.LZSS:
-                        block_info["uncompressed_data"] = lzss().Lzss_Expand(block_info["compressed_data"])
+                        block_info["uncompressed_data"] = lzss().Lzss_Expand(block_info["compressed_data"], block_info["uncompressed_data_size"])
                     elif block_info["compression_type"] == BLOCK_COMPRESSION_TYPE.DEFLATE:
                         block_info["uncompressed_data"] = zlib.decompress(block_info["compressed_data"])
                     else:
@@ -416,7 +418,7 @@ class rom_blocks():
         else:
             print("\tNo upgrade blocks found")
 
-    def unpack(origin, destination = "./out", silent = False, block_file_extension = ".rom", block_size = 0x10000, block_file_prefix = "", address_base = 0x00000000, header_version = BLOCK_HEADER_VERSION.VER2, compression_type = BLOCK_COMPRESSION_TYPE.BSTR, signature_type = BLOCK_SIGNATURE_TYPE.PROD, message_templates = [], build_info = None):
+    def unpack(origin, destination = "./out", silent = False, block_file_extension = ".rom", block_size = 0x10000, block_file_prefix = "", address_base = 0x00000000, header_version = BLOCK_HEADER_VERSION.VER2, compression_type = BLOCK_COMPRESSION_TYPE.BSTR, signature_type = BLOCK_SIGNATURE_TYPE.PROD, message_templates = [], build_info = None, workers = 0):
         ROM_BLOCK_MAGIC = 0x96031889
         check_rom_blocks = []
         write_rom_blocks = []
@@ -510,6 +512,20 @@ class rom_blocks():
                         "block_data": bytearray(0x00)
                     })
 
+            # LZSS blocks don't get merged so they can all be compressed up front over a process pool.
+            lzss_rom_blocks = [rom_block for rom_block in check_rom_blocks if rom_block["compression_type"] == BLOCK_COMPRESSION_TYPE.LZSS]
+            if len(lzss_rom_blocks) > 0:
+                if not silent:
+                    print("\tCompressing " + str(len(lzss_rom_blocks)) + " LZSS block(s)")
+
+                lzss_blobs = []
+                for rom_block in lzss_rom_blocks:
+                    f.seek(rom_block["offset"])
+                    lzss_blobs.append(f.read(rom_block["size"]))
+
+                for rom_block, compressed_data in zip(lzss_rom_blocks, compress_pool.compress_many(lzss_blobs, FILE_COMPRESSION.LZSS, workers)):
+                    rom_block["lzss_data"] = compressed_data
+
             write_block_index = 0x00
             check_block_index = 0x00
             last_check_part_index = len(check_rom_blocks)
@@ -576,8 +592,7 @@ class rom_blocks():
                         compressed_data = zlib_compressed_data
 
                 elif rom_block["compression_type"] == BLOCK_COMPRESSION_TYPE.LZSS:
-                    print("\tCompressing block " + str(write_block_index))
-                    compressed_data = lzss().Lzss_Compress(uncompressed_data)
+                    compressed_data = rom_block["lzss_data"]
                 elif rom_block["compression_type"] == BLOCK_COMPRESSION_TYPE.DEFLATE:
                     compressed_data = zlib.compress(uncompressed_data, 9)
                 else:
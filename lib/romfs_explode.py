@@ -192,7 +192,11 @@ class romfs_explode():
                     print("\nAttemping level1 image (peeling back onion)")
 
                 if build_info["image_type"] == IMAGE_TYPE.VIEWER_SCRAMBLED:
-                    secondart_build_info = romfs_cipher.unscramble_vwr_file(build_info, silent)
+                    if level1_file == "!tmp":
+                        # Nothing needs to be kept so it's read in place.
+                        secondart_build_info = romfs_cipher.detect_vwr_file(build_info)
+                    else:
+                        secondart_build_info = romfs_cipher.unscramble_vwr_file(build_info, silent, level1_file)
                     if not silent:
                         build_meta.print_build_info(secondart_build_info, "\nUnscrambled Type: ")
 
@@ -212,7 +216,8 @@ class romfs_explode():
                         build_meta.print_build_info(secondart_build_info, "\nLevel1 Type: ")
 
                 if secondart_build_info != None:
-                    if level1_file != "!tmp" and "is_level1_image" in secondart_build_info.keys() and secondart_build_info["is_level1_image"]:
+                    if level1_file != "!tmp" and secondart_build_info["path"] != level1_file and "is_level1_image" in secondart_build_info.keys() and secondart_build_info["is_level1_image"]:
+                        build_meta.forget_detect(level1_file)
                         shutil.copyfile(secondart_build_info["path"], level1_file)
                         os.remove(secondart_build_info["path"])
                         secondart_build_info["path"] = level1_file
@@ -230,7 +235,7 @@ class romfs_explode():
     def get_nodes(build_info, read_data = True, data_prefix = "romfs"):
         romfs_nodes = []
 
-        with open(build_info["path"], "rb") as f:
+        with romfs_cipher.open_image(build_info) as f:
             address = (build_info[data_prefix + "_address"] - (0x38 + 0x08))
 
             romfs_nodes = romfs_explode.walk_romfs(f, build_info, address, 0x00000000, 0x00000000, True, read_data, data_prefix)
@@ -11,9 +11,10 @@ from lib.lzpf import *
 from lib.lzss import *
 from lib.build_meta import *
 from lib.autodisk import *
+from lib.compress_pool import *
 
 class romfs_implode():
-    def build_romfs(directory_paths, build_info, build_level = "level0", final_level1_path = None, level1_lzj_version = None, data_blob = b'', autodisk_blob = b'', tmpfs_blob = b'', romfs_data_prefix = "romfs", silent = False, descriptor_table = None, disable_romfs_build = False, disable_romfs_compression = False):
+    def build_romfs(directory_paths, build_info, build_level = "level0", final_level1_path = None, level1_lzj_version = None, data_blob = b'', autodisk_blob = b'', tmpfs_blob = b'', romfs_data_prefix = "romfs", silent = False, descriptor_table = None, disable_romfs_build = False, disable_romfs_compression = False, level1_lzj_match_finder = None, cache_dir = None, level1_lzj_progress = None, level1_lzj_summaries = None, workers = 0, executor = None):
         object_count = 0
         files_blob_size = 0
         romfs_blob = b''
@@ -21,6 +22,7 @@ class romfs_implode():
         object_table_offset = 0
         file_list = {}
         romfs_nodes = []
+        romfs_files = []
 
         if not silent and not disable_romfs_build:
             print("\tBuilding " + romfs_data_prefix)
@@ -184,6 +186,7 @@ class romfs_implode():
                 aligned_size = 0
                 data_checksum = 0
                 next_link = 0
+                compression_plan = FILE_COMPRESSION.NONE
 
                 if file_type == OBJECT_TYPE.FILE:
                     data = build_meta.get_file_data(file_path)
@@ -269,64 +272,12 @@ class romfs_implode():
                             if compression_strategy == "off" or romfs_path in dont_compress_list:
                                 compression_type = FILE_COMPRESSION.NONE
                             elif compression_strategy == "best":
-                                lzpf_len = file_size + 1
-                                lzpf_data = b''
-                                lzss_len = file_size + 1
-                                lzss_data = b''
-
-                                try:
-                                    c = lzpf()
-                                    lzpf_data = c.Lzpf_Compress(data)
-                                    lzpf_len = len(lzpf_data)
-                                except:
-                                    pass
-
-                                try:
-                                    c = lzss()
-                                    lzss_data = c.Lzss_Compress(data)
-                                    lzss_len = len(lzss_data)
-                                except:
-                                    pass
-
-                                if lzss_len > file_size and lzpf_len > file_size:
-                                    compression_type = FILE_COMPRESSION.NONE
-                                elif lzss_len >= lzpf_len:
-                                    compression_type = FILE_COMPRESSION.LZPF
-                                    data = lzpf_data
-                                else:
-                                    compression_type = FILE_COMPRESSION.LZSS
-                                    data = lzss_data
-                            elif compression_type == FILE_COMPRESSION.LZPF:
-                                c = lzpf()
-                                data = c.Lzpf_Compress(data)
-                            elif compression_type == FILE_COMPRESSION.LZSS:
-                                c = lzss()
-                                data = c.Lzss_Compress(data)
+                                compression_plan = "best"
+                            elif compression_type == FILE_COMPRESSION.LZPF or compression_type == FILE_COMPRESSION.LZSS:
+                                compression_plan = compression_type
                             else:
                                 compression_type = FILE_COMPRESSION.NONE
 
-                        if compression_type != FILE_COMPRESSION.NONE:
-                            _file_size = bytearray(4)
-                            struct.pack_into(
-                                endian + "I",
-                                _file_size,
-                                0,
-                                file_size
-                            )
-
-                            compressed_size = data_size
-                            data = _file_size + data
-                        else:
-                            compressed_size = -1
-
-                    data_size = len(data)
-                    alignment_size = 4 - (data_size % 4)
-                    for a in range(4 - (data_size % 4)):
-                        data.append(0)
-
-                    aligned_size = len(data)
-
-                    data_checksum = build_meta.chunked_checksum(data, 1)
                 else: 
                     if descriptor_table != None and "object" in descriptor_table:
                         if depth == 0 and romfs_path in descriptor_table["object"] and "next_link" in descriptor_table["object"][romfs_path]:
@@ -335,7 +286,6 @@ class romfs_implode():
                     children = _walk_romfs(build_meta.natural_sort(file_list[romfs_path]["children"]), (depth + 1))
 
                 object_count += 1
-                files_blob_size += aligned_size
 
                 if not silent:
                     print("\r\t\tObject count: " + str(object_count), end='', flush=True)
@@ -366,8 +316,110 @@ class romfs_implode():
 
                 _romfs_nodes.append(romfs_node)
 
+                if file_type == OBJECT_TYPE.FILE:
+                    romfs_files.append((romfs_node, compression_plan))
+
             return _romfs_nodes
 
+        def _compress_romfs_files():
+            nonlocal endian, files_blob_size
+
+            # Files are compressed all at once after the walk so they can be spread over a process pool.
+            # For "best" only LZPF is sized up front, it's much quicker than LZSS. LZSS then only has
+            # to beat that and gives up as soon as it can't. LZPF is only built if it's the winner.
+            best_files = [romfs_node for romfs_node, compression_plan in romfs_files if compression_plan == "best"]
+
+            lzpf_sizes = compress_pool.estimate_many(
+                [romfs_node["data"] for romfs_node in best_files],
+                FILE_COMPRESSION.LZPF,
+                workers,
+                ignore_errors=True,
+                size_limits=[romfs_node["file_size"] for romfs_node in best_files],
+                executor=executor
+            )
+
+            best_codecs = {}
+            size_limits = {}
+            for romfs_node, lzpf_size in zip(best_files, lzpf_sizes):
+                file_size = romfs_node["file_size"]
+
+                # LZPF wins a tie
+                if lzpf_size != None and lzpf_size <= file_size:
+                    best_codecs[romfs_node["path"]] = FILE_COMPRESSION.LZPF
+                    size_limits[romfs_node["path"]] = lzpf_size - 1
+                else:
+                    best_codecs[romfs_node["path"]] = FILE_COMPRESSION.NONE
+                    size_limits[romfs_node["path"]] = file_size
+
+            compressed_blobs = {}
+
+            lzss_files = [romfs_node for romfs_node, compression_plan in romfs_files if compression_plan == FILE_COMPRESSION.LZSS or compression_plan == "best"]
+            compressed_blobs[FILE_COMPRESSION.LZSS] = dict(zip(
+                [romfs_node["path"] for romfs_node in lzss_files],
+                compress_pool.compress_many(
+                    [romfs_node["data"] for romfs_node in lzss_files],
+                    FILE_COMPRESSION.LZSS,
+                    workers,
+                    ignore_errors=True,
+                    size_limits=[size_limits.get(romfs_node["path"], -1) for romfs_node in lzss_files],
+                    executor=executor
+                )
+            ))
+
+            for romfs_node in best_files:
+                if compressed_blobs[FILE_COMPRESSION.LZSS][romfs_node["path"]] != None:
+                    best_codecs[romfs_node["path"]] = FILE_COMPRESSION.LZSS
+
+            lzpf_files = [romfs_node for romfs_node, compression_plan in romfs_files if compression_plan == FILE_COMPRESSION.LZPF or (compression_plan == "best" and best_codecs[romfs_node["path"]] == FILE_COMPRESSION.LZPF)]
+            compressed_blobs[FILE_COMPRESSION.LZPF] = dict(zip(
+                [romfs_node["path"] for romfs_node in lzpf_files],
+                compress_pool.compress_many([romfs_node["data"] for romfs_node in lzpf_files], FILE_COMPRESSION.LZPF, workers, ignore_errors=True, executor=executor)
+            ))
+
+            for romfs_node, compression_plan in romfs_files:
+                data = romfs_node["data"]
+                file_size = romfs_node["file_size"]
+                compression_type = FILE_COMPRESSION.NONE
+
+                if compression_plan == "best":
+                    compression_type = best_codecs[romfs_node["path"]]
+
+                    if compression_type != FILE_COMPRESSION.NONE:
+                        data = compressed_blobs[compression_type][romfs_node["path"]]
+                elif compression_plan != FILE_COMPRESSION.NONE:
+                    compression_type = compression_plan
+                    data = compressed_blobs[compression_plan][romfs_node["path"]]
+
+                    if data == None:
+                        # Compress again so the error surfaces like it would have done inline.
+                        data = compress_pool.compress_one(compression_plan, romfs_node["data"])
+
+                if compression_type != FILE_COMPRESSION.NONE:
+                    _file_size = bytearray(4)
+                    struct.pack_into(
+                        endian + "I",
+                        _file_size,
+                        0,
+                        file_size
+                    )
+
+                    romfs_node["compressed_size"] = romfs_node["data_size"]
+                    data = _file_size + data
+                else:
+                    romfs_node["compressed_size"] = -1
+
+                data_size = len(data)
+                for a in range(4 - (data_size % 4)):
+                    data.append(0)
+
+                romfs_node["compression_type"] = compression_type
+                romfs_node["data"] = data
+                romfs_node["data_size"] = data_size
+                romfs_node["aligned_size"] = len(data)
+                romfs_node["data_checksum"] = build_meta.chunked_checksum(data, 1)
+
+                files_blob_size += romfs_node["aligned_size"]
+
         if not disable_romfs_build:
             if not silent:
                 if len(directory_paths) == 1:
@@ -382,6 +434,17 @@ class romfs_implode():
             if "/" in file_list:
                 romfs_nodes = _walk_romfs(build_meta.natural_sort(file_list["/"]["children"]))
 
+            # pack hands over the pool it opened, called on its own the pool only lasts for this build.
+            owns_executor = executor == None
+            if owns_executor:
+                executor = compress_pool.open_executor(workers)
+
+            try:
+                _compress_romfs_files()
+            finally:
+                if owns_executor and executor != None:
+                    executor.shutdown()
+
             if not silent:
                 print("\r\tDone.                                 ", flush=True)
 
@@ -437,11 +500,11 @@ class romfs_implode():
             if romfs_blob == None or len(romfs_blob) == 0 and "source_build_path" in build_info and "romfs_offset" in build_info and "romfs_size" in build_info and build_info["romfs_size"] > 0 and build_info["romfs_offset"] > 0 and build_info["image_type"] != IMAGE_TYPE.COMPRESSED_BOX:
                 romfs_blob = build_meta.get_file_data(build_info["source_build_path"], (build_info["romfs_offset"] - build_info["romfs_size"]), build_info["romfs_size"])
                 
-            return build_meta.build_blob(build_info, endian, romfs_blob, data_blob, autodisk_blob, level1_build_blob, level1_lzj_version, tmpfs_blob, silent)
+            return build_meta.build_blob(build_info, endian, romfs_blob, data_blob, autodisk_blob, level1_build_blob, level1_lzj_version, tmpfs_blob, silent, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers)
         else:
             return romfs_blob
 
-    def pack(origin, romfs_folders, tmpfs_folders = [], source_build_path = None, out_path = None, image_type = None, final_level1_path = None, level1_lzj_version = None, data_blob = b'', autodisk_blob = b'', silent = False, build_info = None, build_level = "level0", use_descriptor_file = True, disable_romfs_build = False, disable_romfs_compression = False):
+    def pack(origin, romfs_folders, tmpfs_folders = [], source_build_path = None, out_path = None, image_type = None, final_level1_path = None, level1_lzj_version = None, data_blob = b'', autodisk_blob = b'', silent = False, build_info = None, build_level = "level0", use_descriptor_file = True, disable_romfs_build = False, disable_romfs_compression = False, level1_lzj_match_finder = None, cache_dir = None, level1_lzj_progress = None, level1_lzj_summaries = None, workers = 0):
         if build_info == None and source_build_path != None:
             build_info = build_meta.detect(source_build_path)
 
@@ -478,14 +541,20 @@ class romfs_implode():
 
         tmpfs_blob = b''
 
-        if len(tmpfs_folders) > 0:
-            build_info["tmpfs_offset"] = build_info["flash_size"] - build_info["flash_nvram_size"]
-            build_info["tmpfs_address"] = build_info["build_address"] + build_info["tmpfs_offset"]
-            build_info["memory_tmpfs_address"] = build_info["tmpfs_address"] - 0x08
+        # One pool for every file this pack compresses, TMPFS and ROMFS alike.
+        executor = compress_pool.open_executor(workers)
+        try:
+            if len(tmpfs_folders) > 0:
+                build_info["tmpfs_offset"] = build_info["flash_size"] - build_info["flash_nvram_size"]
+                build_info["tmpfs_address"] = build_info["build_address"] + build_info["tmpfs_offset"]
+                build_info["memory_tmpfs_address"] = build_info["tmpfs_address"] - 0x08
 
-            tmpfs_blob = romfs_implode.build_romfs(tmpfs_folders, build_info, build_level, final_level1_path, level1_lzj_version, data_blob, autodisk_blob, tmpfs_blob, "tmpfs", silent, descriptor_table, disable_romfs_build, disable_romfs_compression)
+                tmpfs_blob = romfs_implode.build_romfs(tmpfs_folders, build_info, build_level, final_level1_path, level1_lzj_version, data_blob, autodisk_blob, tmpfs_blob, "tmpfs", silent, descriptor_table, disable_romfs_build, disable_romfs_compression, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers, executor)
 
-        data = romfs_implode.build_romfs(romfs_folders, build_info, build_level, final_level1_path, level1_lzj_version, data_blob, autodisk_blob, tmpfs_blob, "romfs", silent, descriptor_table, disable_romfs_build, disable_romfs_compression)
+            data = romfs_implode.build_romfs(romfs_folders, build_info, build_level, final_level1_path, level1_lzj_version, data_blob, autodisk_blob, tmpfs_blob, "romfs", silent, descriptor_table, disable_romfs_build, disable_romfs_compression, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers, executor)
+        finally:
+            if executor != None:
+                executor.shutdown()
 
         if build_info["image_type"] == IMAGE_TYPE.VIEWER_SCRAMBLED:
             romfs_cipher.write_vwr_file(build_info, data, silent)
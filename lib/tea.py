@@ -1,4 +1,5 @@
 import ctypes
+import struct
 
 class tea():
     def encrypt(data, key):
@@ -47,4 +48,76 @@ class tea():
 
             sum.value -= delta.value
 
-        return (_data[0].value.to_bytes(4, "little") + _data[1].value.to_bytes(4, "little"))
\ No newline at end of file
+        return (_data[0].value.to_bytes(4, "little") + _data[1].value.to_bytes(4, "little"))
+
+    # The _blocks versions run over any number of back to back 8-byte blocks. With numpy
+    # every block goes through each round at once in uint32 lanes, which wrap like the
+    # c_uint32 math does. Without numpy it's the same rounds on plain masked ints, one
+    # block at a time. The rounds are written once for both, word() makes the round sum
+    # the same type as the lanes.
+
+    def unpack_key(key):
+        return struct.unpack("<4I", bytes(key[0:16]))
+
+    def run_blocks(data, key, rounds):
+        if (len(data) % 8) != 0:
+            raise Exception("TEA data needs to be a multiple of 8 bytes, got " + str(len(data)))
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        k0, k1, k2, k3 = tea.unpack_key(key)
+
+        if numpy != None:
+            blocks = numpy.frombuffer(bytes(data), dtype="<u4").reshape(-1, 2)
+
+            v0, v1 = rounds(
+                blocks[:, 0].astype(numpy.uint32), blocks[:, 1].astype(numpy.uint32),
+                numpy.uint32(k0), numpy.uint32(k1), numpy.uint32(k2), numpy.uint32(k3),
+                numpy.uint32
+            )
+
+            blocks = numpy.empty((len(v0), 2), dtype="<u4")
+            blocks[:, 0] = v0
+            blocks[:, 1] = v1
+
+            return blocks.tobytes()
+        else:
+            out = bytearray(len(data))
+            for i, (v0, v1) in enumerate(struct.iter_unpack("<2I", data)):
+                v0, v1 = rounds(v0, v1, k0, k1, k2, k3, int)
+
+                struct.pack_into("<2I", out, i * 8, v0, v1)
+
+            return bytes(out)
+
+    def encrypt_rounds(v0, v1, k0, k1, k2, k3, word):
+        sum = 0
+        for i in range(32):
+            sum = (sum + 0x9E3779B9) & 0xFFFFFFFF
+            _sum = word(sum)
+
+            v0 = (v0 + ((((v1 << 4) + k0) ^ (v1 + _sum) ^ ((v1 >> 5) + k1)))) & 0xFFFFFFFF
+            v1 = (v1 + ((((v0 << 4) + k2) ^ (v0 + _sum) ^ ((v0 >> 5) + k3)))) & 0xFFFFFFFF
+
+        return v0, v1
+
+    def decrypt_rounds(v0, v1, k0, k1, k2, k3, word):
+        sum = 0xC6EF3720
+        for i in range(32):
+            _sum = word(sum)
+
+            v1 = (v1 - ((((v0 << 4) + k2) ^ (v0 + _sum) ^ ((v0 >> 5) + k3)))) & 0xFFFFFFFF
+            v0 = (v0 - ((((v1 << 4) + k0) ^ (v1 + _sum) ^ ((v1 >> 5) + k1)))) & 0xFFFFFFFF
+
+            sum = (sum - 0x9E3779B9) & 0xFFFFFFFF
+
+        return v0, v1
+
+    def encrypt_blocks(data, key):
+        return tea.run_blocks(data, key, tea.encrypt_rounds)
+
+    def decrypt_blocks(data, key):
+        return tea.run_blocks(data, key, tea.decrypt_rounds)
@@ -416,6 +416,44 @@ def find_file(pattern, search_dir):
 
     return None
 
+def lzj_progress_bar(phase, positions_done, total, width = 40):
+    done = (positions_done / total) if total > 0 else 1
+    filled = int(width * done)
+
+    sys.stdout.write("\r\t" + str(phase).ljust(16) + "[" + ("#" * filled) + (" " * (width - filled)) + "] " + str(int(done * 100)).rjust(3) + "%")
+
+    if positions_done >= total:
+        sys.stdout.write("\n")
+
+    sys.stdout.flush()
+
+def print_lzj_timings(summaries):
+    print("LZJ timings:")
+
+    if len(summaries) == 0:
+        print("\tNo LZJ compression ran (nothing to compress or a cache hit).")
+
+    for summary in summaries:
+        print("\t" + summary["version"] + " " + summary["match_finder"] + ": " + hex(summary["uncompressed_size"]) + " -> " + hex(summary["compressed_size"]) + " bytes in " + "{:.3f}".format(summary["seconds"]) + "s")
+
+        if "resumed_after" in summary:
+            print("\t\tResumed from the " + summary["resumed_after"] + " checkpoint.")
+
+        for phase, phase_summary in summary["phases"].items():
+            line = "\t\t" + phase.ljust(16) + "{:9.3f}".format(phase_summary["seconds"]) + "s"
+
+            if "peak_rss" in phase_summary:
+                line += "  peak rss " + "{:.1f}".format(phase_summary["peak_rss"] / 0x100000) + "MiB"
+
+            if "peak_memory" in phase_summary:
+                line += "  peak traced " + "{:.1f}".format(phase_summary["peak_memory"] / 0x100000) + "MiB"
+
+            print(line)
+
+def print_detect_cache_stats():
+    print("Detect cache:")
+    print("\t" + str(build_meta.DETECT_CACHE_STATS["hits"]) + " hits, " + str(build_meta.DETECT_CACHE_STATS["misses"]) + " misses")
+
 def info(in_path, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, is_rom_blocks = False):
     in_type = PATH_TYPE.NULL_PATH_OBJCT
     if os.path.isdir(in_path):
@@ -443,6 +481,9 @@ def info(in_path, no_matryoshka = False, no_autodisk = False, no_data_section =
             if not no_romfs:
                 print("\n=== ROMFS Files ===\n")
                 romfs_explode.list(in_path, True, "" if no_matryoshka else None)
+            elif not no_matryoshka and build_info["image_type"] in [IMAGE_TYPE.COMPRESSED_BOX, IMAGE_TYPE.COMPRESSED_BOOTROM]:
+                # Listing the ROMFS needs the whole level1 expanded but its build info only needs what detect reads.
+                build_meta.print_build_info(build_matryoshka.detect_level1(build_info), "\nLevel1 Type: ")
 
             if not no_autodisk:
                 print("\n\n=== Autodisk Files ===\n")
@@ -459,8 +500,9 @@ def fixcs(in_path):
     if len(build_blob) >= code_size:
         current_checksum = int.from_bytes(bytes(build_blob[0x08:0x0c]), "big")
 
-        build_blob[0x08:0x0c] = bytearray(0x04)
-        calculated_checksum = build_meta.chunked_checksum(build_blob[0x00:code_size])
+        code_image = checksum_image(build_blob, 0x00, code_size)
+        code_image.write(0x08, bytearray(0x04))
+        calculated_checksum = code_image.checksum()
 
         print("\tCalculated code checksum: " + hex(calculated_checksum) + ", Current code checksum: " + hex(current_checksum))
 
@@ -484,6 +526,7 @@ def fixcs(in_path):
         print("Unable to checksum. File length seems bogus?")
 
     if updated_blob:
+        build_meta.forget_detect(in_path)
         open(in_path, "wb").write(build_blob)
 
 def process_file_to_folder(in_path, template_path, level1_path, out_path, silent = False, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, no_template = False):
@@ -622,7 +665,7 @@ def process_file_to_folder(in_path, template_path, level1_path, out_path, silent
                 f.write(json.dumps(dt, sort_keys=True, indent=4))
                 f.close()
 
-def process_folder_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent = False, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, no_template = False, level0_data_path = None, level1_data_path = None, level1_lzj_version = None, autodisk_path = None):
+def process_folder_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent = False, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, no_template = False, level0_data_path = None, level1_data_path = None, level1_lzj_version = None, autodisk_path = None, level1_lzj_match_finder = None, cache_dir = None, level1_lzj_progress = None, level1_lzj_summaries = None, workers = 0):
     box_types = [
         IMAGE_TYPE.BOX,
         IMAGE_TYPE.COMPRESSED_BOX,
@@ -726,7 +769,7 @@ def process_folder_to_file(in_path, template_path, level1_path, out_path, out_fi
     if out_file_type == IMAGE_TYPE.ULTIMATETV_BOX:
         utv_tools.pack(in_path, out_path, template_path, silent, level0_build_info, True, no_romfs, no_nk, no_nk_registry)
     elif not out_file_type in box_types:
-        romfs_implode.pack(in_path, level0_romfs_folders + tmp_romfs_folders + level1_romfs_folders + unknown_romfs_folders, [], template_path, out_path, out_file_type, "", None, b'', b'', silent, level0_build_info, "level0", True, no_romfs, False)
+        romfs_implode.pack(in_path, level0_romfs_folders + tmp_romfs_folders + level1_romfs_folders + unknown_romfs_folders, [], template_path, out_path, out_file_type, "", None, b'', b'', silent, level0_build_info, "level0", True, no_romfs, False, workers=workers)
     else:
         if template_path != None:
             level0_build_info = build_meta.detect(template_path)
@@ -814,7 +857,7 @@ def process_folder_to_file(in_path, template_path, level1_path, out_path, out_fi
             # LZJ is better than any ROMFS compression so leave it uncompressed and let LZJ do its thing
             disable_romfs_compression = (out_file_type == IMAGE_TYPE.COMPRESSED_BOOTROM and "bootrom_level1_compression" in level0_build_info and level0_build_info["bootrom_level1_compression"] == FILE_COMPRESSION.LZJV1)
 
-            romfs_implode.pack(in_path, _romfs_folders, [], level1_path, built_level1_path, level1_build_info["image_type"], "", None, level1_data, cb_level0_audodisk_data, silent, level1_build_info, "level1", True, no_romfs, disable_romfs_compression)
+            romfs_implode.pack(in_path, _romfs_folders, [], level1_path, built_level1_path, level1_build_info["image_type"], "", None, level1_data, cb_level0_audodisk_data, silent, level1_build_info, "level1", True, no_romfs, disable_romfs_compression, workers=workers)
 
         level0_data = b''
         if not no_data_section:
@@ -858,12 +901,12 @@ def process_folder_to_file(in_path, template_path, level1_path, out_path, out_fi
             elif len(unknown_romfs_folders) > 0:
                 _romfs_folders = [unknown_romfs_folders.pop()]
                 
-        romfs_implode.pack(in_path, _romfs_folders, tmp_romfs_folders, template_path, out_path, out_file_type, built_level1_path, level1_lzj_version, level0_data, audodisk_data, silent, level0_build_info, "level0", True, no_romfs, False)
+        romfs_implode.pack(in_path, _romfs_folders, tmp_romfs_folders, template_path, out_path, out_file_type, built_level1_path, level1_lzj_version, level0_data, audodisk_data, silent, level0_build_info, "level0", True, no_romfs, False, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers)
 
         if built_level1_path != None and os.path.isfile(built_level1_path) and template_path != built_level1_path:
             os.remove(built_level1_path)
 
-def process_file_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent = False, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, no_template = False, level0_data_path = None, level1_data_path = None, level1_lzj_version = None, autodisk_path = None):
+def process_file_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent = False, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, no_template = False, level0_data_path = None, level1_data_path = None, level1_lzj_version = None, autodisk_path = None, level1_lzj_match_finder = None, cache_dir = None, level1_lzj_progress = None, level1_lzj_summaries = None, workers = 0):
     in_build_info = build_meta.detect(in_path)
 
     if in_build_info != None and "image_type" in in_build_info and IMAGE_TYPE(in_build_info["image_type"]) != IMAGE_TYPE.COMPRESSED_BOX and out_file_type == IMAGE_TYPE.COMPRESSED_BOX:
@@ -874,18 +917,18 @@ def process_file_to_file(in_path, template_path, level1_path, out_path, out_file
 
         level0_build_info["image_type"] = IMAGE_TYPE.COMPRESSED_BOX
 
-        romfs_implode.pack(in_path, [], [], template_path, out_path, IMAGE_TYPE.COMPRESSED_BOX, in_path, level1_lzj_version, b'', b'', silent, level0_build_info, "level0", True, no_romfs, False)
+        romfs_implode.pack(in_path, [], [], template_path, out_path, IMAGE_TYPE.COMPRESSED_BOX, in_path, level1_lzj_version, b'', b'', silent, level0_build_info, "level0", True, no_romfs, False, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers)
     else:
         tmp_dump_path = tempfile.mktemp()
 
         process_file_to_folder(in_path, template_path, level1_path, tmp_dump_path, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template)
 
-        process_folder_to_file(tmp_dump_path, template_path, level1_path, out_path, out_file_type, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template, level0_data_path, level1_data_path, level1_lzj_version, autodisk_path)
+        process_folder_to_file(tmp_dump_path, template_path, level1_path, out_path, out_file_type, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template, level0_data_path, level1_data_path, level1_lzj_version, autodisk_path, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers)
 
         if tmp_dump_path != None and os.path.isdir(tmp_dump_path):
             shutil.rmtree(tmp_dump_path)
 
-def process(in_path, template_file, out_path, out_file_type = None, silent = False, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, no_template = False, level1_path = None, level0_data_path = None, level1_data_path = None, level1_lzj_version = None, autodisk_path = None, is_rom_blocks = False, is_build_folder = True, rom_block_size = None, rom_block_address_base = None, rom_block_header_version = None, rom_block_compression_type = None, rom_block_signature_type = None, rom_block_message = "", block_file_prefix = ""):
+def process(in_path, template_file, out_path, out_file_type = None, silent = False, no_matryoshka = False, no_autodisk = False, no_data_section = False, no_romfs = False, no_nk = False, no_nk_registry = False, no_template = False, level1_path = None, level0_data_path = None, level1_data_path = None, level1_lzj_version = None, autodisk_path = None, is_rom_blocks = False, is_build_folder = True, rom_block_size = None, rom_block_address_base = None, rom_block_header_version = None, rom_block_compression_type = None, rom_block_signature_type = None, rom_block_message = "", block_file_prefix = "", level1_lzj_match_finder = None, cache_dir = None, level1_lzj_progress = None, level1_lzj_summaries = None, workers = 0):
     in_type = PATH_TYPE.NULL_PATH_OBJCT
     if os.path.isdir(in_path):
         in_type = PATH_TYPE.UNPACKED_FOLDER
@@ -996,16 +1039,16 @@ def process(in_path, template_file, out_path, out_file_type = None, silent = Fal
             else:
                 message_templates = []
 
-            rom_blocks.unpack(in_path, out_path, silent, block_file_extension, block_size, block_file_prefix, address_base, header_version, compression_type, signature_type, message_templates, build_info)
+            rom_blocks.unpack(in_path, out_path, silent, block_file_extension, block_size, block_file_prefix, address_base, header_version, compression_type, signature_type, message_templates, build_info, workers)
         else:
             process_file_to_folder(in_path, template_path, level1_path, out_path, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template)
     elif in_type == PATH_TYPE.UNPACKED_FOLDER and out_type == PATH_TYPE.PACKED_ROM_FILE:
         if out_file_type == IMAGE_TYPE.ROM_BLOCKS or is_rom_blocks or (not is_build_folder and rom_blocks.count_rom_parts(in_path) > 0):
             rom_blocks.pack(in_path, out_path, silent)
         else:
-            process_folder_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template, level0_data_path, level1_data_path, level1_lzj_version, autodisk_path)
+            process_folder_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template, level0_data_path, level1_data_path, level1_lzj_version, autodisk_path, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers)
     elif in_type == PATH_TYPE.PACKED_ROM_FILE and out_type == PATH_TYPE.PACKED_ROM_FILE:
-        process_file_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template, level0_data_path, level1_data_path, level1_lzj_version, autodisk_path)
+        process_file_to_file(in_path, template_path, level1_path, out_path, out_file_type, silent, no_matryoshka, no_autodisk, no_data_section, no_romfs, no_nk, no_nk_registry, no_template, level0_data_path, level1_data_path, level1_lzj_version, autodisk_path, level1_lzj_match_finder, cache_dir, level1_lzj_progress, level1_lzj_summaries, workers)
     elif in_type == PATH_TYPE.UNPACKED_FOLDER and out_type == PATH_TYPE.UNPACKED_FOLDER and (out_file_type == IMAGE_TYPE.ROM_BLOCKS or is_rom_blocks or (not is_build_folder and rom_blocks.count_rom_parts(in_path) > 0)):
         tmp_dump_path = tempfile.mktemp()
 
@@ -1050,6 +1093,12 @@ def main():
         str(LZJ_VERSION.VERSION2)
     ]
 
+    allowed_lzj_match_finders = [
+        str(LZJ_MATCH_FINDER.RADIX),
+        str(LZJ_MATCH_FINDER.NUMPY),
+        str(LZJ_MATCH_FINDER.PARALLEL)
+    ]
+
     description = "WebTV ROM Tool (Rommy) v1.0.0: "
     description += "This tool allows you to unpack and repack build images. It unpacks and packs ROMFS files, Autodisk files, CompressFS files, and UltimateTV NK.nb files. It supports all approm and bootrom images besides the classic bootrom and any diag-type builds. It also supports both raw and scrambled ROMFS files used in the WebTV viewer and the WEBTV.ROM found in the WebTV Dreamcast disk."
 
@@ -1135,6 +1184,18 @@ def main():
     ap.add_argument('--level1-lzj-version', type=str,
                     help="Specify the lzj version used when creating a compressed box (BPS and LC2.5) image. Available: " + ", ".join(allowed_lzj_versions))
 
+    ap.add_argument('--level1-lzj-match-finder', type=str,
+                    help="Specify how lzj finds matches when creating a compressed box (BPS and LC2.5) image. NUMPY and PARALLEL give the same output as RADIX, only faster. NUMPY needs numpy installed and PARALLEL spreads the work over every CPU. Available: " + ", ".join(allowed_lzj_match_finders))
+
+    ap.add_argument('--cache-dir', type=str,
+                    help="Folder to keep compressed level1 images in. A rebuild with an unchanged level1 image reuses the cached compression instead of compressing again. Interrupted lzj compressions are checkpointed in a checkpoints folder under it and pick up where they left off.")
+
+    ap.add_argument('--workers', type=int, default=0,
+                    help="How many processes to compress ROMFS files, upgrade blocks and the PARALLEL lzj match finder with. 0 (the default) uses every CPU and 1 does everything in this process.")
+
+    ap.add_argument('--timings', action='store_true',
+                    help="Print how long each phase of the level1 lzj compression took and the peak memory used by the end of it, and how many image detections were answered from the detect cache. With --info or --fixcs only the detect cache is printed.")
+
     ap.add_argument('--autodisk-path', action='store_true',
                     help="Path to a folder containing the files to use when creating a build image. Will use details found in input directory otherwise. This is incompatible with --no-autodisk.")
 
@@ -1212,14 +1273,40 @@ def main():
             else:
                 level1_lzj_version = LZJ_VERSION[_level1_lzj_version]
 
-        process(arg.IN_PATH, arg.template_image_file, arg.OUT_PATH, out_type, silent, arg.no_matryoshka, arg.no_autodisk, arg.no_data_section, arg.no_romfs, arg.no_nk, arg.no_nk_registry, arg.no_template, arg.level1_path, arg.level0_data_path, arg.level1_data_path, level1_lzj_version, arg.autodisk_path, arg.rom_blocks, is_build_folder, arg.rom_block_size, arg.rom_block_address_base, rom_block_header_version, rom_block_compression_type, rom_block_signature_type, arg.rom_block_message, arg.rom_block_prefix)
+        level1_lzj_match_finder = None
+        if arg.level1_lzj_match_finder != None:
+            _level1_lzj_match_finder = arg.level1_lzj_match_finder.upper()
+
+            if not LZJ_MATCH_FINDER.has_name(_level1_lzj_match_finder) or not _level1_lzj_match_finder in allowed_lzj_match_finders:
+                raise Exception("LZJ match finder '" + _level1_lzj_match_finder + "' is not known. Allowed types: " + ", ".join(allowed_lzj_match_finders))
+            else:
+                level1_lzj_match_finder = LZJ_MATCH_FINDER[_level1_lzj_match_finder]
+
+        level1_lzj_progress = None
+        if not silent:
+            level1_lzj_progress = lzj_progress_bar
+
+        level1_lzj_summaries = None
+        if arg.timings:
+            level1_lzj_summaries = []
+
+        process(arg.IN_PATH, arg.template_image_file, arg.OUT_PATH, out_type, silent, arg.no_matryoshka, arg.no_autodisk, arg.no_data_section, arg.no_romfs, arg.no_nk, arg.no_nk_registry, arg.no_template, arg.level1_path, arg.level0_data_path, arg.level1_data_path, level1_lzj_version, arg.autodisk_path, arg.rom_blocks, is_build_folder, arg.rom_block_size, arg.rom_block_address_base, rom_block_header_version, rom_block_compression_type, rom_block_signature_type, arg.rom_block_message, arg.rom_block_prefix, level1_lzj_match_finder, arg.cache_dir, level1_lzj_progress, level1_lzj_summaries, arg.workers)
+
+        if level1_lzj_summaries != None:
+            print_lzj_timings(level1_lzj_summaries)
+            print_detect_cache_stats()
     elif arg.IN_PATH != None:
         if arg.fixcs:
             fixcs(arg.IN_PATH)
         else:
             info(arg.IN_PATH, arg.no_matryoshka, arg.no_autodisk, arg.no_data_section, arg.no_romfs, arg.no_nk, arg.no_nk_registry, (not is_build_folder or arg.rom_blocks))
 
+        if arg.timings:
+            print_detect_cache_stats()
+
     if arg.farted:
         do_fart()
 
-main()
+if __name__ == "__main__":
+    # Pool workers re-import this file on platforms that spawn them, so only run from the command line
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import sysconfig
+import argparse
+from lib.lzj import *
+
+# Times the lzj match finders on slices of a real binary, libpython's shared library unless --file says otherwise.
+# Run from the top of the tree: python -m tests.bench_lzj [--size N ...] [--version N] [--workers N] [--file PATH]
+
+def default_file():
+    library_dir = sysconfig.get_config_var("LIBDIR")
+    library_name = sysconfig.get_config_var("LDLIBRARY")
+
+    if library_dir != None and library_name != None:
+        return os.path.join(library_dir, library_name)
+    else:
+        return sys.executable
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the lzj match finders.")
+    ap.add_argument('--file', type=str, default=default_file(), help="What to take the slices from.")
+    ap.add_argument('--size', type=lambda x: int(x, 0), nargs="+", default=[0x64000], help="Slice sizes to compress, 0x64000 (400KB) by default.")
+    ap.add_argument('--version', type=int, default=2, help="LZJ version to compress with.")
+    ap.add_argument('--workers', type=int, default=0, help="Workers for the PARALLEL match finder, 0 uses every CPU.")
+    ap.add_argument('--match-finder', type=str, nargs="+", default=[str(match_finder) for match_finder in LZJ_MATCH_FINDER], help="Which match finders to time.")
+    arg = ap.parse_args()
+
+    with open(arg.file, "rb") as f:
+        file_data = f.read()
+
+    version = LZJ_VERSION.get_value("VERSION" + str(arg.version))
+    match_finders = [LZJ_MATCH_FINDER.get_value(name.upper()) for name in arg.match_finder]
+
+    print(os.path.basename(arg.file) + ", " + str(version))
+    print("size".rjust(10) + "finder".rjust(10) + "find".rjust(10) + "compress".rjust(12) + "out size".rjust(12))
+
+    for size in arg.size:
+        data = bytearray(file_data[0:size])
+
+        first_data = None
+        for match_finder in match_finders:
+            d = lzj(version, match_finder, arg.workers)
+            compressed_data, summary = d.Lzj_CompressWithSummary(data)
+
+            if first_data == None:
+                first_data = bytes(compressed_data)
+            elif bytes(compressed_data) != first_data:
+                raise Exception(str(match_finder) + " output for " + hex(size) + " bytes doesn't match " + str(match_finders[0]) + "!")
+
+            print(hex(len(data)).rjust(10) + str(match_finder).rjust(10) + "{:.2f}s".format(summary["phases"][str(LZJ_PHASE.FIND_MATCHES)]["seconds"]).rjust(10) + "{:.2f}s".format(summary["seconds"]).rjust(12) + hex(len(compressed_data)).rjust(12))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import sys
+import time
+import argparse
+from tests.corpus import corpus
+from lib.lzss import *
+
+# Times the EXACT and FAST LZSS match finders over the test corpus.
+# Run from the top of the tree: python -m tests.bench_lzss [--repeat N] [--scale N]
+
+def best_time(function, repeat):
+    best = None
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start_time
+
+        if best == None or seconds < best:
+            best = seconds
+
+    return best, result
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the LZSS match finders.")
+    ap.add_argument('--repeat', type=int, default=3, help="Runs per sample, the fastest one is kept.")
+    ap.add_argument('--scale', type=int, default=4, help="How many times each corpus blob is repeated back to back.")
+    arg = ap.parse_args()
+
+    print("sample".ljust(14) + "size".rjust(10) + "exact".rjust(12) + "fast".rjust(12) + "speedup".rjust(10) + "exact size".rjust(12) + "fast size".rjust(12))
+
+    total_exact = 0
+    total_fast = 0
+    for name, blob in corpus().items():
+        if len(blob) < 0x100:
+            continue
+
+        data = bytearray(blob * arg.scale)
+
+        exact_seconds, exact_data = best_time(lambda: lzss(LZSS_MATCH_FINDER.EXACT).Lzss_Compress(data), arg.repeat)
+        fast_seconds, fast_data = best_time(lambda: lzss(LZSS_MATCH_FINDER.FAST).Lzss_Compress(data), arg.repeat)
+
+        if bytes(lzss().Lzss_Expand(fast_data, len(data))) != bytes(data):
+            raise Exception("FAST output for '" + name + "' doesn't expand back to the input!")
+
+        total_exact += exact_seconds
+        total_fast += fast_seconds
+
+        print(name.ljust(14) + hex(len(data)).rjust(10) + "{:.3f}s".format(exact_seconds).rjust(12) + "{:.3f}s".format(fast_seconds).rjust(12) + "{:.1f}x".format(exact_seconds / max(fast_seconds, 1e-9)).rjust(10) + hex(len(exact_data)).rjust(12) + hex(len(fast_data)).rjust(12))
+
+    print("total".ljust(24) + "{:.3f}s".format(total_exact).rjust(12) + "{:.3f}s".format(total_fast).rjust(12) + "{:.1f}x".format(total_exact / max(total_fast, 1e-9)).rjust(10))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import random
+import struct
+
+# Fixed inputs the codec tests run over. Everything comes from a seeded generator so the same bytes
+# come out on every run and every Python version.
+
+WORDS = [b"ROM", b"build", b"level1", b"romfs", b"WebTV", b"approm", b"the", b"file", b"box", b"data", b"\r\n", b" ", b"."]
+
+def text_blob(rng, size):
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(WORDS) + b" "
+
+    return bytes(data[0:size])
+
+def code_blob(rng, size):
+    # MIPS looking big-endian words: a handful of opcodes with varying registers and offsets.
+    data = bytearray()
+    opcodes = [0x27bd0000, 0x8fbf0000, 0xafbf0000, 0x03e00008, 0x00000000, 0x3c040000, 0x0c000000]
+    while len(data) < size:
+        data += struct.pack(">I", rng.choice(opcodes) | (rng.randrange(0x10) << 0x10) | (rng.randrange(0x40) << 2))
+
+    return bytes(data[0:size])
+
+def mixed_blob(rng, size):
+    # Runs, copies of earlier data (near and far) and noise.
+    data = bytearray(rng.randbytes(0x20))
+    while len(data) < size:
+        kind = rng.randrange(4)
+        if kind == 0:
+            data += bytes([rng.randrange(0x100)]) * rng.randrange(1, 0x40)
+        elif kind == 1:
+            start = rng.randrange(len(data))
+            length = rng.randrange(3, 0x90)
+            for i in range(length):
+                data.append(data[start + i])
+        elif kind == 2:
+            start = rng.randrange(max(len(data) - 0x80, 0), len(data))
+            length = rng.randrange(3, 0x20)
+            for i in range(length):
+                data.append(data[start + i])
+        else:
+            data += rng.randbytes(rng.randrange(1, 0x20))
+
+    return bytes(data[0:size])
+
+def corpus():
+    rng = random.Random(0x524f4d)
+
+    return {
+        "empty": b"",
+        "one": b"\x41",
+        "two": b"\x41\x42",
+        "short": b"WebTV",
+        "zeros": bytes(0x3000),
+        "ramp": bytes([(i & 0xff) for i in range(0x1800)]),
+        "text": text_blob(rng, 0x2400),
+        "code": code_blob(rng, 0x2000),
+        "mixed": mixed_blob(rng, 0x5000),
+        "two_symbols": bytes([rng.choice([0x00, 0xff]) for i in range(0x1800)]),
+        "random": rng.randbytes(0x0c00),
+    }
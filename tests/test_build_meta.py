@@ -0,0 +1,401 @@
+import io
+import os
+import random
+import struct
+import tempfile
+import unittest
+from lib.build_meta import *
+
+def sample_data():
+    r = random.Random(0x574254)
+
+    samples = [b'', b'\x01', b'\xff\xfe', b'\x80\x81\x82', bytes(range(0x100)), b'\xff' * 0x1003]
+    for size in [5, 0x3f, 0x400, 0x1001, 0x10000, 0x10003]:
+        samples.append(bytes(r.randrange(0x100) for i in range(size)))
+
+    return samples
+
+def word_loop_checksum(data, chunk_size = 4):
+    # The word at a time loop build_meta used before, to check the byte lane sums against.
+    checksum = 0
+
+    data = bytearray(data)
+    if (len(data) % chunk_size) != 0:
+        data += bytes(chunk_size - (len(data) % chunk_size))
+
+    for i in range(0, len(data), chunk_size):
+        checksum += int.from_bytes(data[i:i + chunk_size], "big")
+
+    return checksum & 0xffffffff
+
+def table_crc32(data, crc = 0xffffffff):
+    # The table driven loop build_meta.crc32 used before zlib. Its table is the reflected 0xedb88320 one built here.
+    table = []
+    for i in range(0x100):
+        value = i
+        for bit in range(8):
+            value = (value >> 1) ^ (0xedb88320 if (value & 1) else 0)
+        table.append(value)
+
+    for byte in data:
+        crc = table[(byte ^ crc) & 0xff] ^ (crc >> 8)
+
+    return crc & 0xffffffff
+
+def loop_swap_data(data, swap_bits = 32, start_offset = 0x00, end_offset = 0x00):
+    # The word at a time loop build_meta.swap_data used before array.byteswap().
+    new_data = bytearray()
+    for idx in range(start_offset, end_offset if end_offset > 0 else len(data), 0x02 if swap_bits == 16 else 0x04):
+        if swap_bits == 32 or swap_bits == 16:
+            swap_data = bytearray(data[idx:(idx + (0x02 if swap_bits == 16 else 0x04))])
+            swap_data.reverse()
+        elif swap_bits == 1632 or swap_bits == 3216:
+            _swap_data = bytearray(data[idx:(idx + 0x04)])
+            _swap_data.reverse()
+
+            swap_data = bytearray([_swap_data[1], _swap_data[0], _swap_data[3], _swap_data[2]])
+        else:
+            swap_data = bytearray(data[idx:(idx + 0x04)])
+
+        new_data += swap_data
+
+    return new_data
+
+class build_meta_checksum_test(unittest.TestCase):
+    def test_checksum_matches_word_loop(self):
+        for data in sample_data():
+            with self.subTest(hex(len(data))):
+                self.assertEqual(build_meta.checksum(data), word_loop_checksum(data, 4))
+                self.assertEqual(build_meta.checksum(bytearray(data)), word_loop_checksum(data, 4))
+
+    def test_chunked_checksum_matches_word_loop(self):
+        for data in sample_data():
+            for chunk_size in [1, 2, 3, 4]:
+                with self.subTest(hex(len(data)) + " " + str(chunk_size)):
+                    self.assertEqual(build_meta.chunked_checksum(data, chunk_size), word_loop_checksum(data, chunk_size))
+
+    def test_chunked_checksum_size(self):
+        with self.assertRaises(Exception):
+            build_meta.chunked_checksum(b'\x00' * 8, 5)
+
+class build_meta_checksum_image_test(unittest.TestCase):
+    def test_patches_match_chunked_checksum(self):
+        r = random.Random(0x43484b)
+
+        for chunk_size in [1, 2, 3, 4]:
+            for i in range(0x10):
+                data = bytearray(r.randrange(0x100) for ii in range(r.randrange(0x10, 0x400)))
+                start = r.randrange(0, 0x0b)
+                end = r.choice([-1, len(data) - r.randrange(0, 0x0b)])
+                _end = len(data) if end < 0 else end
+
+                image = checksum_image(data, start, end, chunk_size)
+
+                with self.subTest(str(chunk_size) + " " + hex(len(data)) + " " + hex(start) + "-" + hex(end)):
+                    self.assertEqual(image.checksum(), build_meta.chunked_checksum(data[start:_end], chunk_size))
+
+                for ii in range(0x20):
+                    # Patches anywhere, including across and outside the start and end of the checksum range.
+                    offset = r.randrange(len(data))
+
+                    if r.randrange(2) == 0:
+                        patch = bytes(r.randrange(0x100) for iii in range(r.randrange(1, min(0x0d, len(data) - offset + 1))))
+
+                        image.write(offset, patch)
+                    else:
+                        format = r.choice([">I", "<I", ">H", "B"])
+                        offset = min(offset, len(data) - struct.calcsize(format))
+
+                        image.pack_into(format, offset, r.randrange(0x100 ** struct.calcsize(format)))
+
+                    with self.subTest(str(chunk_size) + " " + hex(len(data)) + " " + hex(start) + "-" + hex(end) + " " + str(ii) + " " + hex(offset)):
+                        self.assertEqual(image.checksum(), build_meta.chunked_checksum(data[start:_end], chunk_size))
+                        self.assertTrue(image.verify())
+
+    def test_verify_catches_unpatched_change(self):
+        data = bytearray(sample_data()[-3])
+        image = checksum_image(data, 3, 0x3f1, 3)
+
+        data[0x100] ^= 0xff
+
+        self.assertFalse(image.verify())
+        self.assertEqual(image.checksum(), build_meta.chunked_checksum(data[3:0x3f1], 3))
+        self.assertTrue(image.verify())
+
+    def test_write_past_end(self):
+        image = checksum_image(bytearray(0x10))
+
+        for offset, size in [(-1, 1), (0x0f, 2), (0x10, 1)]:
+            with self.subTest(hex(offset) + " " + hex(size)):
+                with self.assertRaises(Exception):
+                    image.write(offset, bytes(size))
+
+class build_meta_crc32_test(unittest.TestCase):
+    def test_crc32_matches_table(self):
+        for data in sample_data():
+            for crc in [0xffffffff, 0x00000000, 0x12345678]:
+                with self.subTest(hex(len(data)) + " " + hex(crc)):
+                    self.assertEqual(build_meta.crc32(data, crc), table_crc32(data, crc))
+
+    def test_crc32_carries_on(self):
+        data = sample_data()[-1]
+
+        for split in [0, 1, 3, 0x400, len(data)]:
+            with self.subTest(hex(split)):
+                self.assertEqual(build_meta.crc32(data[split:], build_meta.crc32(data[0:split])), table_crc32(data))
+                self.assertEqual(crc32_stream().update(data[0:split]).update(data[split:]).value(), table_crc32(data))
+
+    def test_crc32_file_range(self):
+        data = sample_data()[-1]
+
+        read_size = build_meta.CRC32_READ_SIZE
+        build_meta.CRC32_READ_SIZE = 0x333
+        try:
+            with tempfile.TemporaryFile() as f:
+                f.write(data)
+
+                for start_offset, size in [(0, 0), (0, 1), (7, 0), (7, 0x1000), (0x333, 0x667), (len(data) - 1, 0), (len(data), 0), (len(data) - 5, 0x100)]:
+                    with self.subTest(hex(start_offset) + " " + hex(size)):
+                        self.assertEqual(build_meta.crc32_file_range(f, start_offset, size), table_crc32(data[start_offset:(start_offset + size) if size > 0 else len(data)]))
+        finally:
+            build_meta.CRC32_READ_SIZE = read_size
+
+class build_meta_swap_test(unittest.TestCase):
+    SWAP_BITS = [16, 32, 1632, 3216, 0]
+
+    def test_swap_data_matches_loop(self):
+        for data in sample_data():
+            for swap_bits in self.SWAP_BITS:
+                for start_offset, end_offset in [(0, 0), (2, 0), (1, 0), (0, 3), (4, 0x1f), (0x10, 0x400)]:
+                    with self.subTest(hex(len(data)) + " " + str(swap_bits) + " " + hex(start_offset) + "-" + hex(end_offset)):
+                        try:
+                            swapped_data = loop_swap_data(data, swap_bits, start_offset, end_offset)
+                        except IndexError:
+                            # 16/32 can't swap a partial word.
+                            with self.assertRaises(Exception):
+                                build_meta.swap_data(data, swap_bits, start_offset, end_offset)
+                        else:
+                            self.assertEqual(build_meta.swap_data(data, swap_bits, start_offset, end_offset), swapped_data)
+
+    def test_swap_file_data_matches_swap_data(self):
+        data = sample_data()[-2]
+
+        read_size = build_meta.SWAP_READ_SIZE
+        build_meta.SWAP_READ_SIZE = 0x40c
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                in_path = os.path.join(temp_dir, "in.bin")
+                out_path = os.path.join(temp_dir, "out.bin")
+                with open(in_path, "wb") as f:
+                    f.write(data)
+
+                for swap_bits in self.SWAP_BITS:
+                    for start_offset, end_offset in [(0, 0), (4, 0), (8, 0x1001), (0x40c, 0x819)]:
+                        with self.subTest(str(swap_bits) + " " + hex(start_offset) + "-" + hex(end_offset)):
+                            build_meta.swap_file_data(in_path, out_path, swap_bits, start_offset, end_offset)
+
+                            with open(out_path, "rb") as f:
+                                self.assertEqual(f.read(), build_meta.swap_data(data, swap_bits, start_offset, end_offset))
+        finally:
+            build_meta.SWAP_READ_SIZE = read_size
+
+class build_meta_detect_test(unittest.TestCase):
+    def test_detect_leaves_opened_file_open(self):
+        f = io.BytesIO(bytes(0x2000))
+
+        build_info = build_meta.detect("image.bin", f)
+
+        self.assertFalse(f.closed)
+        self.assertEqual(build_info["path"], "image.bin")
+        self.assertEqual(build_info["image_type"], IMAGE_TYPE.UNKNOWN)
+
+    def test_detect_path_matches_opened_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "image.bin")
+            with open(path, "wb") as f:
+                f.write(bytes(0x2000))
+
+            with open(path, "rb") as f:
+                self.assertEqual(build_meta.detect(path, f), build_meta.detect(path))
+
+class build_meta_detect_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "image.bin")
+        self.write_image(bytes(0x2000))
+
+        build_meta.forget_detect()
+
+    def tearDown(self):
+        build_meta.forget_detect()
+        self.temp_dir.cleanup()
+
+    def write_image(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def detect_counted(self, path, opened_file = None):
+        # Returns what detect gave back and how many (hits, misses) it added.
+        hits = build_meta.DETECT_CACHE_STATS["hits"]
+        misses = build_meta.DETECT_CACHE_STATS["misses"]
+
+        build_info = build_meta.detect(path, opened_file)
+
+        return build_info, (build_meta.DETECT_CACHE_STATS["hits"] - hits, build_meta.DETECT_CACHE_STATS["misses"] - misses)
+
+    def test_hit_and_miss(self):
+        first_info, first_counts = self.detect_counted(self.path)
+        second_info, second_counts = self.detect_counted(self.path)
+
+        self.assertEqual(first_counts, (0, 1))
+        self.assertEqual(second_counts, (1, 0))
+        self.assertEqual(second_info, first_info)
+
+    def test_path_spelling(self):
+        self.detect_counted(self.path)
+
+        other_path = os.path.join(self.temp_dir.name, ".", "image.bin")
+        build_info, counts = self.detect_counted(other_path)
+
+        self.assertEqual(counts, (1, 0))
+        self.assertEqual(build_info["path"], other_path)
+
+    def test_opened_file_isnt_cached(self):
+        self.detect_counted(self.path)
+
+        with open(self.path, "rb") as f:
+            build_info, counts = self.detect_counted(self.path, f)
+
+        self.assertEqual(counts, (0, 0))
+
+    def test_forget_detect(self):
+        self.detect_counted(self.path)
+
+        build_meta.forget_detect(self.path)
+        build_info, counts = self.detect_counted(self.path)
+        self.assertEqual(counts, (0, 1))
+
+        build_meta.forget_detect()
+        build_info, counts = self.detect_counted(self.path)
+        self.assertEqual(counts, (0, 1))
+
+    def test_rewrite_misses(self):
+        first_info, counts = self.detect_counted(self.path)
+
+        # A different size, then the same size with only the mtime moved.
+        self.write_image(bytes(0x3000))
+        build_info, counts = self.detect_counted(self.path)
+        self.assertEqual(counts, (0, 1))
+
+        st = os.stat(self.path)
+        os.utime(self.path, ns = (st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        build_info, counts = self.detect_counted(self.path)
+        self.assertEqual(counts, (0, 1))
+
+        # Only the newest detect of a path is kept.
+        self.assertEqual(len([key for key in build_meta.DETECT_CACHE.keys() if key[0] == os.path.realpath(self.path)]), 1)
+
+    def test_missing_file_isnt_cached(self):
+        missing_path = os.path.join(self.temp_dir.name, "missing.bin")
+
+        self.assertEqual(build_meta.detect_cache_key(missing_path), None)
+        with self.assertRaises(Exception):
+            build_meta.detect(missing_path)
+
+        self.assertEqual(len(build_meta.DETECT_CACHE), 0)
+
+    def test_returns_a_copy(self):
+        first_info, counts = self.detect_counted(self.path)
+        image_type = first_info["image_type"]
+
+        first_info["image_type"] = IMAGE_TYPE.BOX
+        first_info["is_scrambled"] = True
+        del first_info["romfs_offset"]
+
+        build_info, counts = self.detect_counted(self.path)
+
+        self.assertEqual(counts, (1, 0))
+        self.assertEqual(build_info["image_type"], image_type)
+        self.assertFalse("is_scrambled" in build_info)
+        self.assertEqual(build_info["romfs_offset"], -1)
+        self.assertIsNot(build_info, first_info)
+
+class build_meta_scrambled_reader_test(unittest.TestCase):
+    CHUNK_SIZE = scrambled_reader.CHUNK_SIZE
+    BIG_READ = (scrambled_reader.CACHE_CHUNKS + 1) * scrambled_reader.CHUNK_SIZE + 1
+    FILE_SIZES = [0, 1, 8, 9, 16, 0x1000, 0x1001, 0x1008, 0x1009, (scrambled_reader.CACHE_CHUNKS + 2) * scrambled_reader.CHUNK_SIZE + 0x13]
+
+    def unscrambled_files(self, temp_dir):
+        r = random.Random(0x565752)
+
+        for file_size in self.FILE_SIZES:
+            path = os.path.join(temp_dir, hex(file_size) + ".vwr")
+            out_path = os.path.join(temp_dir, hex(file_size) + ".bin")
+
+            with open(path, "wb") as f:
+                f.write(bytes(r.randrange(0x100) for i in range(file_size)))
+
+            romfs_cipher.unscramble_vwr_file({"path": path}, True, out_path)
+
+            with open(out_path, "rb") as f:
+                yield path, f.read()
+
+    def read_cases(self, file_size):
+        offsets = [0, 1, 7, 8, 9, 0xfff, 0x1000, 0x1001, file_size - 9, file_size - 8, file_size - 1, file_size, file_size + 5]
+        sizes = [-1, 0, 1, 7, 8, 9, 0xfff, 0x1000, 0x1001, self.BIG_READ]
+
+        for offset in offsets:
+            for size in sizes:
+                if offset >= 0:
+                    yield offset, size
+
+    def test_reads_match_unscramble_vwr_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for path, data in self.unscrambled_files(temp_dir):
+                with romfs_cipher.open_vwr_file(path) as f:
+                    with self.subTest(hex(len(data))):
+                        self.assertEqual(f.read(), data)
+                        self.assertEqual(f.tell(), len(data))
+                        self.assertEqual(f.read(), b'')
+
+                    for offset, size in self.read_cases(len(data)):
+                        with self.subTest(hex(len(data)) + " " + hex(offset) + " " + hex(size)):
+                            self.assertEqual(f.seek(offset), offset)
+
+                            expected_data = data[offset:] if size < 0 else data[offset:(offset + size)]
+
+                            self.assertEqual(f.read(size), expected_data)
+                            self.assertEqual(f.tell(), offset + len(expected_data))
+                            self.assertLessEqual(len(f.chunks), scrambled_reader.CACHE_CHUNKS)
+
+    def test_seek_whence(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path, data = list(self.unscrambled_files(temp_dir))[-1]
+
+            with romfs_cipher.open_vwr_file(path) as f:
+                f.seek(-9, os.SEEK_END)
+                self.assertEqual(f.read(0x10), data[-9:])
+
+                f.seek(0xffd)
+                f.seek(4, os.SEEK_CUR)
+                self.assertEqual(f.read(8), data[0x1001:0x1009])
+
+                self.assertEqual(f.seek(-0x100, os.SEEK_SET), 0)
+
+    def test_random_reads(self):
+        r = random.Random(0x524541)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path, data = list(self.unscrambled_files(temp_dir))[-1]
+
+            with romfs_cipher.open_vwr_file(path) as f:
+                for i in range(0x200):
+                    offset = r.randrange(len(data) + 0x10)
+                    size = r.choice([r.randrange(0x20), r.randrange(0x2000), r.randrange(self.BIG_READ + 0x1000)])
+
+                    with self.subTest(hex(offset) + " " + hex(size)):
+                        f.seek(offset)
+                        self.assertEqual(f.read(size), data[offset:(offset + size)])
+
+if __name__ == "__main__":
+    unittest.main()
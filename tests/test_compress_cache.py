@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from tests.corpus import corpus
+from lib.build_meta import *
+
+class compress_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def counted(self, compress_function):
+        calls = []
+        def counted_function(blob):
+            calls.append(len(blob))
+
+            return compress_function(blob)
+
+        return counted_function, calls
+
+    def test_hit_skips_compressor(self):
+        blob = corpus()["mixed"]
+        compress_function, calls = self.counted(lzss().Lzss_Compress)
+
+        first_data = compress_cache.compress(self.cache_dir, blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION, compress_function, True)
+        second_data = compress_cache.compress(self.cache_dir, blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION, compress_function, True)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(bytes(second_data), bytes(first_data))
+        self.assertEqual(bytes(second_data), bytes(lzss().Lzss_Compress(bytearray(blob))))
+
+    def test_no_cache_dir(self):
+        blob = corpus()["text"]
+        compress_function, calls = self.counted(lzss().Lzss_Compress)
+
+        compress_cache.compress(None, blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION, compress_function, True)
+        compress_cache.compress(None, blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION, compress_function, True)
+
+        self.assertEqual(len(calls), 2)
+
+    def test_codecs_dont_collide(self):
+        blob = corpus()["text"]
+        lzss_function, lzss_calls = self.counted(lambda blob: lzss().Lzss_Compress(bytearray(blob)))
+        lzj_function, lzj_calls = self.counted(lambda blob: lzj(LZJ_VERSION.VERSION1).Lzj_Compress(bytearray(blob)))
+
+        lzss_data = bytes(compress_cache.compress(self.cache_dir, blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION, lzss_function, True))
+        lzj_data = bytes(compress_cache.compress(self.cache_dir, blob, LZJ_VERSION.VERSION1, lzj.ENCODER_REVISION, lzj_function, True))
+
+        self.assertNotEqual(compress_cache.key(blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION), compress_cache.key(blob, LZJ_VERSION.VERSION1, lzj.ENCODER_REVISION))
+        self.assertNotEqual(compress_cache.key(blob, LZJ_VERSION.VERSION1, lzj.ENCODER_REVISION), compress_cache.key(blob, LZJ_VERSION.VERSION2, lzj.ENCODER_REVISION))
+        self.assertNotEqual(lzss_data, lzj_data)
+
+        self.assertEqual(bytes(compress_cache.compress(self.cache_dir, blob, FILE_COMPRESSION.LZSS, lzss.ENCODER_REVISION, lzss_function, True)), lzss_data)
+        self.assertEqual(bytes(compress_cache.compress(self.cache_dir, blob, LZJ_VERSION.VERSION1, lzj.ENCODER_REVISION, lzj_function, True)), lzj_data)
+        self.assertEqual((len(lzss_calls), len(lzj_calls)), (1, 1))
+
+    def test_encoder_revision_bump_misses(self):
+        blob = corpus()["code"]
+        compress_function, calls = self.counted(lzss().Lzss_Compress)
+
+        compress_cache.compress(self.cache_dir, blob, FILE_COMPRESSION.LZSS, 0x01, compress_function, True)
+        compress_cache.compress(self.cache_dir, blob, FILE_COMPRESSION.LZSS, 0x02, compress_function, True)
+        compress_cache.compress(self.cache_dir, blob, FILE_COMPRESSION.LZSS, 0x02, compress_function, True)
+
+        self.assertEqual(len(calls), 2)
+
+    def test_eviction_drops_least_recently_used(self):
+        for i, key in enumerate(["a", "b", "c"]):
+            compress_cache.put(self.cache_dir, key, bytes(0x100))
+
+            # Spread the mtimes out so the order doesn't come down to the clock's resolution.
+            path = os.path.join(self.cache_dir, key + compress_cache.FILE_EXTENSION)
+            os.utime(path, (1000000 + i, 1000000 + i))
+
+        # A hit makes "a" the most recently used, so "b" is the oldest now.
+        self.assertEqual(compress_cache.get(self.cache_dir, "a"), bytes(0x100))
+
+        compress_cache.put(self.cache_dir, "d", bytes(0x100), 0x300)
+
+        self.assertEqual(compress_cache.get(self.cache_dir, "b"), None)
+        for key in ["a", "c", "d"]:
+            with self.subTest(key):
+                self.assertEqual(compress_cache.get(self.cache_dir, key), bytes(0x100))
+
+    def test_checkpoints_dont_count_against_outputs(self):
+        compress_cache.put(self.cache_dir, "output", bytes(0x100))
+        compress_cache.put(compress_cache.checkpoint_dir(self.cache_dir), "checkpoint", bytes(0x1000), 0x1000)
+
+        compress_cache.evict(self.cache_dir, 0x100)
+
+        self.assertEqual(compress_cache.get(self.cache_dir, "output"), bytes(0x100))
+
+if __name__ == "__main__":
+    unittest.main()
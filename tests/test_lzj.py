@@ -0,0 +1,268 @@
+import sys
+import hashlib
+import random
+import unittest
+import unittest.mock
+import tempfile
+import zlib
+import os
+from tests.corpus import corpus
+from lib.lzj import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# What the original encoder made of each corpus blob. None means it couldn't compress it.
+LZJ_SHA256 = {
+    "VERSION0": {
+        "empty": None,
+        "one": None,
+        "two": None,
+        "short": None,
+        "zeros": "c585c02cb2a0bf37f128036b86b3c73d4b540b436d196317baf90abaefe8ddb5",
+        "ramp": "cb018cc610fe08084cc31c99b32bf51fce6937630b4dca279e9ea062685ef209",
+        "text": "b3ae294071a205983f9315b1f497c36e9bb3bce1d3ab44ce6c63b6eefb5530ca",
+        "code": "4cf2b2a2ec04320910b9f04b25be584bf54f334ccb8301fabaa58c6ba39dd9e4",
+        "mixed": "69dba24ec527e131743dcd81c57212a99f78baf340be162b694d24bcb29ee71c",
+        "two_symbols": "a5641ef1644e108f9f8ea22b40472c79ddc421d10732e4552ed46f9c010eb966",
+        "random": None,
+    },
+    "VERSION1": {
+        "empty": None,
+        "one": None,
+        "two": None,
+        "short": None,
+        "zeros": "c585c02cb2a0bf37f128036b86b3c73d4b540b436d196317baf90abaefe8ddb5",
+        "ramp": "cb018cc610fe08084cc31c99b32bf51fce6937630b4dca279e9ea062685ef209",
+        "text": "b3ae294071a205983f9315b1f497c36e9bb3bce1d3ab44ce6c63b6eefb5530ca",
+        "code": "4cf2b2a2ec04320910b9f04b25be584bf54f334ccb8301fabaa58c6ba39dd9e4",
+        "mixed": "69dba24ec527e131743dcd81c57212a99f78baf340be162b694d24bcb29ee71c",
+        "two_symbols": "a5641ef1644e108f9f8ea22b40472c79ddc421d10732e4552ed46f9c010eb966",
+        "random": None,
+    },
+    "VERSION2": {
+        "empty": None,
+        "one": None,
+        "two": None,
+        "short": None,
+        "zeros": "2000deffb9d61845129fe693bf7de75978cc1c2cd078f18f9f236eb88204eae3",
+        "ramp": "a95e3ae979df89637433e939f972e3629828725c7403d84c8f5d5c8eb73384dd",
+        "text": "c23928cb7f942147d1617d137f6c73e8ff7c188967ff62ba0b65976a21b5b70e",
+        "code": "c3fe2d2670a69157190d46fc3d0931fd46fda98f35fefcd6511079e8d29f6d24",
+        "mixed": "f279a18a3a9228c38cb964facbb45da918603ce53d3250f8a316fa601e5594e2",
+        "two_symbols": "b8cda1ef3126040c5f4907698feb0da17752da556976836bbbe3b503b11498d8",
+        "random": None,
+    },
+    "VERSION3": {
+        "empty": None,
+        "one": None,
+        "two": None,
+        "short": None,
+        "zeros": "c585c02cb2a0bf37f128036b86b3c73d4b540b436d196317baf90abaefe8ddb5",
+        "ramp": "cb018cc610fe08084cc31c99b32bf51fce6937630b4dca279e9ea062685ef209",
+        "text": "3a3d777aeb26edc195ed2c42b8a7fdebef5f888e04eeeb30172e00291170b4e1",
+        "code": "4b73e892dd85fe902c74ca1283886401fc9febe86add637a8ee4559020669b18",
+        "mixed": "15b8feea6ef782fdcafc4bed522eb915a8614cca5629184f76a15e22aa220757",
+        "two_symbols": "409f67f350a96bc9903abb325b49bc1df899c8dc8aa9b6768c9c972b839222b4",
+        "random": None,
+    },
+}
+
+# The expander doesn't give these back the same yet (the original revision doesn't either), what it does give is pinned.
+LZJ_EXPAND_SHA256 = {
+    ("VERSION0", "ramp"): "fd9243e1ba57263ed469c3bdbd7ade6ec5254e7ed924a9f5737fa44749933cc0",
+    ("VERSION0", "text"): "252f6f09517d99b5b08c177312ab2895e46cb1c203f9f7f6aeedf1a6433a8ca9",
+    ("VERSION0", "code"): "7c4653324dfbdb99de39e81766a7b169b69f0f06bf769625d9abecff79dc6518",
+    ("VERSION0", "mixed"): "70a04fc093c89b58976fa791f64511eaf8c70ebf59c3c1dfec2fc98312e16f3e",
+    ("VERSION1", "ramp"): "fd9243e1ba57263ed469c3bdbd7ade6ec5254e7ed924a9f5737fa44749933cc0",
+    ("VERSION2", "ramp"): "fd9243e1ba57263ed469c3bdbd7ade6ec5254e7ed924a9f5737fa44749933cc0",
+    ("VERSION3", "ramp"): "fd9243e1ba57263ed469c3bdbd7ade6ec5254e7ed924a9f5737fa44749933cc0",
+    ("VERSION3", "text"): "a485d0447c86b9ba19126d995bf1a6a1eae4b2bcd2c04e9bbf654580cbea8715",
+    ("VERSION3", "code"): "4fce6285049e7af64882a6f536d3b5ba35f35a6300a95acb317ef64b4e16d566",
+    ("VERSION3", "mixed"): "cb6f2f189d2e060a0d65ebf04f7a875e4cbc9e39b1924062b780896af82c97ea",
+    ("VERSION3", "two_symbols"): "fda1f9206f74c96f63bc2f58b422b2b582a4fb8ceff0fe4b8a63dd7011edee57",
+}
+
+class lzj_match_finder_test(unittest.TestCase):
+    def compress(self, version, match_finder, data):
+        d = lzj(version, match_finder, 4)
+        # Small enough inputs would otherwise fall back to RADIX without ever starting the pool.
+        d.PARALLEL_MIN_SIZE = 0
+
+        return bytes(d.Lzj_Compress(bytearray(data)))
+
+    def check_match_finders(self, version, data):
+        radix_data = self.compress(version, LZJ_MATCH_FINDER.RADIX, data)
+
+        if numpy != None:
+            self.assertEqual(self.compress(version, LZJ_MATCH_FINDER.NUMPY, data), radix_data)
+
+        self.assertEqual(self.compress(version, LZJ_MATCH_FINDER.PARALLEL, data), radix_data)
+
+    def test_match_finders_agree(self):
+        c = corpus()
+        for version in [LZJ_VERSION.VERSION0, LZJ_VERSION.VERSION1, LZJ_VERSION.VERSION2, LZJ_VERSION.VERSION3]:
+            for name in ["zeros", "mixed"]:
+                with self.subTest(str(version) + " " + name):
+                    self.check_match_finders(version, c[name])
+
+    def test_match_finders_agree_on_mixed_content(self):
+        c = corpus()
+
+        self.check_match_finders(LZJ_VERSION.VERSION1, c["mixed"] + c["code"] + c["text"] + c["ramp"])
+
+    def test_match_finders_agree_past_far_offsets(self):
+        # Repeats from more than 0x11101 bytes back and a long run, so every match column gets filled.
+        c = corpus()
+        r = random.Random(5)
+        words = c["text"].split(b" ")
+
+        head = c["mixed"] + c["code"] + c["text"]
+        filler = b" ".join(r.choice(words) for i in range(0x2400))[0:0x9000]
+        data = head + filler + bytes([0x5a]) * 0x1000 + head[0:0x3000] + filler[0x100:0x2100] + head[0x4000:0x6000]
+
+        match_finders = [LZJ_MATCH_FINDER.RADIX, LZJ_MATCH_FINDER.PARALLEL]
+        if numpy != None:
+            match_finders.append(LZJ_MATCH_FINDER.NUMPY)
+
+        results = {}
+        for match_finder in match_finders:
+            d = lzj(LZJ_VERSION.VERSION1, match_finder, 4)
+            d.PARALLEL_MIN_SIZE = 0
+
+            columns = []
+            def keep_columns(phase, positions_done, total):
+                if phase == LZJ_PHASE.FIND_MATCHES and positions_done == total:
+                    columns[:] = [bytes(d.CloseMatchesNOffsetDiffs), bytes(d.Level2Matches), bytes(d.Level3Matches), bytes(d.Level4Matches), bytes(d.Level5Matches)]
+            d.progress_callback = keep_columns
+
+            results[match_finder] = (bytes(d.Lzj_Compress(bytearray(data))), columns)
+
+        radix_data, radix_columns = results[LZJ_MATCH_FINDER.RADIX]
+        for column in radix_columns:
+            self.assertTrue(any(column))
+
+        for match_finder in match_finders:
+            with self.subTest(str(match_finder)):
+                self.assertEqual(results[match_finder][1], radix_columns)
+                self.assertEqual(results[match_finder][0], radix_data)
+
+class lzj_codec_test(unittest.TestCase):
+    def test_output_matches_original_codec(self):
+        for version in [LZJ_VERSION.VERSION0, LZJ_VERSION.VERSION1, LZJ_VERSION.VERSION2, LZJ_VERSION.VERSION3]:
+            for name, blob in corpus().items():
+                with self.subTest(str(version) + " " + name):
+                    sha256 = LZJ_SHA256[str(version)][name]
+
+                    if sha256 == None:
+                        # Too small or doesn't compress, lzj can't store something bigger than the input.
+                        with self.assertRaises(Exception):
+                            lzj(version).Lzj_Compress(bytearray(blob))
+                    else:
+                        compressed_data = bytes(lzj(version).Lzj_Compress(bytearray(blob)))
+                        self.assertEqual(hashlib.sha256(compressed_data).hexdigest(), sha256)
+
+                        uncompressed_data = bytes(lzj(version).Lzj_Expand(compressed_data))
+                        self.assertEqual(hashlib.sha256(uncompressed_data).hexdigest(), LZJ_EXPAND_SHA256.get((str(version), name), hashlib.sha256(blob).hexdigest()))
+
+    def test_expand_stop_after(self):
+        blob = corpus()["mixed"]
+        compressed_data = bytes(lzj(LZJ_VERSION.VERSION1).Lzj_Compress(bytearray(blob)))
+
+        for stop_after in [0, 1, 0xFF, 0x100, 0x101, 0x1000, len(blob) - 1, len(blob), len(blob) + 1]:
+            with self.subTest(hex(stop_after)):
+                d = lzj(LZJ_VERSION.VERSION1)
+
+                self.assertEqual(bytes(d.Lzj_Expand(compressed_data, stop_after)), blob[0:stop_after])
+
+                # Picking up where it stopped gives the rest.
+                self.assertEqual(d.Lzj_ExpandTo(-1), len(blob))
+                self.assertEqual(bytes(d.uncompressed_data), blob)
+
+    @unittest.skipIf(numpy == None, "numpy isn't installed so there's only the one path")
+    def test_match_lengths_without_numpy(self):
+        # RankMatches works match lengths out ahead of time with numpy, this makes the import fail so it falls back
+        # to FindMatchLength at every position.
+        c = corpus()
+        for version in [LZJ_VERSION.VERSION1, LZJ_VERSION.VERSION2]:
+            for name in ["zeros", "code", "mixed", "two_symbols"]:
+                with self.subTest(str(version) + " " + name):
+                    numpy_data = bytes(lzj(version).Lzj_Compress(bytearray(c[name])))
+
+                    with unittest.mock.patch.dict(sys.modules, {"numpy": None}):
+                        self.assertEqual(bytes(lzj(version).Lzj_Compress(bytearray(c[name]))), numpy_data)
+
+    def test_versionx_is_stored(self):
+        blob = corpus()["mixed"]
+
+        self.assertEqual(lzj(LZJ_VERSION.VERSIONX).Lzj_Compress(blob), blob)
+
+class lzj_checkpoint_test(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_dir = self.temp_dir.name
+
+        self.blob = corpus()["mixed"]
+        self.cold_data = bytes(lzj(LZJ_VERSION.VERSION1).Lzj_Compress(bytearray(self.blob)))
+
+        # Encoding normally removes the checkpoints once it's done, keep them so there's something to resume from.
+        with unittest.mock.patch.object(lzj, "RemoveCheckpoints"):
+            self.assertEqual(self.compress(self.blob), (self.cold_data, None))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def compress(self, blob):
+        d = lzj(LZJ_VERSION.VERSION1, checkpoint_dir = self.checkpoint_dir)
+        compressed_data, summary = d.Lzj_CompressWithSummary(bytearray(blob))
+
+        return bytes(compressed_data), summary.get("resumed_after")
+
+    def checkpoint_path(self, phase):
+        return os.path.join(self.checkpoint_dir, compress_cache.key(self.blob, LZJ_VERSION.VERSION1, lzj.ENCODER_REVISION) + "-" + str(phase).lower() + compress_cache.FILE_EXTENSION)
+
+    def test_resume_after_rank_matches(self):
+        self.assertEqual(self.compress(self.blob), (self.cold_data, str(LZJ_PHASE.RANK_MATCHES)))
+
+        # Finishing removes them.
+        self.assertFalse(os.path.exists(self.checkpoint_path(LZJ_PHASE.FIND_MATCHES)))
+        self.assertFalse(os.path.exists(self.checkpoint_path(LZJ_PHASE.RANK_MATCHES)))
+
+    def test_resume_after_find_matches(self):
+        os.remove(self.checkpoint_path(LZJ_PHASE.RANK_MATCHES))
+
+        self.assertEqual(self.compress(self.blob), (self.cold_data, str(LZJ_PHASE.FIND_MATCHES)))
+
+    def test_other_data_misses(self):
+        blob = self.blob[0:-1] + b'\x00'
+
+        self.assertEqual(self.compress(blob), (bytes(lzj(LZJ_VERSION.VERSION1).Lzj_Compress(bytearray(blob))), None))
+
+    def test_bad_checkpoints_are_recomputed(self):
+        good_checkpoints = {}
+        for phase in [LZJ_PHASE.FIND_MATCHES, LZJ_PHASE.RANK_MATCHES]:
+            with open(self.checkpoint_path(phase), "rb") as f:
+                good_checkpoints[phase] = f.read()
+
+        for phase, checkpoint_data in good_checkpoints.items():
+            decompressed_data = zlib.decompress(checkpoint_data)
+            bad_checkpoints = {
+                "truncated": checkpoint_data[0:len(checkpoint_data) // 2],
+                "garbage": bytes(range(0x100)),
+                "empty": b'',
+                "short column": zlib.compress(decompressed_data[0:-4]),
+                "wrong magic": zlib.compress(b'XXXX' + decompressed_data[4:]),
+            }
+
+            for name, bad_data in bad_checkpoints.items():
+                with self.subTest(str(phase) + " " + name):
+                    for keep_phase in [LZJ_PHASE.FIND_MATCHES, LZJ_PHASE.RANK_MATCHES]:
+                        with open(self.checkpoint_path(keep_phase), "wb") as f:
+                            f.write(bad_data if keep_phase == phase else b'')
+
+                    self.assertEqual(self.compress(self.blob), (self.cold_data, None))
+
+if __name__ == "__main__":
+    unittest.main()
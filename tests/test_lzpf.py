@@ -0,0 +1,61 @@
+import hashlib
+import unittest
+from tests.corpus import corpus
+from lib.lzpf import *
+
+# What the original encoder made of each corpus blob.
+LZPF_SHA256 = {
+    "empty": "709e80c88487a2411e1ee4dfb9f22a861492d20c4765150c0c794abd70f8147c",
+    "one": "af2d303d45e1bee2e505b6d4c2ae2eb269a7590b164ac7a55227b503d3587b0c",
+    "two": "e1d6dbb2fd0facebe1555e791d0fd3782ce5d1570f4969025056dea83e9dd617",
+    "short": "c9a8817343ca342212c735659e034ce35580a32bd3902bbb4199656839979383",
+    "zeros": "4a1eb6dc96d992ae05efffadcb3250ea563441586a4307fb6167f35b5b31ae55",
+    "ramp": "73ec117affb99eaccbd2e611b0a7efb01f061aa0d693b068870fab5a2b76c77c",
+    "text": "23008beaafd12971226a3d8aa9182f151eaa2fa503d2cb0294371b4446ad673f",
+    "code": "db64a64e31513d1159bd63fe786ebb4c9cee69c5e3026b3a7f5d97ba4c3e0b7c",
+    "mixed": "9b3b16b364ad800df69a35e7718e71e7fbe16aed3a25ecce49058bbea5af70bc",
+    "two_symbols": "e57f5746cb44ec74b8e1b5b4a51f76fd8c479c4814303790a568abb54b131ba5",
+    "random": "19d11d537ffd55a2a91bfd209c71c51c79279079db14f41adb0247eb7cbab138",
+}
+
+class lzpf_test(unittest.TestCase):
+    def test_output_matches_original_encoder(self):
+        for name, blob in corpus().items():
+            with self.subTest(name):
+                compressed_data = lzpf().Lzpf_Compress(bytearray(blob))
+
+                self.assertEqual(hashlib.sha256(bytes(compressed_data)).hexdigest(), LZPF_SHA256[name])
+
+    def test_round_trips(self):
+        for name, blob in corpus().items():
+            # The end code can't be read back out of a stream this short. romfs_implode only tries LZPF on files over 10 bytes.
+            if len(blob) < 2:
+                continue
+
+            with self.subTest(name):
+                compressed_data = lzpf().Lzpf_Compress(bytearray(blob))
+
+                self.assertEqual(bytes(lzpf().Lzpf_Expand(compressed_data)), blob)
+
+    def test_estimate_size(self):
+        for name, blob in corpus().items():
+            with self.subTest(name):
+                self.assertEqual(lzpf().Lzpf_EstimateSize(bytearray(blob)), len(lzpf().Lzpf_Compress(bytearray(blob))))
+
+    def test_estimate_size_limit(self):
+        # At or under the limit the size is exact, over it anything past the limit will do.
+        for name in ["short", "text", "mixed", "random"]:
+            blob = corpus()[name]
+            compressed_size = len(lzpf().Lzpf_Compress(bytearray(blob)))
+
+            for size_limit in [0, 1, compressed_size - 1, compressed_size, compressed_size + 1]:
+                with self.subTest(name + " " + hex(size_limit)):
+                    estimated_size = lzpf().Lzpf_EstimateSize(bytearray(blob), size_limit)
+
+                    if compressed_size <= size_limit:
+                        self.assertEqual(estimated_size, compressed_size)
+                    else:
+                        self.assertGreater(estimated_size, size_limit)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import hashlib
+import unittest
+from tests.corpus import corpus
+from lib.lzss import *
+
+# What the original binary tree encoder made of each corpus blob. EXACT has to keep matching these.
+LZSS_EXACT_SHA256 = {
+    "empty": "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855",
+    "one": "acfa6b0e008d0208f16026b4d17a4c070e8f9f8d05461bf3ad590044fcd89026",
+    "two": "75754eee5a4d01cadb3618951d3d511de0480e8560a7682db53867dc742b2aa0",
+    "short": "b96fea1df8c2e83384b8a8773b66cd73bda14a4c82b1a79fb99e45970300ece0",
+    "zeros": "6785fe8a05d1a62104ad6bc00ead9ac83ba0f239388749d30c04bc1d39812222",
+    "ramp": "889e649f1603ea71b19a7c7ac34f1e6624d7829c5c78b65d67e6c51729a91166",
+    "text": "da0f9557ab67fa81a920b523779455bfa143f72ed0b927d37bdd875c8c96f0bf",
+    "code": "f2870018647479cb55735d80aac7a8f3694a68cf5fe0bd6c3ca489bda814e596",
+    "mixed": "671b854a479e88f4030bd7a06dde5bd9b18fd52388d0ef8fa0eddbd51cadb0a5",
+    "two_symbols": "48224509ff8fde9e51d93d864af745f6c67b64381c41124ff13db6490145ef51",
+    "random": "d5c7cf258d95c51e578f26c031e5006a9f37d6a72a8feeeb458658be502e47ca",
+}
+
+class lzss_match_finder_test(unittest.TestCase):
+    def test_exact_matches_original_encoder(self):
+        for name, blob in corpus().items():
+            with self.subTest(name):
+                compressed_data = lzss(LZSS_MATCH_FINDER.EXACT).Lzss_Compress(bytearray(blob))
+
+                self.assertEqual(hashlib.sha256(bytes(compressed_data)).hexdigest(), LZSS_EXACT_SHA256[name])
+
+    def test_exact_is_the_default(self):
+        blob = corpus()["mixed"]
+
+        self.assertEqual(lzss().Lzss_Compress(bytearray(blob)), lzss(LZSS_MATCH_FINDER.EXACT).Lzss_Compress(bytearray(blob)))
+
+    def test_fast_round_trips(self):
+        for name, blob in corpus().items():
+            with self.subTest(name):
+                compressed_data = lzss(LZSS_MATCH_FINDER.FAST).Lzss_Compress(bytearray(blob))
+
+                self.assertEqual(bytes(lzss().Lzss_Expand(compressed_data, len(blob))), blob)
+
+    def test_clear_resets_instance(self):
+        # Like the original encoder an instance carries its ring buffer over, clear() puts it back to a fresh one.
+        c = corpus()
+        for match_finder in LZSS_MATCH_FINDER:
+            with self.subTest(str(match_finder)):
+                d = lzss(match_finder)
+                d.Lzss_Compress(bytearray(c["mixed"]))
+                d.clear()
+
+                self.assertEqual(d.Lzss_Compress(bytearray(c["text"])), lzss(match_finder).Lzss_Compress(bytearray(c["text"])))
+
+    def test_size_limit(self):
+        # At or under the limit the output (or size) is exact. Over it Lzss_Compress gives None and
+        # Lzss_EstimateSize anything past the limit.
+        for name in ["short", "text", "mixed", "random"]:
+            blob = corpus()[name]
+
+            for match_finder in LZSS_MATCH_FINDER:
+                compressed_data = lzss(match_finder).Lzss_Compress(bytearray(blob))
+                compressed_size = len(compressed_data)
+
+                self.assertEqual(lzss(match_finder).Lzss_EstimateSize(bytearray(blob)), compressed_size)
+
+                for size_limit in [0, 1, compressed_size - 1, compressed_size, compressed_size + 1]:
+                    with self.subTest(name + " " + str(match_finder) + " " + hex(size_limit)):
+                        estimated_size = lzss(match_finder).Lzss_EstimateSize(bytearray(blob), size_limit)
+                        limited_data = lzss(match_finder).Lzss_Compress(bytearray(blob), size_limit)
+
+                        if compressed_size <= size_limit:
+                            self.assertEqual(estimated_size, compressed_size)
+                            self.assertEqual(limited_data, compressed_data)
+                        else:
+                            self.assertGreater(estimated_size, size_limit)
+                            self.assertEqual(limited_data, None)
+
+    def test_expand_stop_after(self):
+        blob = corpus()["mixed"]
+        compressed_data = lzss().Lzss_Compress(bytearray(blob))
+
+        for uncompressed_size in [0, len(blob)]:
+            for stop_after in [0, 1, 7, 8, 9, 0x1000, len(blob) - 1, len(blob), len(blob) + 1]:
+                with self.subTest(hex(uncompressed_size) + " " + hex(stop_after)):
+                    self.assertEqual(bytes(lzss().Lzss_Expand(compressed_data, uncompressed_size, stop_after = stop_after)), blob[0:stop_after])
+
+    def test_match_before_start_reads_zeros(self):
+        # A literal then two matches that both start one byte before the output does.
+        compressed_data = bytearray([0xF9, 0x41, 0x01, 0x02, 0x06, 0x00])
+
+        self.assertEqual(bytes(lzss().Lzss_Expand(compressed_data, 0)), b"A\x00A\x00A\x00\x00A\x00")
+
+    def test_decompressor_matches_expand(self):
+        for name, blob in corpus().items():
+            with self.subTest(name):
+                compressed_data = lzss().Lzss_Compress(bytearray(blob))
+
+                d = LzssDecompressor(len(blob))
+                uncompressed_data = b''
+                for i in range(0, len(compressed_data), 0x133):
+                    uncompressed_data += d.feed(compressed_data[i:i + 0x133])
+                uncompressed_data += d.flush()
+
+                self.assertEqual(uncompressed_data, blob)
+
+    def test_decompressor_flush_reports_half_match(self):
+        compressed_data = lzss().Lzss_Compress(bytearray(corpus()["mixed"]))
+
+        d = LzssDecompressor()
+        d.feed(compressed_data)
+        d.flush()
+
+        d = LzssDecompressor()
+        d.feed(bytearray([0x00, 0x00]))
+        with self.assertRaises(Exception):
+            d.flush()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import sys
+import random
+import unittest
+import unittest.mock
+from lib.tea import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def block_data():
+    r = random.Random(0x544541)
+
+    samples = [b'', bytes(8), b'\xff' * 8, b'\xff' * 0x18]
+    for blocks in [1, 2, 3, 0x20, 0x81]:
+        samples.append(bytes(r.randrange(0x100) for i in range(blocks * 8)))
+
+    return samples
+
+def block_keys():
+    r = random.Random(0x4b4559)
+
+    return [bytes(16), b'\xff' * 16, bytes(r.randrange(0x100) for i in range(16))]
+
+def each_block(function, data, key):
+    return b''.join(function(data[i:i + 8], key) for i in range(0, len(data), 8))
+
+class tea_blocks_test(unittest.TestCase):
+    def check_blocks(self):
+        for key in block_keys():
+            for data in block_data():
+                with self.subTest(key.hex() + " " + hex(len(data))):
+                    encrypted_data = tea.encrypt_blocks(data, key)
+
+                    self.assertEqual(encrypted_data, each_block(tea.encrypt, data, key))
+                    self.assertEqual(tea.decrypt_blocks(data, key), each_block(tea.decrypt, data, key))
+                    self.assertEqual(tea.decrypt_blocks(encrypted_data, key), data)
+                    self.assertEqual(tea.encrypt_blocks(bytearray(data), key), encrypted_data)
+
+    @unittest.skipIf(numpy == None, "numpy isn't installed")
+    def test_blocks_match_each_block_numpy(self):
+        self.check_blocks()
+
+    def test_blocks_match_each_block_without_numpy(self):
+        # None in sys.modules makes the import in run_blocks raise ImportError.
+        with unittest.mock.patch.dict(sys.modules, {"numpy": None}):
+            self.check_blocks()
+
+    def test_blocks_size(self):
+        for size in [1, 7, 9]:
+            with self.subTest(size):
+                with self.assertRaises(Exception):
+                    tea.encrypt_blocks(bytes(size), bytes(16))
+                with self.assertRaises(Exception):
+                    tea.decrypt_blocks(bytes(size), bytes(16))
+
+if __name__ == "__main__":
+    unittest.main()